@@ -54,8 +54,11 @@ class QueryConsumer(AsyncWebsocketConsumer):
             nodes = validated_data.get("nodes")
             level = validated_data.get("level")
             message = validated_data.get("message") or ""
+            token_budget = validated_data.get("token_budget")
 
-            messages = await database_sync_to_async(buddy._get_messages)(level, nodes, message)
+            messages = await database_sync_to_async(buddy._get_messages)(
+                level, nodes, message, token_budget=token_budget
+            )
 
             try:
                 response = await utils.llm.get_async_openai_client().chat.completions.create(
@@ -29,13 +29,17 @@ class Buddy(utils_models.SoftDeletableBaseModel):
     )
 
     def query_model(
-        self, nodes: list["nodes_models.Node"], level: int, query: str
+        self,
+        nodes: list["nodes_models.Node"],
+        level: int,
+        query: str,
+        token_budget: int | None = None,
     ) -> typing.Generator[str | None, None, None]:
         """Query the buddy."""
 
         response = utils.llm.get_openai_client().chat.completions.create(
             model=self.model,
-            messages=self._get_messages(level, nodes, query),
+            messages=self._get_messages(level, nodes, query, token_budget=token_budget),
             stream=True,
             timeout=180,
         )
@@ -62,7 +66,14 @@ class Buddy(utils_models.SoftDeletableBaseModel):
     def calculate_token_counts(
         self, nodes: list["nodes_models.Node"], max_depth: int, query: str
     ) -> dict[int, int]:
-        """Calculate the token counts for each level."""
+        """
+        Calculate the token counts for each level.
+
+        Instead of building and tokenizing the prompt for every level, every node is rendered and
+        tokenized once per combination of settings that occurs on any level, and the count of each
+        level is summed up from those. Tokens can merge across the boundaries of the nodes, so the
+        counts can differ slightly from tokenizing the whole prompt.
+        """
         nodes_at_depth = [node.fetch_subnodes((max_depth // 2) + 1) for node in nodes]
         max_depth_achieved = max(
             min(
@@ -73,13 +84,39 @@ class Buddy(utils_models.SoftDeletableBaseModel):
             0,
         )
 
-        token_counts: dict[int, int] = {}
-        for depth in range(max_depth_achieved + 1):
-            token_counts[depth] = utils.tokens.num_tokens_from_messages(
-                self._get_messages(depth, nodes, query, nodes_at_depth), self.model
+        items_by_depth = {
+            depth: [
+                item
+                for node, nodes_at_depth_node in zip(nodes, nodes_at_depth, strict=True)
+                for item in node.node_context_items(depth, nodes_at_depth_node)
+            ]
+            for depth in range(max_depth_achieved + 1)
+        }
+        # The newline after every node is left out, it merges with the newlines that start the
+        # next node or end the context into a single token.
+        fragments = {
+            (node.public_id, include_content, include_connections): node.node_as_str(
+                include_content=include_content, include_connections=include_connections
             )
+            for items in items_by_depth.values()
+            for node, include_content, include_connections in items
+        }
+        fragment_token_counts = dict(
+            zip(fragments, utils.tokens.token_counts(fragments.values(), self.model), strict=True)
+        )
+        # The tokens of the prompt without any node context.
+        base_token_count = utils.tokens.num_tokens_from_messages(
+            self._build_messages([""] * len(nodes), query), self.model
+        )
 
-        return token_counts
+        return {
+            depth: base_token_count
+            + sum(
+                fragment_token_counts[(node.public_id, include_content, include_connections)] or 0
+                for node, include_content, include_connections in items
+            )
+            for depth, items in items_by_depth.items()
+        }
 
     def _get_messages(
         self,
@@ -87,7 +124,15 @@ class Buddy(utils_models.SoftDeletableBaseModel):
         nodes: list["nodes_models.Node"],
         query: str,
         nodes_at_depth: list[dict[int, list["nodes_models.Node"]]] | None | list[None] = None,
+        token_budget: int | None = None,
     ) -> typing.Iterable[ChatCompletionMessageParam]:
+        """
+        Build the messages for a query. With a token budget, the context of every node is expanded
+        best-first to fit into the tokens the prompt leaves, instead of up to the given level.
+        """
+        if token_budget is not None:
+            return self._build_messages(self._budgeted_context(nodes, query, token_budget), query)
+
         node_context: list[str] = []
         if nodes_at_depth is None:
             nodes_at_depth = [None] * len(nodes)
@@ -95,6 +140,30 @@ class Buddy(utils_models.SoftDeletableBaseModel):
         for node, nodes_at_depth_node in zip(nodes, nodes_at_depth, strict=True):
             node_context.append(node.node_context_for_depth(level, nodes_at_depth_node))
 
+        return self._build_messages(node_context, query)
+
+    def _budgeted_context(
+        self, nodes: list["nodes_models.Node"], query: str, token_budget: int
+    ) -> list[str]:
+        """
+        Get the context of the nodes that fits into the token budget of the whole prompt. The
+        budget is shared evenly by the nodes, the tokens a node doesn't use go to the next ones.
+        """
+        remaining_tokens = token_budget - utils.tokens.num_tokens_from_messages(
+            self._build_messages([""] * len(nodes), query), self.model
+        )
+        node_context: list[str] = []
+        for index, node in enumerate(nodes):
+            context, used_tokens = node.node_context_for_budget(
+                max(remaining_tokens // (len(nodes) - index), 0), self.model
+            )
+            remaining_tokens -= used_tokens
+            node_context.append(context)
+        return node_context
+
+    def _build_messages(
+        self, node_context: list[str], query: str
+    ) -> list[ChatCompletionMessageParam]:
         system_prompt = str(
             self.system_message
             + "\nCurrent text editor state:\n```\n"
@@ -39,6 +39,12 @@ class BuddyQuerySerializer(serializers.Serializer):
         help_text="List of nodes to use as context",
     )
     level = serializers.IntegerField(required=False, help_text="Level of depth to query the nodes")
+    token_budget = serializers.IntegerField(
+        required=False,
+        min_value=1,
+        help_text="Maximum number of tokens of the prompt, the context of the nodes is expanded "
+        "best-first to fit it instead of up to the level",
+    )
 
 
 class OpenAIQuerySerializer(adrf.serializers.Serializer):
@@ -4,6 +4,7 @@ from django.utils import timezone
 from openai.types.chat import ChatCompletion, ChatCompletionMessage
 from openai.types.chat.chat_completion import Choice
 
+import utils.tokens
 from buddies import models
 from buddies.tests import factories
 from nodes.tests import factories as node_factories
@@ -55,3 +56,40 @@ class BuddyTestCase(BaseTransactionTestCase):
         self.assertIn(0, token_counts)
         self.assertNotIn(1, token_counts)
         self.assertNotIn(-1, token_counts)
+
+    def test_token_calculation_matches_prompt(self) -> None:
+        """Test that the token counts summed per node are close to those of the whole prompt."""
+        buddy = factories.BuddyFactory(model="gpt-4o")
+        node = node_factories.NodeFactory()
+        subnodes = node_factories.NodeFactory.create_batch(3)
+        node.subnodes.add(*subnodes)
+        for subnode in subnodes:
+            subnode.subnodes.add(*node_factories.NodeFactory.create_batch(2))
+
+        token_counts = buddy.calculate_token_counts([node], 5, "test")
+        self.assertListEqual(list(token_counts), [0, 1, 2, 3])
+        self.assertListEqual(sorted(token_counts.values()), list(token_counts.values()))
+        for depth, token_count in token_counts.items():
+            expected = utils.tokens.num_tokens_from_messages(
+                buddy._get_messages(depth, [node], "test"), buddy.model
+            )
+            # Tokens can merge across the boundaries of the nodes, at most one per node.
+            self.assertAlmostEqual(token_count, expected, delta=len(node.node_context_items(depth)))
+
+    def test_token_budget(self) -> None:
+        """Test that the prompt built for a token budget fits into it."""
+        buddy = factories.BuddyFactory(model="gpt-4o")
+        nodes = node_factories.NodeFactory.create_batch(2)
+        for node in nodes:
+            node.subnodes.add(*node_factories.NodeFactory.create_batch(3))
+        prompt_tokens = utils.tokens.num_tokens_from_messages(
+            buddy._get_messages(3, nodes, "test"), buddy.model
+        )
+
+        for token_budget in (prompt_tokens // 2, prompt_tokens * 2):
+            messages = buddy._get_messages(0, nodes, "test", token_budget=token_budget)
+            self.assertLessEqual(
+                utils.tokens.num_tokens_from_messages(messages, buddy.model), token_budget
+            )
+        # The budget fits the whole graph.
+        self.assertEqual(messages, buddy._get_messages(3, nodes, "test"))
@@ -45,7 +45,8 @@ class BuddyModelViewSet(views.BaseModelViewSet):
         description="Query a buddy using the given nodes and level. The level defines the depth of "
         "the query, level 0 meaning that only the node detail page of the node specified is "
         "queried, level 1 includes the specified node's graph (subnodes), level 2 will also add "
-        "the subnodes detail pages to the context, etc.",
+        "the subnodes detail pages to the context, etc. Alternatively, a token budget for the "
+        "whole prompt can be given, the context is then expanded best-first to fit it.",
         responses={(200, "text/event-stream"): OpenApiTypes.STR, 404: None},
     )
     @action(detail=True, methods=["post"], serializer_class=serializers.BuddyQuerySerializer)
@@ -59,9 +60,11 @@ class BuddyModelViewSet(views.BaseModelViewSet):
         nodes = validated_data.get("nodes")
         level = validated_data.get("level")
         message = validated_data.get("message") or ""
+        token_budget = validated_data.get("token_budget")
 
         return StreamingHttpResponse(
-            buddy.query_model(nodes, level, message), content_type="text/event-stream"
+            buddy.query_model(nodes, level, message, token_budget),
+            content_type="text/event-stream",
         )
 
     @extend_schema(
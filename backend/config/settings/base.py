@@ -457,12 +457,88 @@ IMAGEKIT_DEFAULT_CACHEFILE_STRATEGY = "imagekit.cachefiles.strategies.Optimistic
 NODE_CRDT_KEY = env("NODE_CRDT_KEY", default="default")
 NODE_CRDT_EVENTS_INTERVAL = env.int("NODE_CRDT_INTERVAL", default=60 * 5)
 NODE_CRDT_EVENTS_TASK = env("NODE_CRDT_TASK", default="nodes.tasks.process_document_events")
+# The number of document events that are claimed and processed together.
+NODE_CRDT_EVENTS_BATCH_SIZE = env.int("NODE_CRDT_EVENTS_BATCH_SIZE", default=100)
+# The number of shards the document events are partitioned into, each shard is processed by its
+# own task, so up to this many workers can process events in parallel.
+NODE_CRDT_EVENTS_SHARDS = env.int("NODE_CRDT_EVENTS_SHARDS", default=1)
+# The budget of a single task run, after which it commits its work and enqueues a new task for the
+# remaining events. The time budget (in seconds) has to stay below CELERY_TASK_SOFT_TIME_LIMIT.
+NODE_CRDT_EVENTS_TIME_BUDGET = env.float("NODE_CRDT_EVENTS_TIME_BUDGET", default=30)
+NODE_CRDT_EVENTS_MAX_EVENTS = env.int("NODE_CRDT_EVENTS_MAX_EVENTS", default=10_000)
+# Failed document events are retried with an exponential backoff, starting at the given number of
+# seconds, until they failed the given number of times.
+NODE_CRDT_EVENTS_RETRY_TASK = env(
+    "NODE_CRDT_EVENTS_RETRY_TASK", default="nodes.tasks.retry_failed_document_events"
+)
+NODE_CRDT_EVENTS_RETRY_INTERVAL = env.int("NODE_CRDT_EVENTS_RETRY_INTERVAL", default=60)
+NODE_CRDT_EVENTS_RETRY_BACKOFF = env.int("NODE_CRDT_EVENTS_RETRY_BACKOFF", default=60)
+NODE_CRDT_EVENTS_MAX_ATTEMPTS = env.int("NODE_CRDT_EVENTS_MAX_ATTEMPTS", default=10)
+# The document events table is partitioned by day, partitions are created this many days ahead
+# and the empty partitions of past days are dropped.
+NODE_CRDT_EVENTS_PARTITIONS_AHEAD = env.int("NODE_CRDT_EVENTS_PARTITIONS_AHEAD", default=7)
+NODE_CRDT_EVENTS_PARTITION_TASK = env(
+    "NODE_CRDT_EVENTS_PARTITION_TASK", default="nodes.tasks.maintain_document_event_partitions"
+)
+NODE_CRDT_EVENTS_PARTITION_INTERVAL = env.int(
+    "NODE_CRDT_EVENTS_PARTITION_INTERVAL", default=60 * 60
+)
+# Dropping a partition waits at most this many seconds for the lock on the events table, while it
+# waits, every new document event waits as well. Partitions that can't be locked in time are
+# dropped by the next run.
+NODE_CRDT_EVENTS_PARTITION_LOCK_TIMEOUT = env.float(
+    "NODE_CRDT_EVENTS_PARTITION_LOCK_TIMEOUT", default=5
+)
 
 # The interval at which we create document snapshots.
 NODE_VERSIONING_INTERVAL = env.int("NODE_VERSIONING_INTERVAL", default=60 * 5)
 # The interval at which the task is executed.
 NODE_VERSIONING_TASK_INTERVAL = env.int("NODE_VERSIONING_INTERVAL", default=60)
 NODE_VERSIONING_TASK = env("NODE_VERSIONING_TASK", default="nodes.tasks.document_versioning")
+# The number of changed documents that are versioned per transaction.
+NODE_VERSIONING_BATCH_SIZE = env.int("NODE_VERSIONING_BATCH_SIZE", default=100)
+# Versions are stored as deltas to a keyframe, a new keyframe is stored after this many deltas.
+NODE_VERSIONING_KEYFRAME_INTERVAL = env.int("NODE_VERSIONING_KEYFRAME_INTERVAL", default=50)
+# Versions smaller than this many bytes are stored uncompressed.
+NODE_VERSIONING_COMPRESSION_THRESHOLD = env.int(
+    "NODE_VERSIONING_COMPRESSION_THRESHOLD", default=1024
+)
+# Stored version data of at least this many bytes is offloaded from the database to the storage
+# NODE_VERSIONING_BLOB_STORAGE, under NODE_VERSIONING_BLOB_LOCATION. If
+# NODE_VERSIONING_BLOB_REDIRECT is set, uncompressed offloaded versions are downloaded from the
+# storage directly.
+NODE_VERSIONING_INLINE_THRESHOLD = env.int("NODE_VERSIONING_INLINE_THRESHOLD", default=256 * 1024)
+NODE_VERSIONING_BLOB_STORAGE = env("NODE_VERSIONING_BLOB_STORAGE", default="default")
+NODE_VERSIONING_BLOB_LOCATION = env("NODE_VERSIONING_BLOB_LOCATION", default="document-versions/")
+NODE_VERSIONING_BLOB_REDIRECT = env.bool("NODE_VERSIONING_BLOB_REDIRECT", default=False)
+# The retention policy for document versions as [max_age, interval] tiers in seconds, spaces can
+# override it. By default all versions of the last hour are kept, hourly versions for a day, daily
+# versions for a month and weekly versions after that.
+NODE_VERSIONING_RETENTION = env.json(
+    "NODE_VERSIONING_RETENTION",
+    default=[
+        [60 * 60, 0],
+        [60 * 60 * 24, 60 * 60],
+        [60 * 60 * 24 * 30, 60 * 60 * 24],
+        [None, 60 * 60 * 24 * 7],
+    ],
+)
+# The interval at which old document versions are pruned.
+NODE_VERSIONING_RETENTION_INTERVAL = env.int("NODE_VERSIONING_RETENTION_INTERVAL", default=60 * 60)
+NODE_VERSIONING_RETENTION_TASK = env(
+    "NODE_VERSIONING_RETENTION_TASK", default="nodes.tasks.prune_document_versions"
+)
+# The number of documents whose versions are pruned per transaction.
+NODE_VERSIONING_RETENTION_BATCH_SIZE = env.int("NODE_VERSIONING_RETENTION_BATCH_SIZE", default=100)
+
+# Node context
+# ------------------------------------------------------------------------------
+# The rendered context of a node is cached in the cache NODE_CONTEXT_CACHE, under a key that changes
+# with the revisions of the nodes in its subgraph, so entries only expire to free up space.
+NODE_CONTEXT_CACHE = env("NODE_CONTEXT_CACHE", default="default")
+NODE_CONTEXT_CACHE_TIMEOUT = env.int("NODE_CONTEXT_CACHE_TIMEOUT", default=60 * 60 * 24)
+# The maximum depth of the subgraph that is expanded to fill a token budget.
+NODE_CONTEXT_MAX_DEPTH = env.int("NODE_CONTEXT_MAX_DEPTH", default=10)
 
 # LLMs
 # ------------------------------------------------------------------------------
@@ -471,6 +547,13 @@ OPENAI_BASE_URL = env("OPENAI_BASE_URL", default=None)
 AZURE_OPENAI_API_KEY = env("AZURE_OPENAI_API_KEY", default=None)
 AZURE_OPENAI_ENDPOINT = env("AZURE_OPENAI_ENDPOINT", default=None)
 AZURE_OPENAI_API_VERSION = env("AZURE_OPENAI_API_VERSION", default="2024-09-01-preview")
+# Token counts are cached by the hash of the text, in process for the last
+# TOKEN_COUNT_LOCAL_CACHE_SIZE texts and in the cache TOKEN_COUNT_CACHE for texts of at least
+# TOKEN_COUNT_CACHE_MIN_LENGTH characters, shorter ones are faster to tokenize again than to fetch.
+TOKEN_COUNT_LOCAL_CACHE_SIZE = env.int("TOKEN_COUNT_LOCAL_CACHE_SIZE", default=10_000)
+TOKEN_COUNT_CACHE = env("TOKEN_COUNT_CACHE", default="default")
+TOKEN_COUNT_CACHE_MIN_LENGTH = env.int("TOKEN_COUNT_CACHE_MIN_LENGTH", default=256)
+TOKEN_COUNT_CACHE_TIMEOUT = env.int("TOKEN_COUNT_CACHE_TIMEOUT", default=60 * 60 * 24 * 30)
 
 # API settings
 # ------------------------------------------------------------------------------
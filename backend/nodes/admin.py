@@ -17,6 +17,7 @@ class SpaceAdmin(admin.ModelAdmin):
 admin.site.register(models.Document)
 admin.site.register(models.DocumentEvent)
 admin.site.register(models.DocumentVersion)
+admin.site.register(models.FailedDocumentEvent)
 admin.site.register(models.Node)
 admin.site.register(models.MethodNode)
 admin.site.register(models.MethodNodeRun)
@@ -0,0 +1,52 @@
+"""
+Storage of large document version payloads outside of the database.
+
+Payloads are stored in the storage configured with `NODE_VERSIONING_BLOB_STORAGE`, under the
+SHA-256 hash of their content, so identical payloads are only stored once.
+"""
+
+from hashlib import sha256
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage, storages
+
+
+def get_storage() -> Storage:
+    return storages[settings.NODE_VERSIONING_BLOB_STORAGE]
+
+
+def save(payload: bytes) -> str:
+    """Store the payload unless it's already stored, returns its key."""
+    storage = get_storage()
+    key = f"{settings.NODE_VERSIONING_BLOB_LOCATION}{sha256(payload).hexdigest()}"
+    if storage.exists(key):
+        return key
+    # The storage might pick another name if the same payload is stored concurrently.
+    return storage.save(key, ContentFile(payload))
+
+
+def open_blob(key: str) -> File:
+    return get_storage().open(key, "rb")
+
+
+def read(key: str) -> bytes:
+    with open_blob(key) as blob:
+        return blob.read()
+
+
+def url(key: str) -> str:
+    """Return a URL to download the blob from, signed if the storage supports it."""
+    return get_storage().url(key)
+
+
+def delete(keys: set[str]) -> int:
+    """Delete the blobs, returns the number of reclaimed bytes."""
+    storage = get_storage()
+    reclaimed_bytes = 0
+    for key in keys:
+        if storage.exists(key):
+            reclaimed_bytes += storage.size(key)
+            storage.delete(key)
+    return reclaimed_bytes
@@ -0,0 +1,265 @@
+import random
+import statistics
+import threading
+import time
+import typing
+import uuid
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import nodes.models
+import nodes.tasks
+
+DOCUMENT_TYPES = {
+    "editor": nodes.models.DocumentType.EDITOR,
+    "graph": nodes.models.DocumentType.GRAPH,
+    "space": nodes.models.DocumentType.SPACE,
+    "method": nodes.models.DocumentType.METHOD_GRAPH,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the processing of document events with synthetic edits. The edits are written "
+        "to the documents table, like the CRDT server does, while the events are processed."
+    )
+
+    def add_arguments(self, parser: typing.Any) -> None:
+        parser.add_argument("--edits", type=int, default=1000, help="Number of edits to make.")
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=0,
+            help="Edits per second, by default the edits are made as fast as possible.",
+        )
+        parser.add_argument(
+            "--documents", type=int, default=50, help="Number of documents that are edited."
+        )
+        parser.add_argument(
+            "--size",
+            type=int,
+            default=20,
+            help="Number of paragraphs of editor documents and nodes of graphs and spaces.",
+        )
+        parser.add_argument(
+            "--mix",
+            default="editor=60,graph=20,space=15,method=5",
+            help="Relative frequency of edits per document type.",
+        )
+        parser.add_argument("--batch-size", type=int, default=None)
+        parser.add_argument("--seed", type=int, default=None)
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Run even if DEBUG is disabled. The benchmark writes to the database.",
+        )
+
+    def handle(self, *args: typing.Any, **options: typing.Any) -> None:
+        if not settings.DEBUG and not options["force"]:
+            raise CommandError("The benchmark writes to the database, use --force to run it.")
+        try:
+            from faker import Faker
+
+            from nodes.tests import factories
+        except ImportError as exc:
+            raise CommandError("The benchmark needs the local requirements installed.") from exc
+
+        self.factories = factories
+        self.random = random.Random(options["seed"])
+        self.faker = Faker()
+        self.faker.seed_instance(options["seed"])
+        self.size = options["size"]
+        # All public IDs of documents, spaces and nodes that are created, for cleaning up.
+        self.public_ids: set[str] = set()
+        mix = self._parse_mix(options["mix"])
+
+        try:
+            documents = self._create_documents(options["documents"], mix)
+            self._run(documents, mix, options)
+        finally:
+            self._cleanup()
+
+    def _parse_mix(self, mix: str) -> dict[str, float]:
+        try:
+            weights = {
+                DOCUMENT_TYPES[name.strip()]: float(weight)
+                for name, weight in (part.split("=") for part in mix.split(","))
+            }
+        except (KeyError, ValueError) as exc:
+            raise CommandError(
+                f"Invalid mix {mix!r}, expected e.g. 'editor=60,graph=20,space=15,method=5'."
+            ) from exc
+        return {document_type: weight for document_type, weight in weights.items() if weight > 0}
+
+    def _create_documents(self, count: int, mix: dict[str, float]) -> list[nodes.models.Document]:
+        """Create the documents that are edited, at least one per document type of the mix."""
+        document_types = list(mix)
+        document_types += self.random.choices(
+            list(mix), weights=list(mix.values()), k=max(count - len(mix), 0)
+        )
+        documents = []
+        for document_type in document_types:
+            if document_type == nodes.models.DocumentType.SPACE:
+                # Space documents belong to an existing space.
+                public_id = str(self.factories.SpaceFactory.create().public_id)
+            else:
+                public_id = self._new_id()
+            self.public_ids.add(public_id)
+            documents.append(
+                nodes.models.Document.objects.create(
+                    public_id=public_id,
+                    document_type=document_type,
+                    data=b"",
+                    json=self._initial_json(document_type),
+                )
+            )
+        return documents
+
+    def _new_id(self) -> str:
+        public_id = str(uuid.uuid4())
+        self.public_ids.add(public_id)
+        return public_id
+
+    def _initial_json(self, document_type: str) -> dict[str, typing.Any]:
+        if document_type == nodes.models.DocumentType.EDITOR:
+            return {
+                "default": {
+                    "type": "doc",
+                    "content": [self._paragraph() for _ in range(self.size)],
+                }
+            }
+        if document_type == nodes.models.DocumentType.SPACE:
+            return {"nodes": {self._new_id(): self._space_node() for _ in range(self.size)}}
+        return {
+            "nodes": {self._new_id(): {} for _ in range(self.size)},
+            "edges": {},
+        }
+
+    def _paragraph(self) -> dict[str, typing.Any]:
+        return {"type": "paragraph", "content": [{"type": "text", "text": self.faker.paragraph()}]}
+
+    def _space_node(self) -> dict[str, typing.Any]:
+        return {"title": self.faker.sentence(nb_words=4)}
+
+    def _edit(self, document: nodes.models.Document) -> None:
+        """Make a small change to the document, similar to a single edit in the frontend."""
+        if document.document_type == nodes.models.DocumentType.EDITOR:
+            paragraphs = document.json["default"]["content"]
+            paragraphs[self.random.randrange(len(paragraphs))] = self._paragraph()
+        elif document.document_type == nodes.models.DocumentType.SPACE:
+            node_id = self.random.choice(list(document.json["nodes"]))
+            document.json["nodes"][node_id] = self._space_node()
+        else:
+            graph_nodes = document.json["nodes"]
+            if graph_nodes and self.random.random() < 0.5:
+                del graph_nodes[self.random.choice(list(graph_nodes))]
+            else:
+                graph_nodes[self._new_id()] = {}
+        nodes.models.Document.objects.filter(pk=document.pk).update(
+            json=document.json, updated_at=timezone.now()
+        )
+
+    def _run(
+        self,
+        documents: list[nodes.models.Document],
+        mix: dict[str, float],
+        options: dict[str, typing.Any],
+    ) -> None:
+        documents_by_type = {
+            document_type: [
+                document for document in documents if document.document_type == document_type
+            ]
+            for document_type in mix
+        }
+        # Process the events of the initial documents, so that they don't count as edits.
+        self._process(options["batch_size"])
+        failed_events = nodes.models.FailedDocumentEvent.objects.count()
+
+        edit_times: list[float] = []
+        done = threading.Event()
+        stop = threading.Event()
+
+        def make_edits() -> None:
+            try:
+                interval = 1 / options["rate"] if options["rate"] else 0
+                start = time.monotonic()
+                for index in range(options["edits"]):
+                    if stop.is_set():
+                        break
+                    if interval:
+                        time.sleep(max(start + index * interval - time.monotonic(), 0))
+                    document_type = self.random.choices(list(mix), weights=list(mix.values()))[0]
+                    self._edit(self.random.choice(documents_by_type[document_type]))
+                    edit_times.append(time.monotonic())
+            finally:
+                connection.close()
+                done.set()
+
+        lags: list[float] = []
+        query_counts: list[int] = []
+        producer = threading.Thread(target=make_edits)
+        start = time.monotonic()
+        producer.start()
+        try:
+            while not done.is_set() or len(lags) < len(edit_times):
+                pending = len(edit_times)
+                if pending == len(lags):
+                    time.sleep(0.01)
+                    continue
+                with CaptureQueriesContext(connection) as queries:
+                    self._process(options["batch_size"])
+                run_end = time.monotonic()
+                query_counts.append(len(queries))
+                # Every edit that was committed before the run started is synced now.
+                lags += [run_end - edit_time for edit_time in edit_times[len(lags) : pending]]
+        finally:
+            # Stop making edits if processing fails, so that they don't outlive the cleanup.
+            stop.set()
+            producer.join()
+        duration = time.monotonic() - start
+
+        failed_events = nodes.models.FailedDocumentEvent.objects.count() - failed_events
+        self._report(len(edit_times), duration, lags, query_counts, failed_events)
+
+    def _process(self, batch_size: int | None) -> None:
+        shards = settings.NODE_CRDT_EVENTS_SHARDS
+        for shard in range(shards) if shards > 1 else [None]:
+            nodes.tasks.process_document_events(batch_size=batch_size, shard=shard)
+
+    def _report(
+        self,
+        edits: int,
+        duration: float,
+        lags: list[float],
+        query_counts: list[int],
+        failed_events: int,
+    ) -> None:
+        quantiles = statistics.quantiles(lags, n=100) if len(lags) > 1 else lags * 99
+        self.stdout.write(f"Edits:              {edits}")
+        self.stdout.write(f"Duration:           {duration:.2f}s")
+        self.stdout.write(f"Throughput:         {edits / duration:.1f} edits/s")
+        self.stdout.write(f"Lag p50:            {quantiles[49] * 1000:.1f}ms")
+        self.stdout.write(f"Lag p99:            {quantiles[98] * 1000:.1f}ms")
+        self.stdout.write(f"Processing runs:    {len(query_counts)}")
+        self.stdout.write(
+            f"Queries per run:    {statistics.mean(query_counts) if query_counts else 0:.1f}"
+        )
+        self.stdout.write(f"Queries per edit:   {sum(query_counts) / max(edits, 1):.2f}")
+        self.stdout.write(f"Failed events:      {failed_events}")
+
+    def _cleanup(self) -> None:
+        """
+        Delete everything the benchmark created. The documents are deleted first, because their
+        deletion creates events, and the nodes and spaces last, after the events that could
+        recreate them are gone.
+        """
+        with transaction.atomic():
+            nodes.models.Document.objects.filter(public_id__in=self.public_ids).delete()
+            nodes.models.DocumentEvent.objects.filter(public_id__in=self.public_ids).delete()
+            nodes.models.FailedDocumentEvent.objects.filter(public_id__in=self.public_ids).delete()
+            nodes.models.Node.all_objects.filter(public_id__in=self.public_ids).delete()
+            nodes.models.Space.all_objects.filter(public_id__in=self.public_ids).delete()
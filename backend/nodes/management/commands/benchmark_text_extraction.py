@@ -0,0 +1,152 @@
+import json
+import time
+import typing
+
+from django.core.management import BaseCommand, CommandError
+from django.db.models.functions import Length
+
+import nodes.models
+import nodes.utils
+
+
+def extract_text_recursively(node: dict[str, typing.Any] | list | None) -> list[str]:
+    """The previous, recursive text extraction, as the baseline of the benchmark."""
+    texts: list[str] = []
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == "type" and value == "text":
+                texts.append(node["text"])
+            elif isinstance(value, (dict, list)):
+                texts.extend(extract_text_recursively(value))
+    elif isinstance(node, list):
+        for item in node:
+            texts.extend(extract_text_recursively(item))
+    return texts
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the text extraction of node content. By default synthetic editor content is "
+        "used, --file and --documents benchmark exported or stored editor documents instead."
+    )
+
+    def add_arguments(self, parser: typing.Any) -> None:
+        parser.add_argument(
+            "--file",
+            action="append",
+            default=[],
+            help="JSON file with the content of an editor document, can be given multiple times.",
+        )
+        parser.add_argument(
+            "--documents",
+            type=int,
+            default=0,
+            help="Benchmark this many of the largest editor documents in the database.",
+        )
+        parser.add_argument(
+            "--paragraphs", type=int, default=2000, help="Paragraphs of the synthetic content."
+        )
+        parser.add_argument(
+            "--depth", type=int, default=50, help="Nesting depth of the synthetic bullet list."
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=10, help="Runs per document, the fastest one counts."
+        )
+        parser.add_argument(
+            "--max-tokens",
+            type=int,
+            default=1000,
+            help="Token budget for benchmarking the truncated extraction.",
+        )
+
+    def handle(self, *args: typing.Any, **options: typing.Any) -> None:
+        contents = self._load_contents(options)
+        if not contents:
+            raise CommandError("No content to benchmark.")
+
+        implementations: dict[str, typing.Callable[[typing.Any], typing.Any]] = {
+            "recursive": extract_text_recursively,
+            "iterative": nodes.utils.extract_text_from_node,
+            "first fragment": lambda content: next(nodes.utils.iter_text(content), None),
+            "token budget": lambda content: nodes.utils.truncate_text(
+                content, max_tokens=options["max_tokens"]
+            ),
+        }
+        for name, content in contents:
+            self.stdout.write(name)
+            expected = nodes.utils.extract_text_from_node(content)
+            for implementation, function in implementations.items():
+                try:
+                    duration = self._measure(function, content, options["repeat"])
+                except RecursionError:
+                    self.stdout.write(f"  {implementation:<16} RecursionError")
+                    continue
+                self.stdout.write(f"  {implementation:<16} {duration * 1000:8.2f}ms")
+            self.stdout.write(f"  {'fragments':<16} {len(expected):8}")
+
+    def _load_contents(self, options: dict[str, typing.Any]) -> list[tuple[str, typing.Any]]:
+        contents: list[tuple[str, typing.Any]] = []
+        for path in options["file"]:
+            try:
+                with open(path) as file:
+                    contents.append((path, json.load(file)))
+            except (OSError, ValueError) as exc:
+                raise CommandError(f"Could not read {path}: {exc}") from exc
+        if options["documents"]:
+            documents = (
+                nodes.models.Document.objects.filter(document_type=nodes.models.DocumentType.EDITOR)
+                .order_by(Length("data").desc())
+                .values_list("public_id", "json")[: options["documents"]]
+            )
+            contents += [(f"document {public_id}", content) for public_id, content in documents]
+        if not contents:
+            contents.append(
+                (
+                    f"synthetic ({options['paragraphs']} paragraphs, depth {options['depth']})",
+                    self._synthetic_content(options["paragraphs"], options["depth"]),
+                )
+            )
+        return contents
+
+    def _synthetic_content(self, paragraphs: int, depth: int) -> dict[str, typing.Any]:
+        """Editor content with marked up paragraphs and a deeply nested bullet list."""
+        content: list[dict[str, typing.Any]] = [
+            {
+                "type": "paragraph",
+                "content": [
+                    {"type": "text", "text": f"Paragraph {index} with "},
+                    {"type": "text", "marks": [{"type": "bold"}], "text": "bold"},
+                    {"type": "text", "text": " and plain text."},
+                ],
+            }
+            for index in range(paragraphs)
+        ]
+        nested: dict[str, typing.Any] = {"type": "text", "text": "Innermost item"}
+        for level in range(depth):
+            nested = {
+                "type": "bulletList",
+                "content": [
+                    {
+                        "type": "listItem",
+                        "content": [
+                            {
+                                "type": "paragraph",
+                                "content": [{"type": "text", "text": f"Item {level}"}],
+                            },
+                            nested,
+                        ],
+                    }
+                ],
+            }
+        content.append(nested)
+        return {"default": {"type": "doc", "content": content}}
+
+    def _measure(
+        self, function: typing.Callable[[typing.Any], typing.Any], content: typing.Any, repeat: int
+    ) -> float:
+        durations = []
+        for _ in range(max(repeat, 1)):
+            start = time.perf_counter()
+            function(content)
+            durations.append(time.perf_counter() - start)
+        return min(durations)
@@ -1,8 +1,7 @@
+import asyncio
+import dataclasses
 import logging
-import selectors
 import signal
-import sys
-import types
 import typing
 
 import psycopg
@@ -15,19 +14,136 @@ import nodes.tasks
 logger = logging.getLogger(__name__)
 
 
-def signal_handler(sig: int, frame: types.FrameType | None) -> None:
-    logger.info("Shutting down...")
-    sys.exit(0)
+@dataclasses.dataclass
+class ListenerStats:
+    """Counters of the listener, logged periodically and on shutdown."""
 
+    notifications_received: int = 0
+    tasks_dispatched: int = 0
+    reconnects: int = 0
 
-# Register signal handlers
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
+    def __str__(self) -> str:
+        return (
+            f"{self.notifications_received} notifications received, "
+            f"{self.tasks_dispatched} tasks dispatched, {self.reconnects} reconnects"
+        )
+
+
+class DocumentListener:
+    """
+    Listen for document changes and enqueue the processing of the document events.
+
+    A single task processes all pending events, so notifications are debounced: the first
+    notification dispatches a task right away and all notifications received in the following
+    `debounce` seconds are folded into a single task that is dispatched at the end of the window.
+    If the connection is lost, the listener reconnects with an exponential backoff.
+    """
+
+    def __init__(
+        self,
+        conninfo: dict[str, typing.Any],
+        debounce: float = 1.0,
+        max_backoff: float = 60.0,
+        health_check_interval: float = 60.0,
+        stats_interval: float = 300.0,
+    ):
+        self.conninfo = conninfo
+        self.debounce = debounce
+        self.max_backoff = max_backoff
+        self.health_check_interval = health_check_interval
+        self.stats_interval = stats_interval
+        self.stats = ListenerStats()
+        self._pending = asyncio.Event()
+
+    async def run(self) -> None:
+        """Run the listener until it is cancelled."""
+        try:
+            async with asyncio.TaskGroup() as task_group:
+                task_group.create_task(self.listen())
+                task_group.create_task(self.dispatch())
+                task_group.create_task(self.log_stats())
+        finally:
+            logger.info(f"Listener stopped: {self.stats}")
+
+    def notify(self) -> None:
+        """Record a notification, the events are processed by the next dispatched task."""
+        self.stats.notifications_received += 1
+        self._pending.set()
+
+    async def dispatch(self) -> None:
+        """Dispatch at most one task per debounce window while notifications are pending."""
+        while True:
+            await self._pending.wait()
+            self._pending.clear()
+            try:
+                await asyncio.to_thread(nodes.tasks.process_document_events.delay)
+            except Exception:
+                logger.exception("Could not dispatch the document events task, retrying...")
+                self._pending.set()
+            else:
+                self.stats.tasks_dispatched += 1
+            await asyncio.sleep(self.debounce)
+
+    async def listen(self) -> None:
+        """Listen for notifications, reconnecting with an exponential backoff."""
+        backoff = 1.0
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(
+                    **self.conninfo, autocommit=True
+                ) as connection:
+                    await connection.execute(f"LISTEN {nodes.models.PG_NOTIFY_CHANNEL};")
+                    logger.info("Listening for notifications...")
+                    backoff = 1.0
+                    # Changes might have happened while we weren't listening.
+                    self._pending.set()
+                    await self._receive(connection)
+            except (psycopg.OperationalError, psycopg.InterfaceError, TimeoutError) as exc:
+                self.stats.reconnects += 1
+                logger.warning(f"Lost the database connection ({exc}), reconnecting in {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+
+    async def _receive(self, connection: psycopg.AsyncConnection) -> None:
+        while True:
+            received = False
+            async for notify in connection.notifies(timeout=self.health_check_interval):
+                logger.debug(f"NOTIFY received: {notify.pid}, {notify.channel}, {notify.payload}")
+                received = True
+                self.notify()
+            if not received:
+                # No notifications for a while, make sure the connection is still alive.
+                await asyncio.wait_for(connection.execute("SELECT 1"), timeout=10)
+
+    async def log_stats(self) -> None:
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            logger.info(f"Listener stats: {self.stats}")
 
 
 class Command(BaseCommand):
     help = "Listen for changes in the document table"
 
+    def add_arguments(self, parser: typing.Any) -> None:
+        parser.add_argument(
+            "--debounce",
+            type=float,
+            default=1.0,
+            help="Dispatch at most one task per this many seconds.",
+        )
+        parser.add_argument(
+            "--max-backoff",
+            type=float,
+            default=60.0,
+            help="Maximum number of seconds to wait between reconnection attempts.",
+        )
+        parser.add_argument(
+            "--stats-interval",
+            type=float,
+            default=300.0,
+            help="Log the notification and dispatch counters every this many seconds.",
+        )
+
     def handle(self, *args: typing.Any, **options: typing.Any) -> None:
         if "direct" in connections:
             connection = connections["direct"]
@@ -35,31 +151,28 @@ class Command(BaseCommand):
         else:
             connection = connections["default"]
             logger.error("Using default connection instead of direct connection")
-        with connection.cursor() as curs:
-            conn = curs.connection
-            curs.execute(f"LISTEN {nodes.models.PG_NOTIFY_CHANNEL};")
-            self.stdout.write(self.style.SUCCESS("Listening for notifications..."))
-
-            sel = selectors.DefaultSelector()
-            sel.register(conn, selectors.EVENT_READ)
-            while True:
-                if not sel.select(timeout=60.0):
-                    continue  # No FD activity detected in one minute
-
-                # Activity detected. Is the connection still ok?
-                try:
-                    conn.execute("SELECT 1")
-                except psycopg.OperationalError:
-                    # You were disconnected: do something useful such as panicking
-                    self.stdout.write(
-                        self.style.WARNING("We lost our database connection! Shutting down...")
-                    )
-                    sys.exit(1)
-
-                for notify in conn.notifies():
-                    self.stdout.write(
-                        self.style.SUCCESS(
-                            f"NOTIFY received: {notify.pid}, {notify.channel}, {notify.payload}"
-                        )
-                    )
-                    nodes.tasks.process_document_events.delay()
+
+        conninfo = connection.get_connection_params()
+        # These are specific to Django's synchronous connections.
+        conninfo.pop("cursor_factory", None)
+        conninfo.pop("context", None)
+
+        listener = DocumentListener(
+            conninfo,
+            debounce=options["debounce"],
+            max_backoff=options["max_backoff"],
+            stats_interval=options["stats_interval"],
+        )
+        self.stdout.write(self.style.SUCCESS("Listening for notifications..."))
+        asyncio.run(self._run(listener))
+
+    @staticmethod
+    async def _run(listener: DocumentListener) -> None:
+        task = asyncio.create_task(listener.run())
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, task.cancel)
+        try:
+            await task
+        except asyncio.CancelledError:
+            logger.info("Shutting down...")
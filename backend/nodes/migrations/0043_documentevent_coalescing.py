@@ -0,0 +1,38 @@
+# Generated by Django 5.1.8 on 2026-10-18 18:22
+
+import pgtrigger.compiler
+import pgtrigger.migrations
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("nodes", "0042_alter_methodnode_managers_methodnode_buddy_and_more"),
+    ]
+
+    operations = [
+        pgtrigger.migrations.RemoveTrigger(
+            model_name="document",
+            name="document_change",
+        ),
+        migrations.AddIndex(
+            model_name="documentevent",
+            index=models.Index(
+                fields=["public_id", "document_type"], name="documentevent_document_idx"
+            ),
+        ),
+        pgtrigger.migrations.AddTrigger(
+            model_name="document",
+            trigger=pgtrigger.compiler.Trigger(
+                name="document_change",
+                sql=pgtrigger.compiler.UpsertTriggerSql(
+                    func="\n                    IF (TG_OP = 'INSERT') THEN\n                        INSERT INTO nodes_documentevent (public_id, document_type, action, created_at, new_data) VALUES (NEW.public_id, NEW.document_type, 'INSERT', NOW(), NEW.json);\n                    ELSIF (TG_OP = 'UPDATE') THEN\n                        -- Coalesce the change into the latest pending event of the document, unless that event is being processed right now.\n                        UPDATE nodes_documentevent SET new_data = NEW.json WHERE id = (\n                            SELECT id FROM nodes_documentevent WHERE id = (\n                                SELECT max(id) FROM nodes_documentevent WHERE public_id = NEW.public_id AND document_type = NEW.document_type\n                            ) AND action IN ('INSERT', 'UPDATE') FOR UPDATE SKIP LOCKED\n                        );\n                        IF NOT FOUND THEN\n                            INSERT INTO nodes_documentevent (public_id, document_type, action, created_at, old_data, new_data) VALUES (NEW.public_id, NEW.document_type, 'UPDATE', NOW(), OLD.json, NEW.json);\n                        END IF;\n                    ELSIF (TG_OP = 'DELETE') THEN\n                        INSERT INTO nodes_documentevent (public_id, document_type, action, created_at, old_data) VALUES (OLD.public_id, OLD.document_type, 'DELETE', NOW(), OLD.json);\n                    END IF;\n                    NOTIFY nodes_document_change;\n                    RETURN NEW;\n                    ",
+                    hash="d85140e04e4556ce33f96b01e7f36b2933ee2033",
+                    operation="INSERT OR UPDATE OR DELETE",
+                    pgid="pgtrigger_document_change_b3491",
+                    table="nodes_document",
+                    when="AFTER",
+                ),
+            ),
+        ),
+    ]
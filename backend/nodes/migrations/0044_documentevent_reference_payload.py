@@ -0,0 +1,50 @@
+# Generated by Django 5.1.8 on 2026-10-18 18:27
+
+import django.db.models.deletion
+import pgtrigger.compiler
+import pgtrigger.migrations
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("nodes", "0043_documentevent_coalescing"),
+    ]
+
+    operations = [
+        pgtrigger.migrations.RemoveTrigger(
+            model_name="document",
+            name="document_change",
+        ),
+        migrations.RemoveField(
+            model_name="documentevent",
+            name="old_data",
+        ),
+        migrations.AddField(
+            model_name="documentevent",
+            name="document",
+            field=models.ForeignKey(
+                blank=True,
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.DO_NOTHING,
+                related_name="+",
+                to="nodes.document",
+            ),
+        ),
+        pgtrigger.migrations.AddTrigger(
+            model_name="document",
+            trigger=pgtrigger.compiler.Trigger(
+                name="document_change",
+                sql=pgtrigger.compiler.UpsertTriggerSql(
+                    declare="DECLARE payload jsonb;",
+                    func="\n                    -- In the reference format, events only point to the document and the processor loads its current JSON.\n                    IF (TG_OP <> 'DELETE' AND coalesce(current_setting('nodes.document_event_payload', true), '') <> 'reference') THEN\n                        payload := NEW.json;\n                    END IF;\n                    IF (TG_OP = 'INSERT') THEN\n                        INSERT INTO nodes_documentevent (public_id, document_type, action, created_at, document_id, new_data) VALUES (NEW.public_id, NEW.document_type, 'INSERT', NOW(), NEW.id, payload);\n                    ELSIF (TG_OP = 'UPDATE') THEN\n                        -- Coalesce the change into the latest pending event of the document, unless that event is being processed right now.\n                        UPDATE nodes_documentevent SET new_data = payload WHERE id = (\n                            SELECT id FROM nodes_documentevent WHERE id = (\n                                SELECT max(id) FROM nodes_documentevent WHERE public_id = NEW.public_id AND document_type = NEW.document_type\n                            ) AND action IN ('INSERT', 'UPDATE') FOR UPDATE SKIP LOCKED\n                        );\n                        IF NOT FOUND THEN\n                            INSERT INTO nodes_documentevent (public_id, document_type, action, created_at, document_id, new_data) VALUES (NEW.public_id, NEW.document_type, 'UPDATE', NOW(), NEW.id, payload);\n                        END IF;\n                    ELSIF (TG_OP = 'DELETE') THEN\n                        INSERT INTO nodes_documentevent (public_id, document_type, action, created_at, document_id) VALUES (OLD.public_id, OLD.document_type, 'DELETE', NOW(), OLD.id);\n                    END IF;\n                    NOTIFY nodes_document_change;\n                    RETURN NEW;\n                    ",
+                    hash="e32127a62d650b994ef0366c634a3aab2458f4fd",
+                    operation="INSERT OR UPDATE OR DELETE",
+                    pgid="pgtrigger_document_change_b3491",
+                    table="nodes_document",
+                    when="AFTER",
+                ),
+            ),
+        ),
+    ]
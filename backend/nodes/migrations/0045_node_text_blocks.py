@@ -0,0 +1,17 @@
+# Generated by Django 5.1.8 on 2026-10-18 18:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("nodes", "0044_documentevent_reference_payload"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="node",
+            name="text_blocks",
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
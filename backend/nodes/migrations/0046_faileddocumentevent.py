@@ -0,0 +1,68 @@
+# Generated by Django 5.1.8 on 2026-10-18 18:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("nodes", "0045_node_text_blocks"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="FailedDocumentEvent",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("event_id", models.BigIntegerField()),
+                ("public_id", models.UUIDField(editable=False)),
+                (
+                    "document_type",
+                    models.CharField(
+                        choices=[
+                            ("EDITOR", "Editor"),
+                            ("SPACE", "Space"),
+                            ("GRAPH", "Graph"),
+                            ("METHOD", "Method Graph"),
+                        ],
+                        max_length=255,
+                    ),
+                ),
+                (
+                    "action",
+                    models.CharField(
+                        choices=[("INSERT", "Insert"), ("UPDATE", "Update"), ("DELETE", "Delete")],
+                        max_length=255,
+                    ),
+                ),
+                ("new_data", models.JSONField(blank=True, null=True)),
+                ("event_created_at", models.DateTimeField()),
+                ("error", models.TextField()),
+                ("attempts", models.PositiveIntegerField(default=1)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("last_failed_at", models.DateTimeField(auto_now=True)),
+                ("next_retry_at", models.DateTimeField(blank=True, null=True)),
+                (
+                    "document",
+                    models.ForeignKey(
+                        blank=True,
+                        db_constraint=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        related_name="+",
+                        to="nodes.document",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(fields=["next_retry_at"], name="failedevent_next_retry_idx")
+                ],
+            },
+        ),
+    ]
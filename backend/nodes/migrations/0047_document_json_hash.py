@@ -0,0 +1,87 @@
+# Generated by Django 5.1.8 on 2026-10-18 18:48
+
+from hashlib import sha256
+
+import pgtrigger
+import pgtrigger.compiler
+import pgtrigger.migrations
+from django.db import migrations, models
+
+
+def backfill_json_hashes(apps, schema_editor):
+    """
+    Hash the JSON of existing documents and carry the hashes of their latest versions over to the
+    new hash format, so that unchanged documents don't get a new version.
+    """
+    Document = apps.get_model("nodes", "Document")
+    DocumentVersion = apps.get_model("nodes", "DocumentVersion")
+
+    # Updating the hash doesn't change the document, so it must not create document events.
+    with pgtrigger.ignore("nodes.Document:document_change"):
+        schema_editor.execute(
+            "UPDATE nodes_document "
+            "SET json_hash = encode(sha256(convert_to(json::text, 'UTF8')), 'hex')"
+        )
+
+    latest_versions = {
+        version.document_id: version
+        for version in DocumentVersion.objects.filter(is_removed=False)
+        .order_by("document_id", "-created_at")
+        .distinct("document_id")
+        .only("document_id", "json_hash")
+    }
+    changed_versions = []
+    for document in (
+        Document.objects.filter(pk__in=latest_versions.keys())
+        .only("json", "json_hash")
+        .iterator(chunk_size=500)
+    ):
+        version = latest_versions[document.pk]
+        if version.json_hash == sha256(str(document.json).encode()).hexdigest():
+            version.json_hash = document.json_hash
+            changed_versions.append(version)
+    DocumentVersion.objects.bulk_update(changed_versions, ["json_hash"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("nodes", "0046_faileddocumentevent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="json_hash",
+            field=models.CharField(blank=True, default="", editable=False, max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name="document",
+            index=models.Index(
+                fields=["updated_at"], include=("json_hash",), name="document_updated_at_hash_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="documentversion",
+            index=models.Index(
+                models.F("document"),
+                models.OrderBy(models.F("created_at"), descending=True),
+                include=("json_hash",),
+                name="documentversion_latest_idx",
+            ),
+        ),
+        pgtrigger.migrations.AddTrigger(
+            model_name="document",
+            trigger=pgtrigger.compiler.Trigger(
+                name="document_json_hash",
+                sql=pgtrigger.compiler.UpsertTriggerSql(
+                    func="NEW.json_hash := encode(sha256(convert_to(NEW.json::text, 'UTF8')), 'hex');RETURN NEW;",
+                    hash="e484441b0ba7c5e6d8abcda13abc1d9e195999dc",
+                    operation='INSERT OR UPDATE OF "json"',
+                    pgid="pgtrigger_document_json_hash_9e820",
+                    table="nodes_document",
+                    when="BEFORE",
+                ),
+            ),
+        ),
+        migrations.RunPython(backfill_json_hashes, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 5.1.8 on 2026-10-18 18:57
+
+import django.db.models.deletion
+import pgtrigger.compiler
+import pgtrigger.migrations
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("nodes", "0047_document_json_hash"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PendingDocumentVersion",
+            fields=[
+                (
+                    "document",
+                    models.OneToOneField(
+                        db_constraint=False,
+                        on_delete=django.db.models.deletion.DO_NOTHING,
+                        primary_key=True,
+                        related_name="+",
+                        serialize=False,
+                        to="nodes.document",
+                    ),
+                ),
+                ("queued_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name="document",
+            name="document_updated_at_hash_idx",
+        ),
+        pgtrigger.migrations.AddTrigger(
+            model_name="document",
+            trigger=pgtrigger.compiler.Trigger(
+                name="document_pending_version",
+                sql=pgtrigger.compiler.UpsertTriggerSql(
+                    func="\n                    IF (TG_OP = 'DELETE') THEN\n                        DELETE FROM nodes_pendingdocumentversion WHERE document_id = OLD.id;\n                    ELSIF (TG_OP = 'INSERT' OR NEW.json_hash IS DISTINCT FROM OLD.json_hash) THEN\n                        INSERT INTO nodes_pendingdocumentversion (document_id, queued_at)\n                        VALUES (NEW.id, NOW()) ON CONFLICT (document_id) DO NOTHING;\n                    END IF;\n                    RETURN NULL;\n                    ",
+                    hash="4cc4c69102dc1b467306f1eeed23139685ae6e60",
+                    operation='INSERT OR UPDATE OF "json" OR DELETE',
+                    pgid="pgtrigger_document_pending_version_6f847",
+                    table="nodes_document",
+                    when="AFTER",
+                ),
+            ),
+        ),
+        # Queue the documents that changed since their last version, so that no change is skipped
+        # when switching from scanning recently updated documents.
+        migrations.RunSQL(
+            """
+            INSERT INTO nodes_pendingdocumentversion (document_id, queued_at)
+            SELECT document.id, NOW() FROM nodes_document document
+            WHERE document.json_hash IS DISTINCT FROM (
+                SELECT version.json_hash FROM nodes_documentversion version
+                WHERE version.document_id = document.id AND NOT version.is_removed
+                ORDER BY version.created_at DESC LIMIT 1
+            )
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.1.8 on 2026-10-18 19:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("nodes", "0048_document_pending_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="documentversion",
+            name="encoding",
+            field=models.CharField(
+                choices=[("raw", "Raw"), ("zlib", "zlib"), ("delta", "Delta")],
+                default="raw",
+                max_length=16,
+            ),
+        ),
+        migrations.AddField(
+            model_name="documentversion",
+            name="keyframe",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.RESTRICT,
+                related_name="deltas",
+                to="nodes.documentversion",
+            ),
+        ),
+        migrations.AddField(
+            model_name="documentversion",
+            name="size",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
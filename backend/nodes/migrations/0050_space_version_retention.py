@@ -0,0 +1,23 @@
+# Generated by Django 5.1.8 on 2026-10-18 19:05
+
+import nodes.versioning
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("nodes", "0049_document_version_encoding"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="space",
+            name="version_retention",
+            field=models.JSONField(
+                blank=True,
+                help_text="Overrides the retention policy for the document versions of the space and its nodes, as a list of [max_age, interval] tiers in seconds.",
+                null=True,
+                validators=[nodes.versioning.validate_retention_policy],
+            ),
+        ),
+    ]
@@ -0,0 +1,90 @@
+import datetime
+
+from django.db import migrations
+from django.utils import timezone
+
+TABLE = "nodes_documentevent"
+# The `maintain_document_event_partitions` task creates the partitions of the following days.
+PARTITIONS_AHEAD = 7
+
+
+def _index_definitions(schema_editor, table):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT indexdef FROM pg_indexes WHERE tablename = %s AND indexname <> %s",
+            [table, f"{table}_pkey"],
+        )
+        return [definition for (definition,) in cursor.fetchall()]
+
+
+def _replace_table(schema_editor, partitioned):
+    """
+    Copy the events into a new (partitioned or plain) table with the same columns and indexes,
+    which then replaces the old table.
+    """
+    execute = schema_editor.execute
+    indexes = _index_definitions(schema_editor, TABLE)
+    execute(f"LOCK TABLE {TABLE} IN ACCESS EXCLUSIVE MODE")
+    execute(
+        f"CREATE TABLE {TABLE}_new (LIKE {TABLE})"
+        + (" PARTITION BY RANGE (created_at)" if partitioned else "")
+    )
+    if partitioned:
+        execute(f"CREATE TABLE {TABLE}_default PARTITION OF {TABLE}_new DEFAULT")
+        today = timezone.now().date()
+        for offset in range(PARTITIONS_AHEAD):
+            day = today + datetime.timedelta(days=offset)
+            execute(
+                f"CREATE TABLE {TABLE}_p{day:%Y%m%d} PARTITION OF {TABLE}_new "
+                "FOR VALUES FROM (%s) TO (%s)",
+                [
+                    datetime.datetime.combine(day, datetime.time(), datetime.UTC),
+                    datetime.datetime.combine(
+                        day + datetime.timedelta(days=1), datetime.time(), datetime.UTC
+                    ),
+                ],
+            )
+    execute(f"INSERT INTO {TABLE}_new SELECT * FROM {TABLE}")
+    # Continue the IDs after the ones of existing and failed events.
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT greatest(
+                (SELECT max(id) FROM {TABLE}),
+                (SELECT max(event_id) FROM nodes_faileddocumentevent)
+            )
+            """
+        )
+        (last_id,) = cursor.fetchone()
+    execute(f"DROP TABLE {TABLE}")
+    execute(f"ALTER TABLE {TABLE}_new RENAME TO {TABLE}")
+    if partitioned:
+        # Partitioned tables can't have identity columns before Postgres 17.
+        execute(f"CREATE SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id")
+        execute(f"ALTER TABLE {TABLE} ALTER COLUMN id SET DEFAULT nextval('{TABLE}_id_seq')")
+        execute(f"ALTER TABLE {TABLE} ADD PRIMARY KEY (id, created_at)")
+    else:
+        execute(f"ALTER TABLE {TABLE} ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY")
+        execute(f"ALTER TABLE {TABLE} ADD PRIMARY KEY (id)")
+    if last_id is not None:
+        execute(f"SELECT setval(pg_get_serial_sequence('{TABLE}', 'id'), %s)", [last_id])
+    for definition in indexes:
+        execute(definition)
+
+
+def partition_document_events(apps, schema_editor):
+    _replace_table(schema_editor, partitioned=True)
+
+
+def unpartition_document_events(apps, schema_editor):
+    _replace_table(schema_editor, partitioned=False)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("nodes", "0050_space_version_retention"),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_document_events, unpartition_document_events),
+    ]
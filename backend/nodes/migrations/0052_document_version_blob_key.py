@@ -0,0 +1,25 @@
+# Generated by Django 5.1.8 on 2026-10-18 19:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("nodes", "0051_partition_document_events"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="documentversion",
+            name="blob_key",
+            field=models.CharField(blank=True, default="", max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name="documentversion",
+            index=models.Index(
+                condition=models.Q(("blob_key", ""), _negated=True),
+                fields=["blob_key"],
+                name="documentversion_blob_key_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.8 on 2026-10-18 19:54
+
+import pgtrigger.compiler
+import pgtrigger.migrations
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("nodes", "0052_document_version_blob_key"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="node",
+            name="revision",
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        pgtrigger.migrations.AddTrigger(
+            model_name="node",
+            trigger=pgtrigger.compiler.Trigger(
+                name="node_revision",
+                sql=pgtrigger.compiler.UpsertTriggerSql(
+                    func="\n                    IF NEW.title IS DISTINCT FROM OLD.title\n                        OR NEW.text IS DISTINCT FROM OLD.text\n                        OR NEW.description IS DISTINCT FROM OLD.description\n                    THEN\n                        NEW.revision := OLD.revision + 1;\n                    ELSE\n                        -- Saving a stale instance must not reset the revision.\n                        NEW.revision := OLD.revision;\n                    END IF;\n                    RETURN NEW;\n                    ",
+                    hash="9429e42f786a3d96487698bed984f444fd3f3b35",
+                    operation="UPDATE",
+                    pgid="pgtrigger_node_revision_12248",
+                    table="nodes_node",
+                    when="BEFORE",
+                ),
+            ),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.8 on 2026-10-18 20:22
+
+import pgtrigger.compiler
+import pgtrigger.migrations
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("nodes", "0053_node_revision"),
+    ]
+
+    operations = [
+        pgtrigger.migrations.RemoveTrigger(
+            model_name="document",
+            name="document_pending_version",
+        ),
+        migrations.AddField(
+            model_name="pendingdocumentversion",
+            name="json_hash",
+            field=models.CharField(blank=True, default="", editable=False, max_length=64),
+        ),
+        pgtrigger.migrations.AddTrigger(
+            model_name="document",
+            trigger=pgtrigger.compiler.Trigger(
+                name="document_pending_version",
+                sql=pgtrigger.compiler.UpsertTriggerSql(
+                    func="\n                    IF (TG_OP = 'DELETE') THEN\n                        DELETE FROM nodes_pendingdocumentversion WHERE document_id = OLD.id;\n                    ELSIF (TG_OP = 'INSERT' OR NEW.json_hash IS DISTINCT FROM OLD.json_hash) THEN\n                        INSERT INTO nodes_pendingdocumentversion (document_id, queued_at, json_hash)\n                        VALUES (NEW.id, NOW(), NEW.json_hash)\n                        ON CONFLICT (document_id) DO UPDATE SET json_hash = EXCLUDED.json_hash;\n                    END IF;\n                    RETURN NULL;\n                    ",
+                    hash="9fb3d96ff09b5a26942638969218770e9a59540d",
+                    operation='INSERT OR UPDATE OF "json" OR DELETE',
+                    pgid="pgtrigger_document_pending_version_6f847",
+                    table="nodes_document",
+                    when="AFTER",
+                ),
+            ),
+        ),
+        # Entries that were queued before the hash was kept with them.
+        migrations.RunSQL(
+            """
+            UPDATE nodes_pendingdocumentversion pending SET json_hash = document.json_hash
+            FROM nodes_document document WHERE document.id = pending.document_id
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
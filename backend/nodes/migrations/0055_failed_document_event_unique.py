@@ -0,0 +1,26 @@
+# Generated by Django 5.1.8 on 2026-10-18 20:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("nodes", "0054_pending_document_version_hash"),
+    ]
+
+    operations = [
+        # Keep only the latest dead-letter row of events that failed more than once.
+        migrations.RunSQL(
+            """
+            DELETE FROM nodes_faileddocumentevent AS failed
+            USING nodes_faileddocumentevent AS later
+            WHERE failed.event_id = later.event_id AND failed.id < later.id
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AlterField(
+            model_name="faileddocumentevent",
+            name="event_id",
+            field=models.BigIntegerField(unique=True),
+        ),
+    ]
@@ -1,3 +1,4 @@
+import hashlib
 import typing
 import uuid
 from collections import OrderedDict, defaultdict
@@ -15,11 +16,14 @@ from django.contrib.postgres import indexes as pg_indexes
 from django.contrib.postgres import search as pg_search
 from django.contrib.postgres.aggregates import ArrayAgg
 from django.contrib.postgres.fields import ArrayField
-from django.db import models
+from django.core.cache import caches
+from django.db import connection, models
 from django.db.models import Q
 from django.db.models.functions import Coalesce
 
+import nodes.blobs
 import nodes.utils
+import nodes.versioning
 import permissions.managers
 import permissions.models
 import permissions.utils
@@ -34,6 +38,7 @@ if typing.TYPE_CHECKING:
     from users import typing as user_typing
 
 PG_NOTIFY_CHANNEL = "nodes_document_change"
+DOCUMENT_EVENT_PAYLOAD_SETTING = "nodes.document_event_payload"
 
 
 class DocumentType(models.TextChoices):
@@ -62,6 +67,16 @@ def unique_node_image_filename(instance: utils.models.BaseModel, filename: str)
 
 
 class DocumentEvent(models.Model):
+    """
+    A change of a document, written by the `document_change` trigger of `Document`.
+
+    By default, events carry a copy of the document's JSON in `new_data`. When the Postgres
+    setting `nodes.document_event_payload` is set to `reference` for the role or database that the
+    CRDT server connects with, e.g. with
+    `ALTER ROLE crdt SET nodes.document_event_payload = 'reference'`, events only reference the
+    document and its current JSON is loaded when they are processed.
+    """
+
     class EventType(models.TextChoices):
         INSERT = "INSERT", "Insert"
         UPDATE = "UPDATE", "Update"
@@ -70,13 +85,72 @@ class DocumentEvent(models.Model):
     public_id = models.UUIDField(editable=False)
     document_type = models.CharField(max_length=255, choices=DocumentType.choices)
     action = models.CharField(max_length=255, choices=EventType.choices)
-    old_data = models.JSONField(null=True, blank=True)
+    document = models.ForeignKey(
+        "Document",
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
     new_data = models.JSONField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self) -> str:
         return f"{self.public_id} - {self.action.title()}"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["public_id", "document_type"], name="documentevent_document_idx")
+        ]
+
+
+class FailedDocumentEvent(models.Model):
+    """
+    A document event that failed to process, kept so that it can be retried.
+    Retries load the current JSON of the referenced document, so they don't overwrite the changes
+    of later events with stale data.
+    """
+
+    event_id = models.BigIntegerField(unique=True)
+    public_id = models.UUIDField(editable=False)
+    document_type = models.CharField(max_length=255, choices=DocumentType.choices)
+    action = models.CharField(max_length=255, choices=DocumentEvent.EventType.choices)
+    document = models.ForeignKey(
+        "Document",
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        null=True,
+        blank=True,
+        related_name="+",
+    )
+    new_data = models.JSONField(null=True, blank=True)
+    event_created_at = models.DateTimeField()
+    error = models.TextField()
+    attempts = models.PositiveIntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_failed_at = models.DateTimeField(auto_now=True)
+    # Failed events that ran out of retries are not retried automatically anymore.
+    next_retry_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self) -> str:
+        return f"{self.public_id} - {self.action.title()} ({self.attempts} attempts)"
+
+    def as_event(self) -> DocumentEvent:
+        """Return the document event that failed, loading the current data of its document."""
+        return DocumentEvent(
+            pk=self.event_id,
+            public_id=self.public_id,
+            document_type=self.document_type,
+            action=self.action,
+            document_id=self.document_id,
+            new_data=None if self.document_id else self.new_data,
+            created_at=self.event_created_at,
+        )
+
+    class Meta:
+        indexes = [models.Index(fields=["next_retry_at"], name="failedevent_next_retry_idx")]
+
 
 class BaseNode(utils.models.SoftDeletableBaseModel):
     title = models.TextField(null=True, default=None)
@@ -150,12 +224,20 @@ class Node(BaseNode):
         The fields `title_token_count` and `text_token_count` are updated automatically when the
         `title` and `text` fields are changed.
         The field `text` is updated automatically when the `content` field is changed.
+        The field `text_blocks` caches the hash, text length and token count of each top-level
+        block of the content, so that only the changed blocks need to be extracted and tokenized.
+        The field `revision` is incremented by the `node_revision` trigger whenever the `title`,
+        `text` or `description` fields change, it's part of the key of the cached node context.
         These fields are considered read-only / automatically managed and should not be updated
         directly. The `save` method is overridden to handle these updates.
     """
 
     subnodes = models.ManyToManyField("self", related_name="parents", symmetrical=False, blank=True)
 
+    text_blocks = models.JSONField(null=True, blank=True, editable=False)
+
+    revision = models.PositiveBigIntegerField(default=0, editable=False)
+
     editor_document = models.OneToOneField(
         "Document",
         on_delete=models.SET_NULL,
@@ -169,6 +251,10 @@ class Node(BaseNode):
 
     tracker = model_utils.FieldTracker()
 
+    # The public IDs of the subnodes, set by `fetch_subnodes` so that `node_as_str` doesn't need to
+    # query them.
+    subnode_public_ids: list[uuid.UUID] | None = None
+
     @staticmethod
     def get_user_has_permission_filter(
         action: permissions.models.Action,
@@ -319,6 +405,28 @@ class Node(BaseNode):
     def __is_updated(update_fields: typing.Iterable[str] | None, field: str) -> bool:
         return update_fields is None or field in update_fields
 
+    def refresh_managed_fields(self, *fields: str) -> list[str]:
+        """
+        Recalculate the automatically managed fields that depend on the given fields and return the
+        names of the fields that were updated.
+        This is used by `save`, but also by bulk operations that bypass `save`.
+        """
+        updated_fields: list[str] = []
+        if "content" in fields:
+            self.text, self.text_token_count, self.text_blocks = nodes.utils.extract_text(
+                self.content, previous_text=self.text, previous_blocks=self.text_blocks
+            )
+            updated_fields += ["text", "text_token_count", "text_blocks"]
+        counted_fields = [field for field in ("title", "description") if field in fields]
+        for field, count in zip(
+            counted_fields,
+            tokens.token_counts(getattr(self, field) for field in counted_fields),
+            strict=True,
+        ):
+            setattr(self, f"{field}_token_count", count)
+            updated_fields.append(f"{field}_token_count")
+        return updated_fields
+
     def save(
         self,
         force_insert: bool = False,  # type: ignore[override] # I can't see what's wrong with this.
@@ -326,20 +434,12 @@ class Node(BaseNode):
         using: str | None = None,
         update_fields: typing.Iterable[str] | None = None,
     ) -> None:
-        add_to_update_fields: list[str] = []
-        if self.tracker.has_changed("content") and self.__is_updated(update_fields, "content"):
-            self.text = " ".join(nodes.utils.extract_text_from_node(self.content))
-            add_to_update_fields.append("text")
-            self.text_token_count = tokens.token_count(self.text)
-            add_to_update_fields.append("text_token_count")
-        if self.tracker.has_changed("title") and self.__is_updated(update_fields, "title"):
-            self.title_token_count = tokens.token_count(self.title)
-            add_to_update_fields.append("title_token_count")
-        if self.tracker.has_changed("description") and self.__is_updated(
-            update_fields, "description"
-        ):
-            self.description_token_count = tokens.token_count(self.description)
-            add_to_update_fields.append("description_token_count")
+        changed_fields = [
+            field
+            for field in ("content", "title", "description")
+            if self.tracker.has_changed(field) and self.__is_updated(update_fields, field)
+        ]
+        add_to_update_fields = self.refresh_managed_fields(*changed_fields)
 
         update_fields = self.__add_to_update_fields(update_fields, *add_to_update_fields)
 
@@ -363,7 +463,10 @@ class Node(BaseNode):
             if single_line_description:
                 node_str += f"\n - Description: {single_line_description}"
         if include_connections:
-            if subnode_ids := self.subnodes.values_list("public_id", flat=True):
+            subnode_ids = self.subnode_public_ids
+            if subnode_ids is None:
+                subnode_ids = list(self.subnodes.values_list("public_id", flat=True))
+            if subnode_ids:
                 node_str += f"\n - Connects to: {', '.join(map(str, subnode_ids))}"
 
         if str(self.public_id) in edges:
@@ -374,16 +477,91 @@ class Node(BaseNode):
 
         return node_str
 
-    def fetch_subnodes(self, depth: int) -> dict[int, list["Node"]]:
-        """Fetch subnodes of a node and return then by depth."""
+    def _subgraph_rows(self, depth: int) -> list[tuple[int, uuid.UUID, bool, int, int | None, int]]:
+        """
+        Walk the subgraph of the node up to the given depth with a single recursive query.
+
+        Returns every followed edge as `(node_id, public_id, is_removed, depth, parent_id,
+        revision)` of its target, ordered by depth and edge, the first row is the node itself.
+        Removed subnodes are returned, but not followed.
+        """
+        node_table = Node._meta.db_table
+        edge_table = Node.subnodes.through._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH RECURSIVE subgraph (
+                    node_id, public_id, is_removed, depth, parent_id, revision, edge_id
+                ) AS (
+                    SELECT id, public_id, false, 0, NULL::bigint, revision, NULL::bigint
+                    FROM {node_table}
+                    WHERE id = %s
+                    UNION
+                    SELECT node.id, node.public_id, node.is_removed, subgraph.depth + 1,
+                        edge.from_node_id, node.revision, edge.id
+                    FROM subgraph
+                    JOIN {edge_table} AS edge ON edge.from_node_id = subgraph.node_id
+                    JOIN {node_table} AS node ON node.id = edge.to_node_id
+                    WHERE subgraph.depth < %s AND NOT subgraph.is_removed
+                )
+                SELECT node_id, public_id, is_removed, depth, parent_id, revision FROM subgraph
+                ORDER BY depth, edge_id NULLS FIRST
+                """,
+                [self.pk, depth],
+            )
+            return cursor.fetchall()
+
+    def fetch_subnodes(
+        self,
+        depth: int,
+        rows: list[tuple[int, uuid.UUID, bool, int, int | None, int]] | None = None,
+    ) -> dict[int, list["Node"]]:
+        """
+        Fetch subnodes of a node and return them by depth, every node at most once per depth.
+
+        The subgraph is walked with a single recursive query (see `_subgraph_rows`, its rows can be
+        passed in if they were already fetched), and the available subnodes are loaded with a
+        second one. Removed subnodes aren't followed, but are listed as connections like in
+        `node_as_str`. The subnodes of the nodes that were expanded are cached in
+        `subnode_public_ids`.
+        """
+        if rows is None:
+            rows = self._subgraph_rows(depth)
+
+        subnode_public_ids: dict[int, dict[uuid.UUID, None]] = defaultdict(dict)
+        node_ids_at_depth: dict[int, dict[int, None]] = defaultdict(dict)
+        expanded_node_ids = set()
+        for node_id, public_id, is_removed, node_depth, parent_id, _ in rows:
+            if parent_id is not None:
+                subnode_public_ids[parent_id][public_id] = None
+            if not is_removed:
+                node_ids_at_depth[node_depth][node_id] = None
+                if node_depth < depth:
+                    expanded_node_ids.add(node_id)
+        node_ids_at_depth.pop(0, None)
+
+        nodes_by_id: dict[int, Node] = {}
+        if node_ids_at_depth:
+            nodes_by_id = Node.available_objects.in_bulk(
+                {node_id for node_ids in node_ids_at_depth.values() for node_id in node_ids}
+            )
+        # The node itself can be part of a cycle.
+        nodes_by_id[self.pk] = self
+        for node_id, node in nodes_by_id.items():
+            if node_id in expanded_node_ids:
+                node.subnode_public_ids = list(subnode_public_ids.get(node_id, ()))
+
         nodes_at_depth = {0: [self]}
         for i in range(1, depth + 1):
-            subnodes = Node.available_objects.filter(
-                parents__in=nodes_at_depth[i - 1]
-            ).prefetch_related("subnodes")
+            # Nodes can be removed between the queries.
+            subnodes = [
+                nodes_by_id[node_id]
+                for node_id in node_ids_at_depth.get(i, ())
+                if node_id in nodes_by_id
+            ]
             if not subnodes:
                 break
-            nodes_at_depth[i] = list(subnodes)
+            nodes_at_depth[i] = subnodes
         return nodes_at_depth
 
     def node_context_for_depth(
@@ -392,7 +570,163 @@ class Node(BaseNode):
         nodes_at_depth: dict[int, list["Node"]] | None = None,
         include_edges: bool = False,
     ) -> str:
-        """Get the context of a node for a certain depth."""
+        """
+        Get the context of a node for a certain depth.
+
+        If the subnodes aren't passed in, the context is cached in `NODE_CONTEXT_CACHE`. The cache
+        key contains a hash of the walked subgraph, including the revision of every node in it and
+        the hash of the graph document if edges are included, so any change to the titles, texts
+        or connections of the nodes (or to the edges) results in a new key.
+        """
+        if nodes_at_depth is not None:
+            return self._render_context(query_depth, nodes_at_depth, include_edges)
+
+        node_depth = (query_depth // 2) + 1
+        rows = self._subgraph_rows(node_depth)
+        subgraph_hash = hashlib.sha256(repr(rows).encode())
+        if include_edges and self.graph_document_id is not None:
+            graph_hash = (
+                Document.objects.filter(pk=self.graph_document_id)
+                .values_list("json_hash", flat=True)
+                .first()
+            )
+            subgraph_hash.update(repr(graph_hash).encode())
+        cache_key = (
+            f"node-context:{self.pk}:{query_depth}:{int(include_edges)}:{subgraph_hash.hexdigest()}"
+        )
+
+        cache = caches[settings.NODE_CONTEXT_CACHE]
+        context = cache.get(cache_key)
+        if context is None:
+            context = self._render_context(
+                query_depth, self.fetch_subnodes(node_depth, rows), include_edges
+            )
+            cache.set(cache_key, context, settings.NODE_CONTEXT_CACHE_TIMEOUT)
+        return context
+
+    def _graph_edges(self) -> dict[str, list[str]]:
+        """Get the targets of the edges of the node's graph by the public ID of their source."""
+        edges = defaultdict(list)
+        if self.graph_document and "edges" in self.graph_document.json:
+            raw_edges = self.graph_document.json["edges"]
+            for edge in raw_edges.values():
+                edges[edge["source"]].append(edge["target"])
+        return edges
+
+    def _render_context(
+        self, query_depth: int, nodes_at_depth: dict[int, list["Node"]], include_edges: bool
+    ) -> str:
+        edges = self._graph_edges() if include_edges else {}
+        return "".join(
+            node.node_as_str(
+                include_content=include_content,
+                include_connections=include_connections,
+                edges=edges,
+            )
+            + "\n"
+            for node, include_content, include_connections in self.node_context_items(
+                query_depth, nodes_at_depth
+            )
+        )
+
+    def node_context_for_budget(
+        self, token_budget: int, model: str = "gpt-4", include_edges: bool = False
+    ) -> tuple[str, int]:
+        """
+        Get the largest context of a node that fits into a token budget, and its token count.
+
+        The subgraph is expanded best-first up to `NODE_CONTEXT_MAX_DEPTH`: closer nodes come
+        first, at every depth the titles of the nodes before their content and connections, and
+        nodes that are prerequisites of other nodes (edges of the graph) before the rest. Parts that
+        don't fit are skipped, smaller ones after them can still be included. The expansion stops
+        at the first depth that adds nothing.
+
+        The rendered nodes are tokenized on their own, with the newline that separates them, so
+        their counts come from the token count cache. Tokens can merge across the boundaries of
+        the nodes, so the count of the whole context can differ slightly. It's counted at the end;
+        if it doesn't fit, the last nodes are left out by their own counts, assuming the same
+        difference, and only the shortened context is counted again. The returned count is the
+        exact one.
+        """
+        edges = self._graph_edges() if include_edges else {}
+        nodes_at_depth = self.fetch_subnodes(settings.NODE_CONTEXT_MAX_DEPTH)
+
+        # The nodes in the context, whether their content is included and their token count, in
+        # order.
+        included: dict[uuid.UUID, tuple[Node, bool, int]] = OrderedDict()
+        seen: set[uuid.UUID] = set()
+        used_tokens = 0
+        for depth_nodes in nodes_at_depth.values():
+            candidates = sorted(
+                (node for node in depth_nodes if node.public_id not in seen),
+                key=lambda node: str(node.public_id) not in edges,
+            )
+            seen.update(node.public_id for node in candidates)
+
+            added = []
+            title_counts = tokens.token_counts(
+                (
+                    node.node_as_str(include_content=False, include_connections=False, edges=edges)
+                    + "\n"
+                    for node in candidates
+                ),
+                model,
+            )
+            for node, title_count in zip(candidates, title_counts, strict=True):
+                if used_tokens + (title_count or 0) <= token_budget:
+                    included[node.public_id] = (node, False, title_count or 0)
+                    used_tokens += title_count or 0
+                    added.append((node, title_count or 0))
+            if not added:
+                break
+
+            content_counts = tokens.token_counts(
+                (
+                    node.node_as_str(
+                        include_content=True,
+                        include_connections=node.subnode_public_ids is not None,
+                        edges=edges,
+                    )
+                    + "\n"
+                    for node, _ in added
+                ),
+                model,
+            )
+            for (node, title_count), content_count in zip(added, content_counts, strict=True):
+                if used_tokens + (content_count or 0) - title_count <= token_budget:
+                    included[node.public_id] = (node, True, content_count or 0)
+                    used_tokens += (content_count or 0) - title_count
+
+        fragments = [
+            node.node_as_str(
+                include_content=include_content,
+                include_connections=include_content and node.subnode_public_ids is not None,
+                edges=edges,
+            )
+            + "\n"
+            for node, include_content, _ in included.values()
+        ]
+        fragment_counts = [count for _, _, count in included.values()]
+        # The sum of the counts of the nodes in the context.
+        estimated_tokens = used_tokens
+        context = "".join(fragments)
+        used_tokens = (tokens.token_count(context, model) or 0) if fragments else 0
+        while fragments and used_tokens > token_budget:
+            difference = used_tokens - estimated_tokens
+            while fragments and estimated_tokens + difference > token_budget:
+                fragments.pop()
+                estimated_tokens -= fragment_counts.pop()
+            context = "".join(fragments)
+            used_tokens = (tokens.token_count(context, model) or 0) if fragments else 0
+        return context, used_tokens
+
+    def node_context_items(
+        self, query_depth: int, nodes_at_depth: dict[int, list["Node"]] | None = None
+    ) -> list[tuple["Node", bool, bool]]:
+        """
+        Get the nodes in the context of a node for a certain depth, in order, with whether their
+        content and their connections are included.
+        """
         node_depth = (query_depth // 2) + 1
         if nodes_at_depth:
             nodes_at_depth = {
@@ -403,21 +737,14 @@ class Node(BaseNode):
 
         ignore_content_at_depth = node_depth if query_depth % 2 == 0 else None
 
-        nodes_added: "dict[uuid.UUID, tuple[bool, bool]]" = {}
-        context_nodes: "dict[uuid.UUID, str]" = OrderedDict()
-
-        edges = defaultdict(list)
-        if include_edges and self.graph_document and "edges" in self.graph_document.json:
-            raw_edges = self.graph_document.json["edges"]
-            for edge in raw_edges.values():
-                edges[edge["source"]].append(edge["target"])
+        context_nodes: "dict[uuid.UUID, tuple[Node, bool, bool]]" = OrderedDict()
 
         for depth, _nodes in nodes_at_depth.items():
             include_content = depth != ignore_content_at_depth
             for node in _nodes:
                 # Check if the node is already added to the context, if so, with what settings.
-                set_include_content, set_include_connections = nodes_added.get(
-                    node.public_id, (False, False)
+                _, set_include_content, set_include_connections = context_nodes.get(
+                    node.public_id, (node, False, False)
                 )
 
                 # Calculate the new settings for the node, to provide as much context as possible.
@@ -426,21 +753,11 @@ class Node(BaseNode):
                     set_include_connections or depth != node_depth
                 ) and query_depth > 1
 
-                # Save the new settings for the node.
-                nodes_added[node.public_id] = (new_include_content, new_include_connections)
+                # Save the new settings for the node, the OrderedDict preserves the original order
+                # (context closer to the initial node comes first).
+                context_nodes[node.public_id] = (node, new_include_content, new_include_connections)
 
-                # Add node context to the OrderedDict to preserve the original order (context
-                # closer to the initial node comes first).
-                context_nodes[node.public_id] = (
-                    node.node_as_str(
-                        include_content=new_include_content,
-                        include_connections=new_include_connections,
-                        edges=edges,
-                    )
-                    + "\n"
-                )
-
-        return "".join(context_nodes.values())
+        return list(context_nodes.values())
 
     @staticmethod
     def has_read_permission(request: "http.HttpRequest") -> bool:
@@ -501,7 +818,26 @@ class Node(BaseNode):
                     return NEW;
                     """  # noqa: E501
                 ),
-            )
+            ),
+            pgtrigger.Trigger(
+                name="node_revision",
+                operation=pgtrigger.Update,
+                when=pgtrigger.Before,
+                func=pgtrigger.Func(
+                    """
+                    IF NEW.title IS DISTINCT FROM OLD.title
+                        OR NEW.text IS DISTINCT FROM OLD.text
+                        OR NEW.description IS DISTINCT FROM OLD.description
+                    THEN
+                        NEW.revision := OLD.revision + 1;
+                    ELSE
+                        -- Saving a stale instance must not reset the revision.
+                        NEW.revision := OLD.revision;
+                    END IF;
+                    RETURN NEW;
+                    """
+                ),
+            ),
         ]
 
 
@@ -667,16 +1003,66 @@ class MethodNode(permissions.models.MembershipModelMixin, Node):  # type: ignore
 
 
 class DocumentVersion(utils.models.SoftDeletableBaseModel):
-    """Task for storing the version of a document."""
+    """
+    Task for storing the version of a document.
+
+    The CRDT binary is stored in `data` as described in `nodes.versioning`, use `get_data` to
+    restore it. Large payloads are stored in the blob storage under `blob_key` instead, see
+    `nodes.blobs`.
+    """
+
+    class Encoding(models.TextChoices):
+        RAW = nodes.versioning.RAW, "Raw"
+        ZLIB = nodes.versioning.ZLIB, "zlib"
+        DELTA = nodes.versioning.DELTA, "Delta"
 
     document_type = models.CharField(max_length=255, choices=DocumentType.choices)
     document = models.ForeignKey("Document", on_delete=models.CASCADE, related_name="versions")
     json_hash = models.CharField(max_length=255)
     data = models.BinaryField()
+    encoding = models.CharField(max_length=16, choices=Encoding.choices, default=Encoding.RAW)
+    # The version that a delta is based on.
+    keyframe = models.ForeignKey(
+        "self", on_delete=models.RESTRICT, null=True, blank=True, related_name="deltas"
+    )
+    # The size of the restored data.
+    size = models.PositiveIntegerField(null=True, blank=True)
+    blob_key = models.CharField(max_length=255, blank=True, default="")
 
     def __str__(self) -> str:
         return f"{self.document.public_id} - {self.created_at}"
 
+    def get_payload(self) -> bytes:
+        """Return the stored data, without restoring it."""
+        if self.blob_key:
+            return nodes.blobs.read(self.blob_key)
+        return bytes(self.data)
+
+    def get_data(self) -> bytes:
+        """Restore the CRDT binary of this version."""
+        data = self.get_payload()
+        if self.encoding == self.Encoding.DELTA:
+            assert self.keyframe is not None
+            return nodes.versioning.patch(data, self.keyframe.get_data())
+        return nodes.versioning.decompress(self.encoding, data)
+
+    class Meta(utils.models.SoftDeletableBaseModel.Meta):
+        indexes = utils.models.SoftDeletableBaseModel.Meta.indexes + [
+            # Lets versioning look up the hash of the latest version of a document from the index.
+            models.Index(
+                "document",
+                models.F("created_at").desc(),
+                include=["json_hash"],
+                name="documentversion_latest_idx",
+            ),
+            # Lets retention check whether blobs are still referenced.
+            models.Index(
+                fields=["blob_key"],
+                condition=~Q(blob_key=""),
+                name="documentversion_blob_key_idx",
+            ),
+        ]
+
     @staticmethod
     def has_read_permission(request: "http.HttpRequest") -> bool:
         """
@@ -703,6 +1089,29 @@ class DocumentVersion(utils.models.SoftDeletableBaseModel):
         return self.document.has_object_write_permission(request)
 
 
+class PendingDocumentVersion(models.Model):
+    """
+    A document that changed since its last version, written by the `document_pending_version`
+    trigger of `Document`. The versioning task drains these in batches, so that its cost depends on
+    the number of changed documents and no change is skipped if the task doesn't run for a while.
+    The trigger keeps `json_hash` up to date with the document, so that the task only removes an
+    entry if the document didn't change again while its version was created.
+    """
+
+    document = models.OneToOneField(
+        "Document",
+        on_delete=models.DO_NOTHING,
+        db_constraint=False,
+        primary_key=True,
+        related_name="+",
+    )
+    queued_at = models.DateTimeField(auto_now_add=True)
+    json_hash = models.CharField(max_length=64, editable=False, blank=True, default="")
+
+    def __str__(self) -> str:
+        return f"{self.document_id} - {self.queued_at}"
+
+
 class Space(permissions.models.MembershipBaseModel):
     title = models.CharField(max_length=255)
     default_node = models.ForeignKey(
@@ -716,6 +1125,15 @@ class Space(permissions.models.MembershipBaseModel):
     document = models.OneToOneField(
         "Document", on_delete=models.SET_NULL, null=True, blank=True, related_name="space"
     )
+    version_retention = models.JSONField(
+        help_text=(
+            "Overrides the retention policy for the document versions of the space and its nodes, "
+            "as a list of [max_age, interval] tiers in seconds."
+        ),
+        null=True,
+        blank=True,
+        validators=[nodes.versioning.validate_retention_policy],
+    )
 
     # Manually annotating reverse relations that are not automatically detected.
     # See: https://github.com/typeddjango/django-stubs/issues/1354
@@ -864,6 +1282,9 @@ class Document(models.Model):
 
     data = models.BinaryField()
     json = models.JSONField()
+    # The SHA-256 hash of the JSON, maintained by the `document_json_hash` trigger, because the CRDT
+    # server writes documents directly. It isn't refreshed on the instance when saving.
+    json_hash = models.CharField(max_length=64, editable=False, blank=True, default="")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -878,24 +1299,63 @@ class Document(models.Model):
             )
         ]
         triggers = [
+            pgtrigger.Trigger(
+                name="document_json_hash",
+                operation=pgtrigger.Insert | pgtrigger.UpdateOf("json"),
+                when=pgtrigger.Before,
+                func=pgtrigger.Func(
+                    "NEW.json_hash := encode(sha256(convert_to(NEW.json::text, 'UTF8')), 'hex');"
+                    "RETURN NEW;"
+                ),
+            ),
+            pgtrigger.Trigger(
+                name="document_pending_version",
+                operation=pgtrigger.Insert | pgtrigger.UpdateOf("json") | pgtrigger.Delete,
+                when=pgtrigger.After,
+                func=pgtrigger.Func(
+                    """
+                    IF (TG_OP = 'DELETE') THEN
+                        DELETE FROM nodes_pendingdocumentversion WHERE document_id = OLD.id;
+                    ELSIF (TG_OP = 'INSERT' OR NEW.json_hash IS DISTINCT FROM OLD.json_hash) THEN
+                        INSERT INTO nodes_pendingdocumentversion (document_id, queued_at, json_hash)
+                        VALUES (NEW.id, NOW(), NEW.json_hash)
+                        ON CONFLICT (document_id) DO UPDATE SET json_hash = EXCLUDED.json_hash;
+                    END IF;
+                    RETURN NULL;
+                    """
+                ),
+            ),
             pgtrigger.Trigger(
                 name="document_change",
                 operation=pgtrigger.Insert | pgtrigger.Update | pgtrigger.Delete,
                 when=pgtrigger.After,
+                declare=[("payload", "jsonb")],
                 func=pgtrigger.Func(
                     f"""
+                    -- In the reference format, events only point to the document and the processor loads its current JSON.
+                    IF (TG_OP <> 'DELETE' AND coalesce(current_setting('{DOCUMENT_EVENT_PAYLOAD_SETTING}', true), '') <> 'reference') THEN
+                        payload := NEW.json;
+                    END IF;
                     IF (TG_OP = 'INSERT') THEN
-                        INSERT INTO nodes_documentevent (public_id, document_type, action, created_at, new_data) VALUES (NEW.public_id, NEW.document_type, '{DocumentEvent.EventType.INSERT}', NOW(), NEW.json);
+                        INSERT INTO nodes_documentevent (public_id, document_type, action, created_at, document_id, new_data) VALUES (NEW.public_id, NEW.document_type, '{DocumentEvent.EventType.INSERT}', NOW(), NEW.id, payload);
                     ELSIF (TG_OP = 'UPDATE') THEN
-                        INSERT INTO nodes_documentevent (public_id, document_type, action, created_at, old_data, new_data) VALUES (NEW.public_id, NEW.document_type, '{DocumentEvent.EventType.UPDATE}', NOW(), OLD.json, NEW.json);
+                        -- Coalesce the change into the latest pending event of the document, unless that event is being processed right now.
+                        UPDATE nodes_documentevent SET new_data = payload WHERE id = (
+                            SELECT id FROM nodes_documentevent WHERE id = (
+                                SELECT max(id) FROM nodes_documentevent WHERE public_id = NEW.public_id AND document_type = NEW.document_type
+                            ) AND action IN ('{DocumentEvent.EventType.INSERT}', '{DocumentEvent.EventType.UPDATE}') FOR UPDATE SKIP LOCKED
+                        );
+                        IF NOT FOUND THEN
+                            INSERT INTO nodes_documentevent (public_id, document_type, action, created_at, document_id, new_data) VALUES (NEW.public_id, NEW.document_type, '{DocumentEvent.EventType.UPDATE}', NOW(), NEW.id, payload);
+                        END IF;
                     ELSIF (TG_OP = 'DELETE') THEN
-                        INSERT INTO nodes_documentevent (public_id, document_type, action, created_at, old_data) VALUES (OLD.public_id, OLD.document_type, '{DocumentEvent.EventType.DELETE}', NOW(), OLD.json);
+                        INSERT INTO nodes_documentevent (public_id, document_type, action, created_at, document_id) VALUES (OLD.public_id, OLD.document_type, '{DocumentEvent.EventType.DELETE}', NOW(), OLD.id);
                     END IF;
                     NOTIFY {PG_NOTIFY_CHANNEL};
                     RETURN NEW;
                     """  # noqa: E501
                 ),
-            )
+            ),
         ]
 
     @staticmethod
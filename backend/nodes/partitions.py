@@ -0,0 +1,109 @@
+"""
+Maintenance of the daily partitions of the document events table.
+
+`nodes_documentevent` is range partitioned by `created_at`, with one partition per day and a
+default partition for everything else. Events are deleted as soon as they are processed, so
+instead of vacuuming the dead rows, the partitions of past days are dropped once they are empty.
+"""
+
+import datetime
+import logging
+
+from django.conf import settings
+from django.db import DatabaseError, OperationalError, connection, transaction
+
+logger = logging.getLogger(__name__)
+
+TABLE = "nodes_documentevent"
+PARTITION_PREFIX = f"{TABLE}_p"
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+
+def partition_name(day: datetime.date) -> str:
+    return f"{PARTITION_PREFIX}{day:%Y%m%d}"
+
+
+def list_partitions() -> dict[str, datetime.date | None]:
+    """Return the partitions of the events table with the day they hold, None for the default."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = %s::regclass
+            """,
+            [TABLE],
+        )
+        names = [name for (name,) in cursor.fetchall()]
+    return {
+        name: (
+            datetime.datetime.strptime(name.removeprefix(PARTITION_PREFIX), "%Y%m%d").date()
+            if name.startswith(PARTITION_PREFIX)
+            else None
+        )
+        for name in names
+    }
+
+
+def create_partitions(start: datetime.date, days: int) -> list[str]:
+    """Create the missing partitions for the given days, returns the names of the new ones."""
+    existing = list_partitions()
+    created = []
+    for offset in range(days):
+        day = start + datetime.timedelta(days=offset)
+        name = partition_name(day)
+        if name in existing:
+            continue
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    f"CREATE TABLE {name} PARTITION OF {TABLE} FOR VALUES FROM (%s) TO (%s)",
+                    [
+                        datetime.datetime.combine(day, datetime.time(), datetime.UTC),
+                        datetime.datetime.combine(
+                            day + datetime.timedelta(days=1), datetime.time(), datetime.UTC
+                        ),
+                    ],
+                )
+        except DatabaseError:
+            # Most likely the default partition already holds events of that day.
+            logger.exception(f"Could not create the document events partition {name}")
+        else:
+            created.append(name)
+    return created
+
+
+def drop_partitions(before: datetime.date) -> list[str]:
+    """
+    Drop the empty partitions of the days before the given one, returns the names of the dropped
+    ones. Partitions that still hold events are kept, so that no unprocessed event is lost.
+
+    The lock on the events table is only waited for up to `NODE_CRDT_EVENTS_PARTITION_LOCK_TIMEOUT`
+    seconds, because new events queue up behind it. Partitions that can't be locked in time are
+    kept until the next run. Detaching the partitions concurrently would avoid the lock, but isn't
+    possible for tables with a default partition.
+    """
+    dropped = []
+    for name, day in sorted(list_partitions().items(), key=lambda partition: partition[0]):
+        if day is None or day >= before:
+            continue
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT set_config('lock_timeout', %s, true)",
+                    [f"{round(settings.NODE_CRDT_EVENTS_PARTITION_LOCK_TIMEOUT * 1000)}ms"],
+                )
+                # Dropping a partition locks the table anyway. Locking it before the partition
+                # avoids deadlocks with queries on the table, and no event is added before the drop.
+                cursor.execute(f"LOCK TABLE {TABLE}, {name} IN ACCESS EXCLUSIVE MODE")
+                cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {name})")
+                (not_empty,) = cursor.fetchone()
+                if not_empty:
+                    logger.warning(f"Keeping the document events partition {name}, it isn't empty")
+                    continue
+                cursor.execute(f"DROP TABLE {name}")
+        except OperationalError:
+            logger.warning(f"Keeping the document events partition {name}, it couldn't be locked")
+            continue
+        dropped.append(name)
+    return dropped
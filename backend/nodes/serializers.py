@@ -81,6 +81,8 @@ class NodeSearchResultSerializer(utils.serializers.BaseSoftDeletableSerializer[m
         exclude = (utils.serializers.BaseSoftDeletableSerializer.Meta.exclude or []) + [
             "content",
             "text",
+            "text_blocks",
+            "revision",
             "graph_document",
             "editor_document",
             "subnodes",
@@ -150,7 +152,10 @@ class SpaceSerializer(utils.serializers.BaseSoftDeletableSerializer[models.Space
     class Meta(utils.serializers.BaseSoftDeletableSerializer.Meta):
         model = models.Space
         read_only_fields = ["default_node"]
-        exclude = (utils.serializers.BaseSoftDeletableSerializer.Meta.exclude or []) + ["document"]
+        exclude = (utils.serializers.BaseSoftDeletableSerializer.Meta.exclude or []) + [
+            "document",
+            "version_retention",
+        ]
 
 
 class DocumentVersionSerializer(
@@ -161,6 +166,10 @@ class DocumentVersionSerializer(
         exclude = (utils.serializers.BaseSoftDeletableSerializer.Meta.exclude or []) + [
             "data",
             "json_hash",
+            "encoding",
+            "keyframe",
+            "size",
+            "blob_key",
         ]
 
 
@@ -189,6 +198,8 @@ class MethodNodeListSerializer(utils.serializers.BaseSoftDeletableSerializer[mod
         exclude = (utils.serializers.BaseSoftDeletableSerializer.Meta.exclude or []) + [
             "content",
             "text",
+            "text_blocks",
+            "revision",
             "graph_document",
             "editor_document",
             "forked_from",
@@ -22,6 +22,45 @@ def create_periodic_tasks(sender: typing.Any, **kwargs: typing.Any) -> None:
         },
     )
 
+    # Create a schedule for retrying failed document events
+    try:
+        schedule, created = IntervalSchedule.objects.get_or_create(
+            every=settings.NODE_CRDT_EVENTS_RETRY_INTERVAL, period=IntervalSchedule.SECONDS
+        )
+    except IntervalSchedule.MultipleObjectsReturned:
+        schedule = IntervalSchedule.objects.filter(
+            every=settings.NODE_CRDT_EVENTS_RETRY_INTERVAL, period=IntervalSchedule.SECONDS
+        ).first()
+
+    # Associate this schedule with the task
+    PeriodicTask.objects.update_or_create(
+        task=settings.NODE_CRDT_EVENTS_RETRY_TASK,
+        defaults={
+            "interval": schedule,
+            "name": "Retry failed document events every "
+            f"{settings.NODE_CRDT_EVENTS_RETRY_INTERVAL} seconds",
+        },
+    )
+
+    # Create a schedule for maintaining the partitions of the document events table
+    try:
+        schedule, created = IntervalSchedule.objects.get_or_create(
+            every=settings.NODE_CRDT_EVENTS_PARTITION_INTERVAL, period=IntervalSchedule.SECONDS
+        )
+    except IntervalSchedule.MultipleObjectsReturned:
+        schedule = IntervalSchedule.objects.filter(
+            every=settings.NODE_CRDT_EVENTS_PARTITION_INTERVAL, period=IntervalSchedule.SECONDS
+        ).first()
+    # Associate this schedule with the task
+    PeriodicTask.objects.update_or_create(
+        task=settings.NODE_CRDT_EVENTS_PARTITION_TASK,
+        defaults={
+            "interval": schedule,
+            "name": "Maintain document event partitions every "
+            f"{settings.NODE_CRDT_EVENTS_PARTITION_INTERVAL} seconds",
+        },
+    )
+
     # Create a schedule for the document versioning task
     try:
         schedule, created = IntervalSchedule.objects.get_or_create(
@@ -42,6 +81,25 @@ def create_periodic_tasks(sender: typing.Any, **kwargs: typing.Any) -> None:
         },
     )
 
+    # Create a schedule for pruning document versions
+    try:
+        schedule, created = IntervalSchedule.objects.get_or_create(
+            every=settings.NODE_VERSIONING_RETENTION_INTERVAL, period=IntervalSchedule.SECONDS
+        )
+    except IntervalSchedule.MultipleObjectsReturned:
+        schedule = IntervalSchedule.objects.filter(
+            every=settings.NODE_VERSIONING_RETENTION_INTERVAL, period=IntervalSchedule.SECONDS
+        ).first()
+    # Associate this schedule with the task
+    PeriodicTask.objects.update_or_create(
+        task=settings.NODE_VERSIONING_RETENTION_TASK,
+        defaults={
+            "interval": schedule,
+            "name": "Prune document versions every "
+            f"{settings.NODE_VERSIONING_RETENTION_INTERVAL} seconds",
+        },
+    )
+
 
 # TODO: This should probably live in another place, not in a specific app.
 @signals.task_postrun.connect
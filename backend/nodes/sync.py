@@ -0,0 +1,575 @@
+"""
+Synchronisation of CRDT documents into the relational models.
+
+Document events are processed in batches: all Nodes, Spaces and Documents affected by a batch are
+fetched with a few `IN (...)` queries and the results are written back with bulk operations, so
+that the number of queries depends on the number of document types in a batch rather than on the
+number of events.
+Events in the reference format don't carry the document's JSON, it is loaded for the whole batch
+with a single query instead.
+"""
+
+import datetime
+import logging
+import typing
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db import models as django_models
+from django.utils import timezone
+
+from nodes import models
+from utils import tokens
+
+logger = logging.getLogger(__name__)
+
+UPSERT_ACTIONS = (models.DocumentEvent.EventType.INSERT, models.DocumentEvent.EventType.UPDATE)
+
+
+def process_events(
+    events: list[models.DocumentEvent], raise_exception: bool = False
+) -> list[tuple[models.DocumentEvent, Exception]]:
+    """
+    Process a batch of document events and return the events that failed, with their errors.
+    If processing the batch fails, the events are processed one by one, so that a single broken
+    event doesn't prevent the rest of the batch from being synced.
+    """
+    try:
+        with transaction.atomic():
+            _process_events(events, raise_exception=raise_exception)
+    except Exception as exc:
+        if raise_exception:
+            raise
+        if len(events) == 1:
+            logger.exception(f"Error processing event {events[0].pk}: {exc}")
+            return [(events[0], exc)]
+        logger.warning(
+            f"Error processing a batch of {len(events)} events, processing them one by one..."
+        )
+        return [failure for event in events for failure in process_events([event])]
+    return []
+
+
+def retry_delay(attempts: int) -> datetime.timedelta | None:
+    """
+    Return the delay before a failed event is retried after the given number of failed attempts,
+    or `None` if it shouldn't be retried anymore.
+    """
+    if attempts >= settings.NODE_CRDT_EVENTS_MAX_ATTEMPTS:
+        return None
+    return datetime.timedelta(seconds=settings.NODE_CRDT_EVENTS_RETRY_BACKOFF * 2 ** (attempts - 1))
+
+
+def dead_letter_events(failures: list[tuple[models.DocumentEvent, Exception]]) -> None:
+    """
+    Keep the failed events in the dead-letter table, so that they can be retried later.
+    Events that failed before count another failed attempt and are retried with a longer delay.
+    """
+    now = timezone.now()
+    existing = models.FailedDocumentEvent.objects.select_for_update().in_bulk(
+        [event.pk for event, _ in failures], field_name="event_id"
+    )
+    new_failed_events = []
+    for event, exc in failures:
+        failed_event = existing.get(event.pk)
+        if failed_event is None:
+            failed_event = models.FailedDocumentEvent(
+                event_id=event.pk,
+                public_id=event.public_id,
+                document_type=event.document_type,
+                action=event.action,
+                document_id=event.document_id,
+                new_data=event.new_data,
+                event_created_at=event.created_at,
+                attempts=0,
+            )
+            new_failed_events.append(failed_event)
+        failed_event.attempts += 1
+        failed_event.error = repr(exc)
+        failed_event.last_failed_at = now
+        delay = retry_delay(failed_event.attempts)
+        failed_event.next_retry_at = now + delay if delay else None
+
+    if existing:
+        models.FailedDocumentEvent.objects.bulk_update(
+            existing.values(), ["attempts", "error", "last_failed_at", "next_retry_at"]
+        )
+    if new_failed_events:
+        models.FailedDocumentEvent.objects.bulk_create(new_failed_events)
+
+
+class DocumentShard(django_models.Func):
+    """
+    The shard of a document, derived from the last two bytes of its public ID.
+    This is the database equivalent of `document_shard`.
+    """
+
+    template = (
+        "mod(get_byte(uuid_send(%(expressions)s), 14) * 256 "
+        "+ get_byte(uuid_send(%(expressions)s), 15), %(shards)s)"
+    )
+    output_field = django_models.IntegerField()
+
+    def __init__(self, expression: str, shards: int, **extra: typing.Any):
+        super().__init__(expression, shards=int(shards), **extra)
+
+
+def document_shard(public_id: uuid.UUID | str, shards: int) -> int:
+    """Return the shard of a document, events of a document always end up in the same shard."""
+    public_id_bytes = uuid.UUID(str(public_id)).bytes
+    return (public_id_bytes[14] * 256 + public_id_bytes[15]) % shards
+
+
+def events_for_shard(
+    shard: int | None = None, shards: int = 1
+) -> "django_models.QuerySet[models.DocumentEvent]":
+    """Return the events of the given shard, or all events if no shard is given."""
+    events = models.DocumentEvent.objects.all()
+    if shard is None:
+        return events
+    return events.alias(shard=DocumentShard("public_id", shards=shards)).filter(shard=shard)
+
+
+def delete_superseded_events(
+    events: "django_models.QuerySet[models.DocumentEvent] | None" = None,
+) -> int:
+    """
+    Delete the insert and update events that are superseded by a later insert or update event of
+    the same document and return the number of deleted events.
+    Only the latest data of a document matters, so the intermediate events don't need to be
+    processed at all. Events that are locked, because they are being processed, are skipped.
+    """
+    if events is None:
+        events = models.DocumentEvent.objects.all()
+    newer_events = models.DocumentEvent.objects.filter(
+        public_id=django_models.OuterRef("public_id"),
+        document_type=django_models.OuterRef("document_type"),
+        action__in=UPSERT_ACTIONS,
+        pk__gt=django_models.OuterRef("pk"),
+    )
+    superseded_events = (
+        events.filter(django_models.Exists(newer_events), action__in=UPSERT_ACTIONS)
+        .select_for_update(skip_locked=True)
+        .values("pk")
+    )
+    deleted, _ = models.DocumentEvent.objects.filter(pk__in=superseded_events).delete()
+    return deleted
+
+
+def coalesce_events(events: list[models.DocumentEvent]) -> list[models.DocumentEvent]:
+    """
+    Return the events without the insert and update events that are superseded by a later insert
+    or update event of the same document, the latest event wins.
+    """
+    latest_events = {
+        (event.public_id, event.document_type): event
+        for event in events
+        if event.action in UPSERT_ACTIONS
+    }
+    return [
+        event
+        for event in events
+        if event.action not in UPSERT_ACTIONS
+        or latest_events[(event.public_id, event.document_type)] is event
+    ]
+
+
+def load_event_data(events: list[models.DocumentEvent]) -> list[models.DocumentEvent]:
+    """
+    Set the current JSON of the referenced documents as data of the insert and update events that
+    don't carry it, and return the events without the ones whose document no longer exists.
+    """
+    reference_events = [
+        event
+        for event in events
+        if event.action in UPSERT_ACTIONS and event.new_data is None and event.document_id
+    ]
+    if not reference_events:
+        return events
+    document_data = dict(
+        models.Document.objects.filter(
+            pk__in={event.document_id for event in reference_events}
+        ).values_list("pk", "json")
+    )
+
+    missing_events = set()
+    for event in reference_events:
+        if event.document_id in document_data:
+            event.new_data = document_data[event.document_id]
+        else:
+            logger.warning(f"Document of event {event.pk} does not exist. Ignoring...")
+            missing_events.add(event)
+    return [event for event in events if event not in missing_events]
+
+
+def _process_events(events: list[models.DocumentEvent], raise_exception: bool = False) -> None:
+    """Dispatch the events to the handlers of their document types."""
+    events_by_type: dict[str, list[models.DocumentEvent]] = defaultdict(list)
+    for event in load_event_data(coalesce_events(events)):
+        logger.debug(f"Processing event {event.pk} for {event.public_id}")
+        events_by_type[event.document_type].append(event)
+
+    # Dicts preserve insertion order, so the handlers run in the order in which the first event
+    # of each document type was created.
+    for document_type, typed_events in events_by_type.items():
+        upsert_events = _filter_upsert_events(typed_events)
+        if not upsert_events:
+            continue
+        if document_type == models.DocumentType.EDITOR:
+            _process_editor_events(upsert_events)
+        elif document_type == models.DocumentType.SPACE:
+            _process_space_events(upsert_events, raise_exception=raise_exception)
+        elif document_type == models.DocumentType.GRAPH:
+            _process_graph_events(upsert_events, node_type=models.NodeType.DEFAULT)
+        elif document_type == models.DocumentType.METHOD_GRAPH:
+            _process_graph_events(
+                upsert_events, node_type=models.NodeType.METHOD, include_subnodes=False
+            )
+        else:
+            logger.warning(f"Unknown document type {document_type} received. Ignoring...")
+
+
+def _filter_upsert_events(
+    events: list[models.DocumentEvent],
+) -> list[models.DocumentEvent]:
+    """Return the insert and update events, logging the ones that are ignored."""
+    upsert_events = []
+    for event in events:
+        if event.action in UPSERT_ACTIONS:
+            upsert_events.append(event)
+        elif event.action == models.DocumentEvent.EventType.DELETE:
+            # We don't actually expect the document to be deleted in the database, they are just
+            # marked as deleted.
+            logger.warning(f"Deletion event for {event.public_id} received. Ignoring...")
+        else:
+            logger.warning(
+                f"Unknown action {event.action} for {event.public_id} received. ignoring..."
+            )
+    return upsert_events
+
+
+def _fetch_document_ids(
+    public_ids: typing.Iterable[str], document_types: typing.Iterable[str]
+) -> dict[tuple[str, str], int]:
+    """Return the primary keys of the documents, keyed by public ID and document type."""
+    return {
+        (str(public_id), document_type): pk
+        for pk, public_id, document_type in models.Document.objects.filter(
+            public_id__in=set(public_ids), document_type__in=document_types
+        ).values_list("pk", "public_id", "document_type")
+    }
+
+
+def _lock_nodes(public_ids: typing.Iterable[str], *defer: str) -> dict[str, models.Node]:
+    """
+    Fetch and lock the nodes with the given public IDs.
+    The rows are locked in the order of their primary keys, which reduces the chance of deadlocks
+    between workers of different shards that lock overlapping nodes.
+    """
+    return {
+        str(node.public_id): node
+        for node in models.Node.all_objects.select_for_update(no_key=True)
+        .filter(public_id__in=set(public_ids))
+        .defer(*defer)
+        .order_by("pk")
+    }
+
+
+def _lock_or_create_nodes(
+    public_ids: typing.Iterable[str], node_type: str, *defer: str
+) -> dict[str, models.Node]:
+    """
+    Fetch and lock the nodes with the given public IDs, creating the ones that don't exist yet.
+    The nodes are created with conflicts ignored and fetched again afterward, so that a node that
+    was created concurrently is updated instead of causing an integrity error.
+    """
+    public_ids = set(map(str, public_ids))
+    nodes = _lock_nodes(public_ids, *defer)
+    if missing_ids := public_ids - nodes.keys():
+        models.Node.all_objects.bulk_create(
+            [models.Node(public_id=public_id, node_type=node_type) for public_id in missing_ids],
+            ignore_conflicts=True,
+        )
+        nodes |= _lock_nodes(missing_ids, *defer)
+    return nodes
+
+
+def _set_documents(
+    node: models.Node, document_ids: dict[tuple[str, str], int], **document_types: str
+) -> list[str]:
+    """
+    Link the node to its documents if it isn't linked yet and return the names of the fields that
+    were updated. The keyword arguments map the document field to the document type.
+    """
+    updated_fields = []
+    for field, document_type in document_types.items():
+        if getattr(node, f"{field}_id") is None:
+            if (document_id := document_ids.get((str(node.public_id), document_type))) is not None:
+                setattr(node, f"{field}_id", document_id)
+                updated_fields.append(field)
+    return updated_fields
+
+
+def _bulk_update_nodes(nodes: dict[models.Node, set[str]]) -> None:
+    """
+    Write back the nodes that were changed, together with the fields that were changed.
+    `bulk_update` doesn't set `auto_now` fields, so `updated_at` is set here like `save` would.
+    """
+    if changed := {node: fields for node, fields in nodes.items() if fields}:
+        now = timezone.now()
+        for node in changed:
+            node.updated_at = now
+        models.Node.all_objects.bulk_update(
+            changed.keys(), set().union(*changed.values(), {"updated_at"}), batch_size=500
+        )
+
+
+def _process_editor_events(events: list[models.DocumentEvent]) -> None:
+    """Update the content of the nodes, creating the nodes that don't exist yet."""
+    # Later events overwrite the content of earlier ones.
+    contents = {str(event.public_id): event.new_data for event in events}
+    nodes = _lock_or_create_nodes(contents.keys(), models.NodeType.DEFAULT)
+    document_ids = _fetch_document_ids(
+        contents.keys(), [models.DocumentType.EDITOR, models.DocumentType.GRAPH]
+    )
+
+    changed_fields: dict[models.Node, set[str]] = {}
+    for public_id, content in contents.items():
+        node = nodes[public_id]
+        fields = set(
+            _set_documents(
+                node,
+                document_ids,
+                graph_document=models.DocumentType.GRAPH,
+                editor_document=models.DocumentType.EDITOR,
+            )
+        )
+        if node.content != content or node.text is None:
+            node.content = content
+            fields |= {"content", *node.refresh_managed_fields("content")}
+        changed_fields[node] = fields
+
+    _bulk_update_nodes(changed_fields)
+
+
+def _process_space_events(  # noqa: PLR0912
+    events: list[models.DocumentEvent], raise_exception: bool = False
+) -> None:
+    """
+    Update the nodes of the spaces and their titles, creating the nodes that didn't get their
+    content synced yet.
+    """
+    space_events: dict[str, list[models.DocumentEvent]] = defaultdict(list)
+    for event in events:
+        if not event.new_data:
+            logger.error(f"Space Event {event.public_id} has no data. Ignoring...")
+            continue
+        space_events[str(event.public_id)].append(event)
+
+    spaces = {
+        str(space.public_id): space
+        for space in models.Space.all_objects.select_for_update(no_key=True).filter(
+            public_id__in=space_events.keys()
+        )
+    }
+    for public_id in space_events.keys() - spaces.keys():
+        logger.error(f"Space {public_id} does not exist. Ignoring...")
+        if raise_exception:
+            raise models.Space.DoesNotExist(f"Space {public_id} does not exist.")
+        del space_events[public_id]
+
+    # Extract nodes and titles from the space data, later events overwrite earlier ones.
+    node_titles: dict[str, str | None] = {}
+    node_spaces: dict[str, models.Space] = {}
+    space_node_ids: dict[models.Space, set[str]] = {}
+    for public_id, typed_events in space_events.items():
+        space = spaces[public_id]
+        for event in typed_events:
+            titles = {
+                node_id: node_data.get("title")
+                for node_id, node_data in event.new_data.get("nodes", {}).items()
+            }
+            node_titles |= titles
+            node_spaces |= dict.fromkeys(titles, space)
+            space_node_ids[space] = set(titles)
+
+    # 1. Update the spaces
+    document_ids = _fetch_document_ids(
+        list(spaces) + list(node_titles),
+        [models.DocumentType.SPACE, models.DocumentType.EDITOR, models.DocumentType.GRAPH],
+    )
+    changed_spaces = []
+    for space in space_node_ids:
+        document_id = document_ids.get((str(space.public_id), models.DocumentType.SPACE))
+        if space.document_id is None and document_id is not None:
+            space.document_id = document_id
+            changed_spaces.append(space)
+    if changed_spaces:
+        models.Space.all_objects.bulk_update(changed_spaces, ["document"])
+
+    # 2. Create new nodes that didn't get their content synced yet
+    nodes = _lock_nodes(node_titles.keys(), "content", "text", "text_blocks")
+    new_nodes = []
+    for node_id in node_titles.keys() - nodes.keys():
+        node = models.Node(
+            public_id=node_id,
+            title=node_titles[node_id],
+            space=node_spaces[node_id],
+            node_type=models.NodeType.DEFAULT,
+        )
+        # This is in case the node's documents were synced meanwhile.
+        _set_documents(
+            node,
+            document_ids,
+            graph_document=models.DocumentType.GRAPH,
+            editor_document=models.DocumentType.EDITOR,
+        )
+        new_nodes.append(node)
+
+    # 3. Update the node titles and token counts of existing nodes
+    changed_nodes = []
+    for node_id, node in nodes.items():
+        if node.title != node_titles[node_id]:
+            node.title = node_titles[node_id]
+            changed_nodes.append(node)
+
+    # The token counts of all new and changed titles are calculated at once.
+    for node, title_token_count in zip(
+        new_nodes + changed_nodes,
+        tokens.token_counts([node.title for node in new_nodes + changed_nodes]),
+        strict=True,
+    ):
+        node.title_token_count = title_token_count
+    if new_nodes:
+        # Another event or worker might have created some of the nodes meanwhile, their titles are
+        # updated instead.
+        models.Node.all_objects.bulk_create(
+            new_nodes,
+            update_conflicts=True,
+            unique_fields=["public_id"],
+            update_fields=["title", "title_token_count"],
+        )
+    _update_titles(changed_nodes)
+
+    # 4. Update the space memberships, only touching the nodes that join or leave a space.
+    for space, node_ids in space_node_ids.items():
+        models.Node.all_objects.filter(space=space).exclude(public_id__in=node_ids).update(
+            space=None
+        )
+        models.Node.all_objects.filter(public_id__in=node_ids).exclude(space=space).update(
+            space=space
+        )
+
+
+def _update_titles(nodes: list[models.Node], batch_size: int = 1000) -> None:
+    """
+    Write the titles and title token counts of the nodes with a single
+    `UPDATE ... FROM (VALUES ...)` statement per batch.
+    """
+    table = models.Node._meta.db_table
+    for start in range(0, len(nodes), batch_size):
+        batch = nodes[start : start + batch_size]
+        values = ", ".join(["(%s::bigint, %s::text, %s::integer)"] * len(batch))
+        params = [
+            value for node in batch for value in (node.pk, node.title, node.title_token_count)
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} AS node "
+                "SET title = data.title, title_token_count = data.title_token_count "
+                f"FROM (VALUES {values}) AS data (id, title, title_token_count) "
+                "WHERE node.id = data.id",
+                params,
+            )
+
+
+def _process_graph_events(
+    events: list[models.DocumentEvent], node_type: str, include_subnodes: bool = True
+) -> None:
+    """Link the graph documents to their nodes and add the graph's nodes as subnodes."""
+    subnode_ids: dict[str, set[str]] = {}
+    for event in events:
+        if include_subnodes and not event.new_data:
+            logger.error(f"Graph Event {event.public_id} has no data. Ignoring...")
+            continue
+        # Later events overwrite the nodes of earlier ones.
+        subnode_ids[str(event.public_id)] = set((event.new_data or {}).get("nodes", []))
+
+    # 1. Get or create the parent nodes
+    nodes = _lock_or_create_nodes(subnode_ids.keys(), node_type, "content", "text", "text_blocks")
+    document_type = (
+        models.DocumentType.GRAPH
+        if node_type == models.NodeType.DEFAULT
+        else models.DocumentType.METHOD_GRAPH
+    )
+    document_ids = _fetch_document_ids(subnode_ids.keys(), [document_type])
+    _bulk_update_nodes(
+        {
+            node: set(_set_documents(node, document_ids, graph_document=document_type))
+            for node in nodes.values()
+        }
+    )
+
+    if not include_subnodes:
+        return
+
+    # 2. Set subnodes
+    subnode_pks = _upsert_nodes(set().union(*subnode_ids.values()), models.NodeType.DEFAULT)
+    _set_subnodes(
+        {
+            nodes[node_id].pk: {subnode_pks[subnode_id] for subnode_id in ids}
+            for node_id, ids in subnode_ids.items()
+        }
+    )
+
+
+def _upsert_nodes(public_ids: typing.Iterable[str], node_type: str) -> dict[str, int]:
+    """
+    Create the nodes with the given public IDs that don't exist yet with a single statement and
+    return the primary keys of all of them, keyed by public ID.
+    """
+    public_ids = set(map(str, public_ids))
+    if not public_ids:
+        return {}
+    models.Node.all_objects.bulk_create(
+        [models.Node(public_id=public_id, node_type=node_type) for public_id in public_ids],
+        ignore_conflicts=True,
+    )
+    return {
+        str(public_id): pk
+        for pk, public_id in models.Node.all_objects.filter(public_id__in=public_ids).values_list(
+            "pk", "public_id"
+        )
+    }
+
+
+def _set_subnodes(subnodes: dict[int, set[int]]) -> None:
+    """
+    Set the subnodes of the given nodes, keyed by the primary key of the node, by deleting the
+    edges that are gone and inserting the new ones, one statement each.
+    """
+    if not subnodes:
+        return
+    table = models.Node.subnodes.through._meta.db_table
+    node_pks = list(subnodes)
+    from_pks = [node_pk for node_pk, subnode_pks in subnodes.items() for _ in subnode_pks]
+    to_pks = [subnode_pk for subnode_pks in subnodes.values() for subnode_pk in subnode_pks]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM {table} AS edge WHERE edge.from_node_id = ANY(%s::bigint[]) "
+            "AND NOT EXISTS (SELECT 1 "
+            "FROM unnest(%s::bigint[], %s::bigint[]) AS new_edge (from_node_id, to_node_id) "
+            "WHERE new_edge.from_node_id = edge.from_node_id "
+            "AND new_edge.to_node_id = edge.to_node_id)",
+            [node_pks, from_pks, to_pks],
+        )
+        if from_pks:
+            cursor.execute(
+                f"INSERT INTO {table} (from_node_id, to_node_id) "
+                "SELECT new_edge.from_node_id, new_edge.to_node_id "
+                "FROM unnest(%s::bigint[], %s::bigint[]) AS new_edge (from_node_id, to_node_id) "
+                "ON CONFLICT DO NOTHING",
+                [from_pks, to_pks],
+            )
@@ -1,341 +1,391 @@
 import logging
-from datetime import timedelta
-from hashlib import sha256
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
 
 import pglock
 from celery import shared_task
 from django.conf import settings
-from django.db import transaction
+from django.db import connection
+from django.db.models import (
+    BooleanField,
+    Count,
+    Exists,
+    ExpressionWrapper,
+    F,
+    OuterRef,
+    Q,
+    Subquery,
+)
+from django.db.models.functions import Coalesce, Length
 from django.utils import timezone
 
-from nodes import models
+from nodes import blobs, models, partitions, sync, versioning
 
 logger = logging.getLogger(__name__)
 
+# A delta is only stored if it is at most this fraction of the size of its keyframe.
+KEYFRAME_DELTA_RATIO = 0.5
+
+# Held while storing versions that refer to blobs and while deleting unreferenced blobs.
+VERSION_BLOBS_LOCK = "document_version_blobs"
+
 
 @shared_task(ignore_result=True, expires=10)
-def process_document_events(raise_exception: bool = False) -> None:  # noqa: PLR0915, PLR0912
+def process_document_events(
+    raise_exception: bool = False, batch_size: int | None = None, shard: int | None = None
+) -> None:
     """
     Process document events and update the corresponding Nodes and Spaces.
-    TODO: Check whether we have an issue with Out of Order Processing.
-    TODO: Reduce complexity of this function.
-    """
+    The events are claimed and processed in batches of `batch_size` events, defaulting to the
+    `NODE_CRDT_EVENTS_BATCH_SIZE` setting.
 
-    # The pglock.advisory context manager is used to ensure that only one task is running at a time.
-    with pglock.advisory("process_document_events_task", xact=True):
-        # Lock the rows we are going to process so that no other task will process them.
-        events = models.DocumentEvent.objects.select_for_update(skip_locked=True).order_by(
-            "created_at"
+    The events can be partitioned by document into `NODE_CRDT_EVENTS_SHARDS` shards, each of them
+    processed by its own task under its own lock, so that multiple workers can drain the events in
+    parallel while the events of a document are still processed in order. Without a shard, the
+    task enqueues one task per shard in that case.
+
+    Each batch is committed on its own. Once the task used up its budget of
+    `NODE_CRDT_EVENTS_TIME_BUDGET` seconds or `NODE_CRDT_EVENTS_MAX_EVENTS` events, it enqueues a
+    new task for the remaining events.
+    """
+    shards = settings.NODE_CRDT_EVENTS_SHARDS
+    if shard is None and shards > 1:
+        for shard_index in range(shards):
+            process_document_events.delay(
+                raise_exception=raise_exception, batch_size=batch_size, shard=shard_index
+            )
+        return
+
+    batch_size = batch_size or settings.NODE_CRDT_EVENTS_BATCH_SIZE
+    lock_id = "process_document_events_task"
+    if shard is not None:
+        lock_id += f"_{shard}"
+    shard_events = sync.events_for_shard(shard, shards)
+
+    # The pglock.advisory context manager is used to ensure that only one task is running at a time
+    # for each shard. Every batch is committed in its own transaction, so that a task that runs out
+    # of time only loses the batch it is working on.
+    with pglock.advisory(lock_id, xact=True):
+        if deleted := sync.delete_superseded_events(shard_events):
+            logger.debug(f"Deleted {deleted} superseded document events")
+
+    deadline = time.monotonic() + settings.NODE_CRDT_EVENTS_TIME_BUDGET
+    processed = 0
+    while time.monotonic() < deadline and processed < settings.NODE_CRDT_EVENTS_MAX_EVENTS:
+        with pglock.advisory(lock_id, xact=True):
+            # Lock the rows we are going to process so that no other task will process them.
+            # The events are ordered by their primary key instead of their creation time, because
+            # the creation time is the start of the inserting transaction, so it doesn't reflect
+            # the order in which the changes to a document were made.
+            events = list(
+                shard_events.select_for_update(skip_locked=True).order_by("pk")[:batch_size]
+            )
+            if not events:
+                return
+
+            # Failed events are moved to the dead-letter table instead of being lost.
+            if failures := sync.process_events(events, raise_exception=raise_exception):
+                sync.dead_letter_events(failures)
+            models.DocumentEvent.objects.filter(pk__in=[event.pk for event in events]).delete()
+        processed += len(events)
+
+    # The budget is used up, continue with the remaining events in a new task, so that a backlog
+    # is drained in steps instead of hitting the time limit and rolling back.
+    if shard_events.exists():
+        logger.info(f"Processed {processed} document events, continuing in a new task")
+        process_document_events.delay(
+            raise_exception=raise_exception, batch_size=batch_size, shard=shard
         )
-        for document_event in events:
-            logger.debug(f"Processing event {document_event.pk} for {document_event.public_id}")
-            try:
-                with transaction.atomic():
-                    if document_event.document_type == models.DocumentType.EDITOR:
-                        # It would be nice to split this into a separate task, but keeping the
-                        # lock is a good way to ensure that we don't process the same event
-                        # twice.
-                        if document_event.action in (
-                            models.DocumentEvent.EventType.INSERT,
-                            models.DocumentEvent.EventType.UPDATE,
-                        ):
-                            # Fetch the node, or create it.
-                            try:
-                                node = models.Node.all_objects.select_for_update(no_key=True).get(
-                                    public_id=document_event.public_id
-                                )
-                            except models.Node.DoesNotExist:
-                                node = models.Node(
-                                    public_id=document_event.public_id,
-                                    node_type=models.NodeType.DEFAULT,
-                                )
-
-                            # Try setting the graph and editor documents.
-                            if not node.graph_document:
-                                try:
-                                    node.graph_document = models.Document.objects.only("id").get(
-                                        public_id=document_event.public_id,
-                                        document_type=models.DocumentType.GRAPH,
-                                    )
-                                except models.Document.DoesNotExist:
-                                    pass
-
-                            if not node.editor_document:
-                                try:
-                                    node.editor_document = models.Document.objects.only("id").get(
-                                        public_id=document_event.public_id,
-                                        document_type=models.DocumentType.EDITOR,
-                                    )
-                                except models.Document.DoesNotExist:
-                                    pass
-
-                            node.content = document_event.new_data
-                            node.save()
-
-                        elif document_event.action == models.DocumentEvent.EventType.DELETE:
-                            # We don't actually expect the document to be deleted in the
-                            # database, they are just marked as deleted.
-                            logger.warning(
-                                f"Deletion event for {document_event.public_id} received. "
-                                "Ignoring..."
-                            )
-                        else:
-                            logger.warning(
-                                f"Unknown action {document_event.action} for "
-                                f"{document_event.public_id} received. ignoring..."
-                            )
-                    elif document_event.document_type == models.DocumentType.SPACE:
-                        if document_event.action in (
-                            models.DocumentEvent.EventType.INSERT,
-                            models.DocumentEvent.EventType.UPDATE,
-                        ):
-                            if not document_event.new_data:
-                                logger.error(
-                                    f"Space Event {document_event.public_id} has no data. "
-                                    "Ignoring..."
-                                )
-                                continue
-                            # 1. Update the space
-
-                            # Extract nodes and titles from space data
-                            node_titles = {
-                                node_id: node_data.get("title")
-                                for node_id, node_data in document_event.new_data.get(
-                                    "nodes", {}
-                                ).items()
-                            }
-
-                            try:
-                                space = models.Space.all_objects.select_for_update(no_key=True).get(
-                                    public_id=document_event.public_id
-                                )
-                            except models.Space.DoesNotExist:
-                                logger.error(
-                                    f"Space {document_event.public_id} does not exist. "
-                                    "Ignoring..."
-                                )
-                                if raise_exception:
-                                    raise
-                                continue
-
-                            if not space.document:
-                                try:
-                                    space.document = models.Document.objects.only("id").get(
-                                        public_id=document_event.public_id
-                                    )
-                                except models.Document.DoesNotExist:
-                                    pass
-                                else:
-                                    space.save(update_fields=["document"])
-
-                            space_nodes = (
-                                models.Node.all_objects.select_for_update(no_key=True)
-                                .filter(public_id__in=node_titles.keys())
-                                .defer("content", "text")
-                                .order_by("-created_at")
-                            )
-                            space.nodes.set(space_nodes)
-
-                            # 2. Update the node titles and token counts of existing nodes
-                            nodes_in_space = set(node_titles.keys())
-                            nodes_existing = set(
-                                map(str, space_nodes.values_list("public_id", flat=True))
-                            )
-
-                            for node in space_nodes:
-                                if node.title != node_titles[str(node.public_id)]:
-                                    node.title = node_titles[str(node.public_id)]
-                                    node.save(update_fields=["title"])
-
-                            # 3. Create new nodes that didn't get their content synced yet
-                            for node_id in nodes_in_space - nodes_existing:
-                                node = models.Node(
-                                    public_id=node_id,
-                                    title=node_titles[node_id],
-                                    space=space,
-                                    node_type=models.NodeType.DEFAULT,
-                                )
-
-                                # This is in case the node was synced meanwhile.
-                                try:
-                                    node.graph_document = models.Document.objects.only("id").get(
-                                        public_id=document_event.public_id,
-                                        document_type=models.DocumentType.GRAPH,
-                                    )
-                                except models.Document.DoesNotExist:
-                                    pass
-
-                                try:
-                                    node.editor_document = models.Document.objects.only("id").get(
-                                        public_id=document_event.public_id,
-                                        document_type=models.DocumentType.EDITOR,
-                                    )
-                                except models.Document.DoesNotExist:
-                                    pass
-
-                                node.save()
-
-                        elif document_event.action == models.DocumentEvent.EventType.DELETE:
-                            logger.warning(
-                                f"Deletion event for {document_event.public_id} received. "
-                                "Ignoring..."
-                            )
-                        else:
-                            logger.warning(
-                                f"Unknown action {document_event.action} for "
-                                f"{document_event.public_id} received. ignoring..."
-                            )
-
-                    elif document_event.document_type == models.DocumentType.GRAPH:
-                        if document_event.action in (
-                            models.DocumentEvent.EventType.INSERT,
-                            models.DocumentEvent.EventType.UPDATE,
-                        ):
-                            if not document_event.new_data:
-                                logger.error(
-                                    f"Graph Event {document_event.public_id} has no data. "
-                                    "Ignoring..."
-                                )
-                                continue
-
-                            # 1. Get or create the parent node
-                            try:
-                                node = models.Node.all_objects.select_for_update(no_key=True).get(
-                                    public_id=document_event.public_id
-                                )
-                            except models.Node.DoesNotExist:
-                                node = models.Node.objects.create(
-                                    public_id=document_event.public_id,
-                                    node_type=models.NodeType.DEFAULT,
-                                )
-
-                            if not node.graph_document:
-                                try:
-                                    node.graph_document = models.Document.objects.only("id").get(
-                                        public_id=document_event.public_id,
-                                        document_type=models.DocumentType.GRAPH,
-                                    )
-                                except models.Document.DoesNotExist:
-                                    pass
-                                else:
-                                    # TODO: Remove duplicate save
-                                    node.save(update_fields=["graph_document"])
-
-                            # 2. Set subnodes
-
-                            for node_id in document_event.new_data.get("nodes", []):
-                                try:
-                                    subnode = models.Node.all_objects.select_for_update(
-                                        no_key=True
-                                    ).get(public_id=node_id)
-                                except models.Node.DoesNotExist:
-                                    subnode = models.Node.objects.create(
-                                        public_id=node_id, node_type=models.NodeType.DEFAULT
-                                    )
-                                node.subnodes.add(subnode)
-
-                        elif document_event.action == models.DocumentEvent.EventType.DELETE:
-                            logger.warning(
-                                f"Deletion event for {document_event.public_id} received. "
-                                "Ignoring..."
-                            )
-                        else:
-                            logger.warning(
-                                f"Unknown action {document_event.action} for "
-                                f"{document_event.public_id} received. ignoring..."
-                            )
-                    elif document_event.document_type == models.DocumentType.METHOD_GRAPH:
-                        if document_event.action in (
-                            models.DocumentEvent.EventType.INSERT,
-                            models.DocumentEvent.EventType.UPDATE,
-                        ):
-                            # 1. Get or create the parent node
-                            try:
-                                node = models.Node.all_objects.select_for_update(no_key=True).get(
-                                    public_id=document_event.public_id
-                                )
-                            except models.Node.DoesNotExist:
-                                node = models.Node.objects.create(
-                                    public_id=document_event.public_id,
-                                    node_type=models.NodeType.METHOD,
-                                )
-
-                            if not node.graph_document:
-                                try:
-                                    node.graph_document = models.Document.objects.only("id").get(
-                                        public_id=document_event.public_id,
-                                        document_type=models.DocumentType.METHOD_GRAPH,
-                                    )
-                                except models.Document.DoesNotExist:
-                                    pass
-                                else:
-                                    # TODO: Remove duplicate save
-                                    node.save(update_fields=["graph_document"])
-
-                        elif document_event.action == models.DocumentEvent.EventType.DELETE:
-                            logger.warning(
-                                f"Deletion event for {document_event.public_id} received. "
-                                "Ignoring..."
-                            )
-                        else:
-                            logger.warning(
-                                f"Unknown action {document_event.action} for "
-                                f"{document_event.public_id} received. ignoring..."
-                            )
-            except Exception as e:
-                logger.exception(f"Error processing event {document_event.pk}: {e}")
-                if raise_exception:
-                    raise
-                continue
-            finally:
-                document_event.delete()
+
+
+@shared_task(ignore_result=True, expires=settings.NODE_CRDT_EVENTS_RETRY_INTERVAL)
+def retry_failed_document_events(batch_size: int | None = None) -> None:
+    """
+    Retry the failed document events that are due, in batches of `batch_size` events.
+    Events that fail again are retried with an exponential backoff until they failed
+    `NODE_CRDT_EVENTS_MAX_ATTEMPTS` times.
+    """
+    batch_size = batch_size or settings.NODE_CRDT_EVENTS_BATCH_SIZE
+    while True:
+        with pglock.advisory("retry_failed_document_events_task", xact=True):
+            now = timezone.now()
+            failed_events = list(
+                models.FailedDocumentEvent.objects.filter(next_retry_at__lte=now)
+                .select_for_update(skip_locked=True)
+                .order_by("event_id")[:batch_size]
+            )
+            if not failed_events:
+                return
+
+            failures = sync.process_events(
+                [failed_event.as_event() for failed_event in failed_events]
+            )
+
+            # The events that failed again count another attempt, the others are done.
+            sync.dead_letter_events(failures)
+            failed_event_ids = {event.pk for event, _ in failures}
+            models.FailedDocumentEvent.objects.filter(
+                pk__in=[
+                    failed_event.pk
+                    for failed_event in failed_events
+                    if failed_event.event_id not in failed_event_ids
+                ]
+            ).delete()
+            logger.info(
+                f"Retried {len(failed_events)} failed document events, {len(failures)} failed again"
+            )
+
+
+@shared_task(ignore_result=True, expires=settings.NODE_CRDT_EVENTS_PARTITION_INTERVAL)
+def maintain_document_event_partitions() -> None:
+    """
+    Create the partitions of the document events table for the following days and drop the empty
+    partitions of past days.
+    """
+
+    today = timezone.now().date()
+    created = partitions.create_partitions(today, settings.NODE_CRDT_EVENTS_PARTITIONS_AHEAD)
+    dropped = partitions.drop_partitions(today)
+    if created or dropped:
+        logger.info(f"Created {len(created)} and dropped {len(dropped)} document event partitions")
 
 
 @shared_task(ignore_result=True, expires=settings.NODE_VERSIONING_INTERVAL * 5)
-def document_versioning() -> None:
+def document_versioning(batch_size: int | None = None) -> None:
     """
-    Save a snapshot of all documents if they were changed within the last interval.
+    Save a snapshot of all documents that changed since their last version and weren't changed
+    within the last interval. New documents get their first version right away.
+
+    The documents that changed are queued by a database trigger. The hashes are compared in the
+    database, so only the data of documents that differ from their last version is loaded. The
+    versions are built (and large ones uploaded to the blob storage) outside of a transaction and
+    without locking the documents, only storing the versions and removing the queue entries
+    locks the entries. An entry is only removed if the document didn't change in the meantime,
+    otherwise it stays queued for the next run.
     """
 
-    now = timezone.now()
-    threshold_time = now - timedelta(seconds=settings.NODE_VERSIONING_INTERVAL)
-    lower_threshold_time = threshold_time - timedelta(days=1)
-
-    # Fetch document versions that were created outside the current interval. Doing the query this
-    # way around means we have to do another one for documents without versions, but this is by
-    # far the fastest query I could find.
-    # TODO: Still add fitting indices for this query to the database. The number of DocumentVersion
-    #       objects will grow very fast.
-    # TODO: Consider using a different approach where we calculate the sha256 hash of the document
-    #       and compare it to the hash stored in the database. This would be faster, but we would
-    #       have to store the hash in the database and calculate it on every save.
-    # Note: We added a lower threshold time to the query to avoid fetching documents checking
-    #       documents that weren't update recently. This became necessary because the query was
-    #       taking too long to execute. However this will cause problems if the task is not run
-    #       for a long time.
-    latest_versions = (
-        models.DocumentVersion.available_objects.order_by("document_id", "-created_at")
-        .distinct("document_id")
-        .select_related("document")
-        .filter(
-            document__updated_at__lt=threshold_time, document__updated_at__gt=lower_threshold_time
+    batch_size = batch_size or settings.NODE_VERSIONING_BATCH_SIZE
+    threshold_time = timezone.now() - timedelta(seconds=settings.NODE_VERSIONING_INTERVAL)
+
+    latest_version = models.DocumentVersion.available_objects.filter(
+        document=OuterRef("document_id")
+    ).order_by("-created_at")
+    # The queue drives the query, the documents are joined by their primary key and `updated_at` is
+    # only checked on the joined rows, so it doesn't need an index.
+    pending_documents = (
+        models.PendingDocumentVersion.objects.filter(
+            Q(document__updated_at__lt=threshold_time)
+            | ~Exists(models.DocumentVersion.objects.filter(document=OuterRef("document_id")))
+        )
+        .annotate(latest_hash=Subquery(latest_version.values("json_hash")[:1]))
+        .annotate(
+            # The document might have been changed back to its last version.
+            changed=ExpressionWrapper(
+                ~Q(latest_hash=F("json_hash"), latest_hash__isnull=False),
+                output_field=BooleanField(),
+            ),
+            latest_keyframe_id=Subquery(
+                latest_version.values(keyframe_or_self=Coalesce("keyframe_id", "id"))[:1]
+            ),
         )
-        .only("document__document_type", "document__data", "document__json", "json_hash")
+        .order_by("queued_at", "document_id")
     )
 
-    for version in latest_versions:
-        document_hash = sha256(str(version.document.json).encode()).hexdigest()
-        if version.json_hash != document_hash:
-            version.document.versions.create(
-                data=version.document.data,
-                json_hash=document_hash,
-                document_type=version.document.document_type,
+    last_queued: tuple[datetime, int] | None = None
+    while True:
+        # Entries that are kept because their document changed are skipped until the next run.
+        if last_queued is not None:
+            pending_documents = pending_documents.filter(
+                Q(queued_at__gt=last_queued[0])
+                | Q(queued_at=last_queued[0], document_id__gt=last_queued[1])
             )
-
-    # Fetch documents without versions and create a version for them
-    for document in models.Document.objects.filter(versions__isnull=True):
-        document.versions.create(
-            data=document.data,
-            json_hash=sha256(str(document.json).encode()).hexdigest(),
-            document_type=document.document_type,
+        batch = list(
+            pending_documents.values_list(
+                "document_id", "queued_at", "json_hash", "changed", "latest_keyframe_id"
+            )[:batch_size]
+        )
+        if not batch:
+            break
+        last_queued = batch[-1][1], batch[-1][0]
+
+        keyframe_ids = {
+            document_id: keyframe_id
+            for document_id, _, _, changed, keyframe_id in batch
+            if changed and keyframe_id
+        }
+        keyframes = models.DocumentVersion.objects.annotate(delta_count=Count("deltas")).in_bulk(
+            set(keyframe_ids.values())
+        )
+        versions = [
+            _new_document_version(document, keyframes.get(keyframe_ids.get(document.pk)))
+            for document in models.Document.objects.filter(
+                pk__in=[document_id for document_id, _, _, changed, _ in batch if changed]
+            ).only("document_type", "data", "json_hash")
+        ]
+        # Large payloads are offloaded to the blob storage.
+        payloads = {
+            version.document_id: bytes(version.data)
+            for version in versions
+            if len(version.data) >= settings.NODE_VERSIONING_INLINE_THRESHOLD
+        }
+        for version in versions:
+            if version.document_id in payloads:
+                version.blob_key = blobs.save(payloads[version.document_id])
+                version.data = b""
+
+        # The hash of a document is the one of its new version, or of its latest version if it
+        # didn't change.
+        handled_hashes = {document_id: json_hash for document_id, _, json_hash, _, _ in batch}
+        handled_hashes |= {version.document_id: version.json_hash for version in versions}
+        # The lock keeps pruning from deleting the blobs of the new versions until they are stored.
+        with pglock.advisory(VERSION_BLOBS_LOCK, xact=True):
+            # Locking the entries makes concurrent changes of the documents wait until the entries
+            # are removed, so they queue the documents again instead of updating a removed entry.
+            # Entries that are locked are being handled by another task.
+            locked = dict(
+                models.PendingDocumentVersion.objects.filter(document_id__in=handled_hashes)
+                .select_for_update(skip_locked=True)
+                .values_list("document_id", "json_hash")
+            )
+            new_versions = [version for version in versions if version.document_id in locked]
+            # Pruning might have deleted a blob with the same payload since it was stored.
+            for version in new_versions:
+                if version.blob_key:
+                    version.blob_key = blobs.save(payloads[version.document_id])
+            models.DocumentVersion.objects.bulk_create(new_versions)
+            models.PendingDocumentVersion.objects.filter(
+                document_id__in=[
+                    document_id
+                    for document_id, json_hash in locked.items()
+                    if json_hash == handled_hashes[document_id]
+                ]
+            ).delete()
+        if len(batch) < batch_size:
+            break
+
+
+def _new_document_version(
+    document: models.Document, keyframe: models.DocumentVersion | None
+) -> models.DocumentVersion:
+    """
+    Build a version of the document, stored as a delta to the keyframe of its previous version if
+    that is small enough and otherwise as a new keyframe.
+    """
+    data = bytes(document.data)
+    version = models.DocumentVersion(
+        document=document,
+        json_hash=document.json_hash,
+        document_type=document.document_type,
+        size=len(data),
+    )
+    if keyframe is not None and keyframe.delta_count < settings.NODE_VERSIONING_KEYFRAME_INTERVAL:
+        keyframe_payload = keyframe.get_payload()
+        delta = versioning.diff(data, versioning.decompress(keyframe.encoding, keyframe_payload))
+        # Once the document drifted too far from the keyframe, a new keyframe is cheaper.
+        if len(delta) <= len(keyframe_payload) * KEYFRAME_DELTA_RATIO:
+            version.encoding = models.DocumentVersion.Encoding.DELTA
+            version.data = delta
+            version.keyframe = keyframe
+    if version.keyframe is None:
+        version.encoding, version.data = versioning.compress(
+            data, settings.NODE_VERSIONING_COMPRESSION_THRESHOLD
         )
+    return version
+
+
+@shared_task(ignore_result=True, expires=settings.NODE_VERSIONING_RETENTION_INTERVAL)
+def prune_document_versions(batch_size: int | None = None) -> int:
+    """
+    Delete the document versions that the retention policy doesn't keep, see
+    `nodes.versioning.validate_retention_policy`. Spaces can override the policy for their own
+    document and the documents of their nodes. Returns the number of reclaimed bytes.
+    """
+
+    batch_size = batch_size or settings.NODE_VERSIONING_RETENTION_BATCH_SIZE
+    now = timezone.now()
+    # Documents with a single version have nothing to prune.
+    document_ids_with_versions = (
+        models.DocumentVersion.objects.values("document_id")
+        .annotate(version_count=Count("id"))
+        .filter(version_count__gt=1)
+        .order_by("document_id")
+        .values_list("document_id", flat=True)
+    )
+
+    pruned_versions = reclaimed_bytes = 0
+    last_document_id = 0
+    while document_ids := list(
+        document_ids_with_versions.filter(document_id__gt=last_document_id)[:batch_size]
+    ):
+        last_document_id = document_ids[-1]
+        policies = _retention_policies(document_ids)
+
+        versions: dict[int, list[tuple[int, datetime, int | None]]] = defaultdict(list)
+        sizes = {}
+        blob_keys = {}
+        for version_id, document_id, created_at, keyframe_id, size, blob_key in (
+            models.DocumentVersion.objects.filter(document_id__in=document_ids)
+            .annotate(stored_size=Length("data"))
+            .values_list(
+                "id", "document_id", "created_at", "keyframe_id", "stored_size", "blob_key"
+            )
+        ):
+            versions[document_id].append((version_id, created_at, keyframe_id))
+            sizes[version_id] = size
+            if blob_key:
+                blob_keys[version_id] = blob_key
+
+        pruned = []
+        for document_id, document_versions in versions.items():
+            retained = versioning.retained_versions(
+                document_versions,
+                policies.get(document_id, settings.NODE_VERSIONING_RETENTION),
+                now,
+            )
+            pruned += [version[0] for version in document_versions if version[0] not in retained]
+        if not pruned:
+            continue
+
+        # The lock keeps new versions from referring to the blobs while they are deleted.
+        with pglock.advisory(VERSION_BLOBS_LOCK, xact=True):
+            # Deleting with a single statement instead of the ORM avoids loading the versions, and
+            # keyframes can be deleted along with their deltas.
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"DELETE FROM {models.DocumentVersion._meta.db_table} WHERE id = ANY(%s)",
+                    [pruned],
+                )
+            pruned_versions += len(pruned)
+            reclaimed_bytes += sum(sizes[version_id] for version_id in pruned)
+
+            # Blobs are shared by versions with the same payload, only delete unreferenced ones.
+            if pruned_blob_keys := {
+                blob_keys[version_id] for version_id in pruned if version_id in blob_keys
+            }:
+                pruned_blob_keys -= set(
+                    models.DocumentVersion.objects.filter(
+                        blob_key__in=pruned_blob_keys
+                    ).values_list("blob_key", flat=True)
+                )
+                reclaimed_bytes += blobs.delete(pruned_blob_keys)
+
+    logger.info(f"Pruned {pruned_versions} document versions, reclaimed {reclaimed_bytes} bytes")
+    return reclaimed_bytes
+
+
+def _retention_policies(document_ids: list[int]) -> dict[int, list[list[int | None]]]:
+    """Return the retention policies of the spaces that override it, by document ID."""
+    policies = dict(
+        models.Space.all_objects.filter(
+            document_id__in=document_ids, version_retention__isnull=False
+        ).values_list("document_id", "version_retention")
+    )
+    for editor_document_id, graph_document_id, policy in models.Node.all_objects.filter(
+        Q(editor_document_id__in=document_ids) | Q(graph_document_id__in=document_ids),
+        space__version_retention__isnull=False,
+    ).values_list("editor_document_id", "graph_document_id", "space__version_retention"):
+        for document_id in (editor_document_id, graph_document_id):
+            if document_id is not None:
+                policies[document_id] = policy
+    return policies
@@ -0,0 +1,68 @@
+import io
+from unittest import mock
+
+from django.apps import apps
+from django.core.management import CommandError, call_command
+
+from nodes import models
+from nodes.management.commands import benchmark_document_events
+from utils.testcases import BaseTransactionTestCase
+
+
+class BenchmarkDocumentEventsTestCase(BaseTransactionTestCase):
+    @staticmethod
+    def _row_counts() -> dict[str, int]:
+        return {model._meta.label: model._base_manager.count() for model in apps.get_models()}
+
+    def test_benchmark(self) -> None:
+        """Test that the benchmark reports its results and cleans up after itself."""
+        row_counts = self._row_counts()
+        out = io.StringIO()
+        call_command(
+            "benchmark_document_events",
+            edits=30,
+            documents=8,
+            size=5,
+            seed=1,
+            force=True,
+            stdout=out,
+        )
+
+        output = out.getvalue()
+        self.assertIn("Edits:              30", output)
+        self.assertIn("edits/s", output)
+        self.assertIn("Lag p99", output)
+        self.assertIn("Failed events:      0", output)
+        self.assertFalse(models.Document.objects.exists())
+        self.assertFalse(models.DocumentEvent.objects.exists())
+        self.assertFalse(models.Node.all_objects.exists())
+        self.assertFalse(models.Space.all_objects.exists())
+        self.assertEqual(self._row_counts(), row_counts)
+
+    def test_benchmark_cleans_up_after_failure(self) -> None:
+        """Test that the benchmark cleans up after itself when processing the events fails."""
+        row_counts = self._row_counts()
+        with (
+            mock.patch.object(
+                benchmark_document_events.Command,
+                "_process",
+                side_effect=[None, RuntimeError("processing failed")],
+            ),
+            self.assertRaises(RuntimeError),
+        ):
+            call_command(
+                "benchmark_document_events",
+                edits=30,
+                documents=8,
+                size=5,
+                seed=1,
+                force=True,
+                stdout=io.StringIO(),
+            )
+
+        self.assertEqual(self._row_counts(), row_counts)
+
+    def test_benchmark_requires_force(self) -> None:
+        """Test that the benchmark doesn't write to the database by accident."""
+        with self.assertRaises(CommandError):
+            call_command("benchmark_document_events", edits=1)
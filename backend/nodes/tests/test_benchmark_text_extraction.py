@@ -0,0 +1,35 @@
+import io
+import json
+import tempfile
+
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase
+
+from nodes.tests import fixtures
+
+
+class BenchmarkTextExtractionTestCase(SimpleTestCase):
+    def test_benchmark(self) -> None:
+        """Test that the benchmark compares the implementations on synthetic content."""
+        out = io.StringIO()
+        call_command("benchmark_text_extraction", paragraphs=10, depth=5, repeat=1, stdout=out)
+
+        output = out.getvalue()
+        self.assertIn("synthetic (10 paragraphs, depth 5)", output)
+        for implementation in ("recursive", "iterative", "first fragment", "token budget"):
+            self.assertIn(f"  {implementation}", output)
+        self.assertIn("fragments              36", output)
+
+    def test_benchmark_file(self) -> None:
+        """Test that the benchmark runs on exported editor content."""
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as file:
+            json.dump(fixtures.EDITOR_WITH_NODES, file)
+            file.flush()
+            out = io.StringIO()
+            call_command("benchmark_text_extraction", file=[file.name], repeat=1, stdout=out)
+        self.assertIn(file.name, out.getvalue())
+        self.assertIn("fragments               3", out.getvalue())
+
+    def test_benchmark_missing_file(self) -> None:
+        with self.assertRaises(CommandError):
+            call_command("benchmark_text_extraction", file=["/nonexistent.json"])
@@ -1,8 +1,10 @@
 from itertools import chain
+from unittest import mock
 
 import permissions.models
 from nodes import models
 from nodes.tests import factories
+from utils import tokens
 from utils.testcases import BaseTestCase
 
 
@@ -60,13 +62,57 @@ class NodeModelTestCase(BaseTestCase):
         node = factories.NodeFactory()
         node.subnodes.add(*second_level_subnodes)
 
-        with self.assertNumQueries(4):
+        with self.assertNumQueries(2):
             nodes_at_depth = node.fetch_subnodes(2)
             self.assertEqual(len(nodes_at_depth[0]), 1)
             self.assertEqual(len(nodes_at_depth[1]), 3)
             self.assertEqual(len(nodes_at_depth[2]), 9)
             self.assertNotIn(3, nodes_at_depth)
 
+    def test_subnode_fetching_graph(self) -> None:
+        """Test that cycles, shared and removed subnodes are fetched like level by level."""
+        node = factories.NodeFactory.create()
+        shared_subnode, removed_subnode = factories.NodeFactory.create_batch(2)
+        second_level_subnodes = factories.NodeFactory.create_batch(2)
+        node.subnodes.add(*second_level_subnodes, removed_subnode)
+        removed_subnode.subnodes.add(factories.NodeFactory.create())
+        removed_subnode.delete()
+        for subnode in second_level_subnodes:
+            subnode.subnodes.add(shared_subnode)
+        shared_subnode.subnodes.add(node)
+
+        with self.assertNumQueries(2):
+            nodes_at_depth = node.fetch_subnodes(5)
+        self.assertListEqual(
+            [{subnode.pk for subnode in nodes} for nodes in nodes_at_depth.values()],
+            [
+                {node.pk},
+                {subnode.pk for subnode in second_level_subnodes},
+                {shared_subnode.pk},
+                {node.pk},
+                {subnode.pk for subnode in second_level_subnodes},
+                {shared_subnode.pk},
+            ],
+        )
+        self.assertEqual(len(nodes_at_depth[2]), 1)
+        # Removed subnodes are listed as connections, but not followed.
+        self.assertCountEqual(
+            node.subnode_public_ids,
+            [subnode.public_id for subnode in [*second_level_subnodes, removed_subnode]],
+        )
+        self.assertListEqual(nodes_at_depth[2][0].subnode_public_ids, [node.public_id])
+        # Nodes appear at several depths, but are the same instance.
+        self.assertIs(nodes_at_depth[5][0], nodes_at_depth[2][0])
+
+        # Subnodes of nodes that weren't expanded are queried.
+        nodes_at_depth = node.fetch_subnodes(2)
+        self.assertIsNone(nodes_at_depth[2][0].subnode_public_ids)
+        with self.assertNumQueries(1):
+            self.assertIn(
+                str(node.public_id),
+                nodes_at_depth[2][0].node_as_str(include_content=False, include_connections=True),
+            )
+
     def test_node_as_str(self) -> None:
         node = factories.NodeFactory.create(title="test", text="test text")
         self.assertEqual(
@@ -141,7 +187,8 @@ class NodeModelTestCase(BaseTestCase):
             self.assertIn(subnode.title.replace("\n", " "), context)
             self.assertNotIn(subnode.text.replace("\n", " "), context)
 
-        context = node.node_context_for_depth(3)
+        with self.assertNumQueries(2):
+            context = node.node_context_for_depth(3)
         self.assertIn(
             node.node_as_str(include_content=True, include_connections=False) + "\n", context
         )
@@ -175,6 +222,138 @@ class NodeModelTestCase(BaseTestCase):
         # to specify its content.
         self.assertEqual(context.count(str(third_level_subnode.public_id)), 3)
 
+    def test_node_context_cache(self) -> None:
+        """The context is cached until a node in the subgraph or a connection changes."""
+        subnodes = factories.NodeFactory.create_batch(2)
+        subsubnode = factories.NodeFactory.create()
+        subnodes[0].subnodes.add(subsubnode)
+        node = factories.NodeFactory()
+        node.subnodes.add(*subnodes)
+
+        context = node.node_context_for_depth(2)
+        # Only the subgraph is walked to check the revisions.
+        with self.assertNumQueries(1):
+            self.assertEqual(node.node_context_for_depth(2), context)
+
+        subsubnode.title = "changed title"
+        subsubnode.save()
+        context = node.node_context_for_depth(2)
+        self.assertIn("changed title", context)
+
+        # Saving without changes or from a stale instance keeps the revision.
+        revision = models.Node.objects.get(pk=subsubnode.pk).revision
+        models.Node.objects.filter(pk=subsubnode.pk).update(revision=0)
+        self.assertEqual(models.Node.objects.get(pk=subsubnode.pk).revision, revision)
+
+        subnodes[1].subnodes.add(subsubnode)
+        context = node.node_context_for_depth(2)
+        self.assertEqual(context.count(str(subsubnode.public_id)), 3)
+
+        subnodes[0].delete()
+        context = node.node_context_for_depth(2)
+        self.assertNotIn(f"({subnodes[0].public_id})", context)
+
+    def test_node_context_for_budget(self) -> None:
+        """The context is expanded best-first until the token budget is used up."""
+        node = factories.NodeFactory()
+        subnodes = factories.NodeFactory.create_batch(3)
+        node.subnodes.add(*subnodes)
+        subsubnodes = factories.NodeFactory.create_batch(3)
+        subnodes[0].subnodes.add(*subsubnodes)
+
+        context, used_tokens = node.node_context_for_budget(100_000)
+        self.assertEqual(tokens.token_count(context), used_tokens)
+        for subnode in chain(subnodes, subsubnodes):
+            self.assertIn(
+                subnode.node_as_str(include_content=True, include_connections=False), context
+            )
+
+        # The titles of the nodes at a depth come before their content, and closer nodes before
+        # further ones.
+        token_budget = tokens.token_count(
+            node.node_as_str(include_content=True, include_connections=True) + "\n"
+        ) + sum(
+            tokens.token_count(
+                subnode.node_as_str(include_content=False, include_connections=False) + "\n"
+            )
+            for subnode in subnodes
+        )
+        context, used_tokens = node.node_context_for_budget(token_budget)
+        self.assertEqual(tokens.token_count(context), used_tokens)
+        self.assertLessEqual(used_tokens, token_budget)
+        self.assertTrue(
+            context.startswith(node.node_as_str(include_content=True, include_connections=True))
+        )
+        for subnode in subnodes:
+            self.assertIn(
+                subnode.node_as_str(include_content=False, include_connections=False) + "\n",
+                context,
+            )
+            self.assertNotIn(subnode.text.replace("\n", " "), context)
+        for subnode in subsubnodes:
+            self.assertNotIn(str(subnode.public_id), context)
+
+        self.assertEqual(node.node_context_for_budget(0), ("", 0))
+
+    def test_node_context_for_budget_fits(self) -> None:
+        """The whole context never exceeds the budget, including the separators of the nodes."""
+        node = factories.NodeFactory()
+        subnodes = factories.NodeFactory.create_batch(5)
+        node.subnodes.add(*subnodes)
+        for subnode in subnodes:
+            subnode.subnodes.add(*factories.NodeFactory.create_batch(3))
+
+        full_context, full_tokens = node.node_context_for_budget(100_000)
+        for token_budget in range(1, full_tokens + 1, 7):
+            with mock.patch.object(tokens, "token_count", wraps=tokens.token_count) as token_count:
+                context, used_tokens = node.node_context_for_budget(token_budget)
+            # The whole context is counted once, and again at most once if it doesn't fit.
+            self.assertLessEqual(token_count.call_count, 2)
+            self.assertLessEqual(tokens.token_count(context), token_budget)
+            self.assertEqual(tokens.token_count(context), used_tokens)
+
+    def test_node_context_for_budget_merged_tokens(self) -> None:
+        """Nodes are left out by their own counts if the whole context counts more tokens."""
+        node = factories.NodeFactory()
+        node.subnodes.add(*factories.NodeFactory.create_batch(20))
+        _, full_tokens = node.node_context_for_budget(100_000)
+
+        token_count = tokens.token_count
+        with mock.patch.object(
+            tokens, "token_count", side_effect=lambda text, model: token_count(text, model) + 50
+        ) as mock_token_count:
+            context, used_tokens = node.node_context_for_budget(full_tokens)
+
+        self.assertEqual(mock_token_count.call_count, 2)
+        self.assertEqual(used_tokens, token_count(context) + 50)
+        self.assertLessEqual(used_tokens, full_tokens)
+        self.assertTrue(context)
+
+    def test_node_context_for_budget_prerequisites(self) -> None:
+        """Prerequisites come first among the nodes at the same depth."""
+        node = factories.NodeFactory()
+        subnodes = factories.NodeFactory.create_batch(3)
+        node.subnodes.add(*subnodes)
+        node.graph_document = factories.DocumentFactory.create(
+            json={
+                "edges": {
+                    "edge": {
+                        "source": str(subnodes[2].public_id),
+                        "target": str(subnodes[0].public_id),
+                    }
+                }
+            }
+        )
+        node.save()
+
+        context, _ = node.node_context_for_budget(100_000, include_edges=True)
+        positions = [context.index(f"({subnode.public_id})") for subnode in subnodes]
+        self.assertLess(positions[2], positions[0])
+        self.assertLess(positions[2], positions[1])
+        self.assertIn(
+            f"This node is a prerequisite for these nodes: {subnodes[0].public_id}", context
+        )
+
 
 class MethodNodeModelTestCase(BaseTestCase):
     def test_role_annotation_query_owner(self) -> None:
@@ -196,3 +375,20 @@ class MethodNodeModelTestCase(BaseTestCase):
         self.assertEqual(fetched_node, node)
         assert fetched_node is not None
         self.assertEqual(fetched_node.user_roles, [permissions.models.VIEWER])
+
+
+class DocumentModelTestCase(BaseTestCase):
+    def test_json_hash(self) -> None:
+        document = factories.DocumentFactory.create(json={"test": "data"})
+        document.refresh_from_db()
+        self.assertEqual(len(document.json_hash), 64)
+
+        # The hash is only recomputed when the JSON changes.
+        json_hash = document.json_hash
+        models.Document.objects.filter(pk=document.pk).update(data=b"new data")
+        document.refresh_from_db()
+        self.assertEqual(document.json_hash, json_hash)
+
+        models.Document.objects.filter(pk=document.pk).update(json={"new": "data"})
+        document.refresh_from_db()
+        self.assertNotEqual(document.json_hash, json_hash)
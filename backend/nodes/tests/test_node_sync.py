@@ -1,6 +1,14 @@
+import datetime
+import typing
 import uuid
+from unittest import mock
 
-from nodes import models, tasks
+from django.db import connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from nodes import models, sync, tasks
 from nodes.tests import factories, fixtures
 from utils.testcases import BaseTransactionTestCase
 
@@ -17,6 +25,82 @@ class NodeEventTestCase(BaseTransactionTestCase):
 
         self.assertEqual(models.DocumentEvent.objects.count(), 1)
 
+    def test_document_trigger_coalescing(self) -> None:
+        """Test that changes to a document are coalesced into its pending event."""
+        document = factories.DocumentFactory.create(
+            document_type=models.DocumentType.EDITOR, json={"version": 1}
+        )
+        for version in (2, 3):
+            document.json = {"version": version}
+            document.save()
+
+        self.assertEqual(models.DocumentEvent.objects.count(), 1)
+        document_event = models.DocumentEvent.objects.get()
+        self.assertEqual(document_event.action, models.DocumentEvent.EventType.INSERT)
+        self.assertEqual(document_event.new_data, {"version": 3})
+
+        # Once the event is processed, a new event is created for the next change.
+        tasks.process_document_events(raise_exception=True)
+        document.json = {"version": 4}
+        document.save()
+
+        document_event = models.DocumentEvent.objects.get()
+        self.assertEqual(document_event.action, models.DocumentEvent.EventType.UPDATE)
+        self.assertEqual(document_event.document_id, document.pk)
+        self.assertEqual(document_event.new_data, {"version": 4})
+
+    def test_document_trigger_reference_payload(self) -> None:
+        """Test that events in the reference format are processed with the document's JSON."""
+        with connection.cursor() as cursor:
+            cursor.execute(f"SET {models.DOCUMENT_EVENT_PAYLOAD_SETTING} = 'reference'")
+        self.addCleanup(self._reset_payload_setting)
+
+        document = factories.DocumentFactory.create(
+            document_type=models.DocumentType.EDITOR, json=fixtures.EDITOR_WITH_NODES
+        )
+        document.json = fixtures.EDITOR_WITHOUT_NODES
+        document.save()
+
+        document_event = models.DocumentEvent.objects.get()
+        self.assertEqual(document_event.document_id, document.pk)
+        self.assertIsNone(document_event.new_data)
+
+        tasks.process_document_events(raise_exception=True)
+
+        node = models.Node.objects.get(public_id=document.public_id)
+        self.assertEqual(node.content, fixtures.EDITOR_WITHOUT_NODES)
+        self.assertEqual(node.editor_document, document)
+
+    @staticmethod
+    def _reset_payload_setting() -> None:
+        with connection.cursor() as cursor:
+            cursor.execute(f"RESET {models.DOCUMENT_EVENT_PAYLOAD_SETTING}")
+
+    def test_superseded_events(self) -> None:
+        """Test that only the latest event of a document is processed."""
+        public_id = str(uuid.uuid4())
+        for content in (fixtures.EDITOR_WITH_NODES, fixtures.EDITOR_WITHOUT_NODES):
+            factories.DocumentEventFactory.create(
+                public_id=public_id,
+                action="UPDATE",
+                new_data=content,
+                document_type=models.DocumentType.EDITOR,
+            )
+        factories.DocumentEventFactory.create(
+            public_id=public_id,
+            action="DELETE",
+            document_type=models.DocumentType.EDITOR,
+        )
+
+        self.assertEqual(sync.delete_superseded_events(), 1)
+        self.assertEqual(models.DocumentEvent.objects.count(), 2)
+
+        tasks.process_document_events(raise_exception=True)
+
+        node = models.Node.all_objects.get(public_id=public_id)
+        self.assertEqual(node.content, fixtures.EDITOR_WITHOUT_NODES)
+        self.assertEqual(models.DocumentEvent.objects.count(), 0)
+
     def test_node_create(self) -> None:
         """Test that a new node is created."""
         self.assertEqual(models.Node.all_objects.count(), 0)
@@ -37,6 +121,26 @@ class NodeEventTestCase(BaseTransactionTestCase):
         self.assertEqual(models.Node.all_objects.count(), 1)
         self.assertEqual(models.DocumentEvent.objects.count(), 0)
 
+    def test_node_update_sets_updated_at(self) -> None:
+        """Test that updating the content of a node moves its update time forward."""
+        node = factories.NodeFactory.create(content=fixtures.EDITOR_WITH_NODES)
+        models.Node.all_objects.filter(pk=node.pk).update(
+            updated_at=timezone.now() - datetime.timedelta(days=1)
+        )
+        node.refresh_from_db()
+
+        factories.DocumentEventFactory.create(
+            public_id=node.public_id,
+            action="UPDATE",
+            new_data=fixtures.EDITOR_WITHOUT_NODES,
+            document_type=models.DocumentType.EDITOR,
+        )
+        tasks.process_document_events(raise_exception=True)
+
+        updated_node = models.Node.all_objects.get(pk=node.pk)
+        self.assertEqual(updated_node.content, fixtures.EDITOR_WITHOUT_NODES)
+        self.assertGreater(updated_node.updated_at, node.updated_at)
+
     def test_project_create(self) -> None:
         """Test that a new project is created."""
         self.assertEqual(models.Space.available_objects.count(), 0)
@@ -213,3 +317,327 @@ class NodeEventTestCase(BaseTransactionTestCase):
         self.assertIsNotNone(node)
         assert node is not None
         self.assertEqual(node.node_type, models.NodeType.METHOD)
+
+    def test_batch_query_count(self) -> None:
+        """Test that the number of queries doesn't depend on the number of events in a batch."""
+
+        def create_events(count: int) -> None:
+            for _ in range(count):
+                factories.DocumentEventFactory.create(
+                    public_id=str(uuid.uuid4()),
+                    action="UPDATE",
+                    new_data=fixtures.EDITOR_WITH_NODES,
+                    document_type=models.DocumentType.EDITOR,
+                )
+
+        create_events(2)
+        with CaptureQueriesContext(connection) as small_batch:
+            tasks.process_document_events(raise_exception=True)
+
+        create_events(20)
+        with CaptureQueriesContext(connection) as large_batch:
+            tasks.process_document_events(raise_exception=True)
+
+        self.assertEqual(len(small_batch), len(large_batch))
+        self.assertEqual(models.Node.all_objects.count(), 22)
+        self.assertEqual(models.DocumentEvent.objects.count(), 0)
+        self.assertFalse(models.Node.all_objects.filter(text_token_count__isnull=True).exists())
+
+    def test_space_reconciliation(self) -> None:
+        """Test that space events update titles and memberships with a constant query count."""
+        space = factories.SpaceFactory.create()
+
+        def sync_space(titles: dict[str, str]) -> CaptureQueriesContext:
+            factories.DocumentEventFactory.create(
+                public_id=space.public_id,
+                action="UPDATE",
+                new_data={
+                    "nodes": {
+                        node_id: {"id": node_id, "title": title}
+                        for node_id, title in titles.items()
+                    }
+                },
+                document_type=models.DocumentType.SPACE,
+            )
+            with CaptureQueriesContext(connection) as queries:
+                tasks.process_document_events(raise_exception=True)
+            return queries
+
+        small_space = {str(uuid.uuid4()): "Title" for _ in range(2)}
+        large_space = {str(uuid.uuid4()): "Title" for _ in range(20)}
+        sync_space(small_space)
+        sync_space(large_space)
+        # Change all titles and swap the nodes of the space.
+        small_queries = sync_space(dict.fromkeys(small_space, "A new title"))
+        large_queries = sync_space(dict.fromkeys(large_space, "A new title"))
+
+        self.assertEqual(len(small_queries), len(large_queries))
+        self.assertEqual(space.nodes.count(), 20)
+        self.assertFalse(
+            models.Node.all_objects.filter(public_id__in=small_space, space__isnull=False).exists()
+        )
+        for node in space.nodes.all():
+            self.assertEqual(node.title, "A new title")
+            self.assertEqual(node.title_token_count, 3)
+
+    def test_graph_reconciliation(self) -> None:
+        """Test that graph events set the exact subnodes with a constant query count."""
+        graph_id = str(uuid.uuid4())
+
+        def sync_graph(subnode_ids: list[str]) -> CaptureQueriesContext:
+            factories.DocumentEventFactory.create(
+                public_id=graph_id,
+                action="UPDATE",
+                new_data={"nodes": {node_id: {"id": node_id} for node_id in subnode_ids}},
+                document_type=models.DocumentType.GRAPH,
+            )
+            with CaptureQueriesContext(connection) as queries:
+                tasks.process_document_events(raise_exception=True)
+            return queries
+
+        small_graph = [str(uuid.uuid4()) for _ in range(2)]
+        large_graph = [str(uuid.uuid4()) for _ in range(20)]
+        # Create the graph's node first, so that both syncs run the same queries.
+        sync_graph([])
+        small_queries = sync_graph(small_graph)
+        large_queries = sync_graph(small_graph[:1] + large_graph)
+
+        self.assertEqual(len(small_queries), len(large_queries))
+        node = models.Node.all_objects.get(public_id=graph_id)
+        # The node that was removed from the graph is no longer a subnode.
+        self.assertSetEqual(
+            {str(public_id) for public_id in node.subnodes.values_list("public_id", flat=True)},
+            set(small_graph[:1] + large_graph),
+        )
+
+        sync_graph([])
+        self.assertFalse(node.subnodes.exists())
+
+    def test_batch_size(self) -> None:
+        """Test that all events are processed if there are more events than the batch size."""
+        for _ in range(5):
+            factories.DocumentEventFactory.create(
+                public_id=str(uuid.uuid4()),
+                action="INSERT",
+                new_data=fixtures.EDITOR_WITHOUT_NODES,
+                document_type=models.DocumentType.EDITOR,
+            )
+
+        tasks.process_document_events(raise_exception=True, batch_size=2)
+
+        self.assertEqual(models.Node.all_objects.count(), 5)
+        self.assertEqual(models.DocumentEvent.objects.count(), 0)
+
+    @override_settings(NODE_CRDT_EVENTS_MAX_EVENTS=4)
+    @mock.patch.object(tasks.process_document_events, "delay")
+    def test_event_budget(self, mock_delay: mock.Mock) -> None:
+        """Test that the remaining events are left to a new task once the budget is used up."""
+        for _ in range(5):
+            factories.DocumentEventFactory.create(
+                public_id=str(uuid.uuid4()),
+                action="INSERT",
+                new_data=fixtures.EDITOR_WITHOUT_NODES,
+                document_type=models.DocumentType.EDITOR,
+            )
+
+        tasks.process_document_events(raise_exception=True, batch_size=2)
+
+        # The processed batches are committed, the remaining event is left for the next task.
+        self.assertEqual(models.Node.all_objects.count(), 4)
+        self.assertEqual(models.DocumentEvent.objects.count(), 1)
+        mock_delay.assert_called_once_with(raise_exception=True, batch_size=2, shard=None)
+
+        tasks.process_document_events(raise_exception=True, batch_size=2)
+
+        self.assertEqual(models.Node.all_objects.count(), 5)
+        self.assertEqual(models.DocumentEvent.objects.count(), 0)
+        mock_delay.assert_called_once()
+
+    def test_failing_event_in_batch(self) -> None:
+        """Test that a failing event doesn't prevent the other events of a batch from syncing."""
+        document = factories.DocumentFactory.create(document_type=models.DocumentType.EDITOR)
+        # The editor document is already linked to another node, so linking it fails.
+        factories.NodeFactory.create(editor_document=document)
+
+        public_id = str(uuid.uuid4())
+        for event_public_id in (document.public_id, public_id):
+            factories.DocumentEventFactory.create(
+                public_id=event_public_id,
+                action="UPDATE",
+                new_data=fixtures.EDITOR_WITHOUT_NODES,
+                document_type=models.DocumentType.EDITOR,
+            )
+
+        tasks.process_document_events()
+
+        self.assertEqual(models.DocumentEvent.objects.count(), 0)
+        self.assertTrue(models.Node.all_objects.filter(public_id=public_id).exists())
+        self.assertFalse(models.Node.all_objects.filter(public_id=document.public_id).exists())
+
+        # The failed event is kept in the dead-letter table.
+        failed_event = models.FailedDocumentEvent.objects.get()
+        self.assertEqual(str(failed_event.public_id), str(document.public_id))
+        self.assertEqual(failed_event.new_data, fixtures.EDITOR_WITHOUT_NODES)
+        self.assertEqual(failed_event.attempts, 1)
+        self.assertIn("IntegrityError", failed_event.error)
+        self.assertIsNotNone(failed_event.next_retry_at)
+
+    @override_settings(NODE_CRDT_EVENTS_RETRY_BACKOFF=60, NODE_CRDT_EVENTS_MAX_ATTEMPTS=3)
+    def test_retry_failed_events(self) -> None:
+        """Test that failed events are retried with a backoff until they succeed."""
+        document = factories.DocumentFactory.create(document_type=models.DocumentType.EDITOR)
+        other_node = factories.NodeFactory.create(editor_document=document)
+        models.DocumentEvent.objects.all().delete()
+        factories.DocumentEventFactory.create(
+            public_id=document.public_id,
+            action="UPDATE",
+            new_data=fixtures.EDITOR_WITHOUT_NODES,
+            document_type=models.DocumentType.EDITOR,
+        )
+        tasks.process_document_events()
+        failed_events = models.FailedDocumentEvent.objects.all()
+
+        # Events are only retried once they are due.
+        tasks.retry_failed_document_events()
+        self.assertEqual(failed_events.get().attempts, 1)
+
+        failed_events.update(next_retry_at=timezone.now())
+        tasks.retry_failed_document_events()
+        failed_event = failed_events.get()
+        self.assertEqual(failed_event.attempts, 2)
+        self.assertAlmostEqual(
+            (failed_event.next_retry_at - failed_event.last_failed_at).total_seconds(), 120
+        )
+
+        # After the cause of the failure is fixed, the retry succeeds.
+        other_node.editor_document = None
+        other_node.save()
+        failed_events.update(next_retry_at=timezone.now())
+        tasks.retry_failed_document_events()
+
+        self.assertFalse(failed_events.exists())
+        node = models.Node.all_objects.get(public_id=document.public_id)
+        self.assertEqual(node.content, fixtures.EDITOR_WITHOUT_NODES)
+
+    @override_settings(NODE_CRDT_EVENTS_MAX_ATTEMPTS=2)
+    def test_retry_failed_events_gives_up(self) -> None:
+        """Test that failed events aren't retried anymore once they ran out of attempts."""
+        document = factories.DocumentFactory.create(document_type=models.DocumentType.EDITOR)
+        factories.NodeFactory.create(editor_document=document)
+        tasks.process_document_events()
+        failed_events = models.FailedDocumentEvent.objects.all()
+
+        failed_events.update(next_retry_at=timezone.now())
+        tasks.retry_failed_document_events()
+
+        failed_event = failed_events.get()
+        self.assertEqual(failed_event.attempts, 2)
+        self.assertIsNone(failed_event.next_retry_at)
+
+    @override_settings(NODE_CRDT_EVENTS_RETRY_BACKOFF=60, NODE_CRDT_EVENTS_MAX_ATTEMPTS=3)
+    def test_dead_letter_event_again(self) -> None:
+        """Test that an event that is dead-lettered again updates its existing row."""
+        document = factories.DocumentFactory.create(document_type=models.DocumentType.EDITOR)
+        event = models.DocumentEvent.objects.get()
+
+        with transaction.atomic():
+            sync.dead_letter_events([(event, ValueError("first"))])
+        with transaction.atomic():
+            sync.dead_letter_events([(event, ValueError("second"))])
+
+        failed_event = models.FailedDocumentEvent.objects.get()
+        self.assertEqual(failed_event.event_id, event.pk)
+        self.assertEqual(failed_event.document_id, document.pk)
+        self.assertEqual(failed_event.attempts, 2)
+        self.assertIn("second", failed_event.error)
+        self.assertAlmostEqual(
+            (failed_event.next_retry_at - failed_event.last_failed_at).total_seconds(), 120
+        )
+
+    def test_space_event_links_node_documents(self) -> None:
+        """Test that nodes created from a space event are linked to their own documents."""
+        space = factories.SpaceFactory.create()
+        node_id = next(iter(fixtures.SPACE["nodes"]))
+        editor_document = factories.DocumentFactory.create(
+            public_id=node_id, document_type=models.DocumentType.EDITOR
+        )
+        models.DocumentEvent.objects.all().delete()
+
+        factories.DocumentEventFactory.create(
+            public_id=str(space.public_id),
+            action="UPDATE",
+            new_data=fixtures.SPACE,
+            document_type=models.DocumentType.SPACE,
+        )
+
+        tasks.process_document_events(raise_exception=True)
+
+        node = models.Node.all_objects.get(public_id=node_id)
+        self.assertEqual(node.editor_document, editor_document)
+        self.assertEqual(node.space, space)
+        self.assertEqual(node.title, fixtures.SPACE["nodes"][node_id]["title"])
+        self.assertIsNotNone(node.title_token_count)
+
+    def test_space_event_with_concurrently_created_node(self) -> None:
+        """Test that nodes created by another worker meanwhile still get their titles."""
+        space = factories.SpaceFactory.create()
+        node_id = next(iter(fixtures.SPACE["nodes"]))
+        factories.DocumentEventFactory.create(
+            public_id=str(space.public_id),
+            action="UPDATE",
+            new_data=fixtures.SPACE,
+            document_type=models.DocumentType.SPACE,
+        )
+        lock_nodes = sync._lock_nodes
+
+        def create_node_after_locking(*args: typing.Any) -> dict[str, models.Node]:
+            nodes = lock_nodes(*args)
+            factories.NodeFactory.create(public_id=node_id, title=None, title_token_count=None)
+            return nodes
+
+        with mock.patch.object(sync, "_lock_nodes", side_effect=create_node_after_locking):
+            tasks.process_document_events(raise_exception=True)
+
+        node = models.Node.all_objects.get(public_id=node_id)
+        self.assertEqual(node.title, fixtures.SPACE["nodes"][node_id]["title"])
+        self.assertIsNotNone(node.title_token_count)
+        self.assertEqual(node.space, space)
+
+    def test_document_shard(self) -> None:
+        """Test that the shards calculated in Python and in the database match."""
+        for _ in range(20):
+            factories.DocumentEventFactory.create(
+                public_id=str(uuid.uuid4()), action="UPDATE", document_type="EDITOR"
+            )
+
+        for shard in range(3):
+            for document_event in sync.events_for_shard(shard, 3):
+                self.assertEqual(sync.document_shard(document_event.public_id, 3), shard)
+        self.assertEqual(
+            sum(sync.events_for_shard(shard, 3).count() for shard in range(3)),
+            models.DocumentEvent.objects.count(),
+        )
+
+    def test_sharded_processing(self) -> None:
+        """Test that events are only processed by the task of their shard."""
+        public_ids = [str(uuid.uuid4()) for _ in range(10)]
+        for public_id in public_ids:
+            factories.DocumentEventFactory.create(
+                public_id=public_id,
+                action="INSERT",
+                new_data=fixtures.EDITOR_WITHOUT_NODES,
+                document_type=models.DocumentType.EDITOR,
+            )
+
+        with self.settings(NODE_CRDT_EVENTS_SHARDS=2):
+            tasks.process_document_events(raise_exception=True, shard=0)
+            self.assertSetEqual(
+                set(map(str, models.Node.all_objects.values_list("public_id", flat=True))),
+                {public_id for public_id in public_ids if sync.document_shard(public_id, 2) == 0},
+            )
+
+            # Without a shard, a task is enqueued for each shard.
+            tasks.process_document_events(raise_exception=True)
+
+        self.assertEqual(models.Node.all_objects.count(), 10)
+        self.assertEqual(models.DocumentEvent.objects.count(), 0)
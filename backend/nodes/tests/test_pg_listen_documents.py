@@ -0,0 +1,61 @@
+import asyncio
+from unittest import mock
+
+import psycopg
+from django.db import connection
+
+from nodes import models
+from nodes.management.commands import pg_listen_documents
+from utils.testcases import BaseTransactionTestCase
+
+
+class DocumentListenerTestCase(BaseTransactionTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.conninfo = connection.get_connection_params()
+        self.conninfo.pop("cursor_factory", None)
+        self.conninfo.pop("context", None)
+
+    async def _notify(self, count: int) -> None:
+        async with await psycopg.AsyncConnection.connect(
+            **self.conninfo, autocommit=True
+        ) as notify_connection:
+            for _ in range(count):
+                await notify_connection.execute(f"NOTIFY {models.PG_NOTIFY_CHANNEL};")
+
+    async def _run_listener(self, listener: pg_listen_documents.DocumentListener) -> None:
+        task = asyncio.create_task(listener.run())
+        # Give the listener time to connect and dispatch the initial task.
+        await asyncio.sleep(0.5)
+        await self._notify(20)
+        await asyncio.sleep(listener.debounce * 2)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+    @mock.patch("nodes.tasks.process_document_events.delay")
+    def test_debounce(self, mock_delay: mock.Mock) -> None:
+        """Test that a burst of notifications dispatches a single task."""
+        listener = pg_listen_documents.DocumentListener(self.conninfo, debounce=1.0)
+        asyncio.run(self._run_listener(listener))
+
+        self.assertEqual(listener.stats.notifications_received, 20)
+        # One task when connecting and one for the whole burst of notifications.
+        self.assertEqual(listener.stats.tasks_dispatched, 2)
+        self.assertEqual(mock_delay.call_count, 2)
+
+    @mock.patch("nodes.tasks.process_document_events.delay")
+    def test_reconnect(self, mock_delay: mock.Mock) -> None:
+        """Test that the listener reconnects when the connection is lost."""
+        listener = pg_listen_documents.DocumentListener(self.conninfo | {"port": 1}, debounce=0.1)
+
+        async def run() -> None:
+            task = asyncio.create_task(listener.run())
+            await asyncio.sleep(0.5)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+        self.assertEqual(listener.stats.reconnects, 1)
+        mock_delay.assert_not_called()
@@ -1,9 +1,14 @@
-from datetime import timedelta
-from hashlib import sha256
+import uuid
+from datetime import datetime, timedelta
+from unittest import mock
 
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.db.models import RestrictedError
+from django.test import override_settings
 from django.utils import timezone
 
-from nodes import models, tasks
+from nodes import blobs, models, partitions, tasks
 from nodes.tests import factories
 from utils.testcases import BaseTransactionTestCase
 
@@ -14,24 +19,25 @@ class DocumentVersioningTestCase(BaseTransactionTestCase):
         document = factories.DocumentFactory(json={"test": "data"}, data=b"test data")
 
         # Run the task
-        with self.assertNumQueries(3):
-            # Two queries to check and one insert to create the version
+        with self.assertNumQueries(8):
+            # One query to fetch the queued documents and one for the data of the changed ones,
+            # then in a transaction one query for the blob lock, one to lock the queue entries, one
+            # insert to create the version and one query to remove the document from the queue
             tasks.document_versioning()
+        document.refresh_from_db()
 
         # Since there wasn't any previous version, there should be only one version now
         self.assertEqual(models.DocumentVersion.available_objects.count(), 1)
         document_version = models.DocumentVersion.available_objects.all()[0]
 
         self.assertEqual(document_version.document, document)
-        self.assertEqual(document_version.data, b"test data")
-        self.assertEqual(
-            document_version.json_hash, sha256(str(document.json).encode()).hexdigest()
-        )
+        self.assertEqual(document_version.get_data(), b"test data")
+        self.assertEqual(document_version.json_hash, document.json_hash)
         self.assertEqual(document_version.document_type, document.document_type)
 
         # Run the task again
-        with self.assertNumQueries(2):
-            # Only two queries to check and no inserts
+        with self.assertNumQueries(1):
+            # Only one query to check the queue and no inserts
             tasks.document_versioning()
 
         # There should be no new versions since the document hasn't changed and the interval hasn't
@@ -42,6 +48,7 @@ class DocumentVersioningTestCase(BaseTransactionTestCase):
         document.json = {"new": "data"}
         document.data = b"new data"
         document.save()
+        document.refresh_from_db()
 
         # Run the task again
         tasks.document_versioning()
@@ -58,17 +65,15 @@ class DocumentVersioningTestCase(BaseTransactionTestCase):
         last_document_version = models.DocumentVersion.available_objects.last()
         assert last_document_version is not None  # For mypy
         self.assertEqual(last_document_version.document, document)
-        self.assertEqual(last_document_version.data, b"new data")
-        self.assertEqual(
-            last_document_version.json_hash, sha256(str(document.json).encode()).hexdigest()
-        )
+        self.assertEqual(last_document_version.get_data(), b"new data")
+        self.assertEqual(last_document_version.json_hash, document.json_hash)
         self.assertEqual(last_document_version.document_type, document.document_type)
 
         # But if we run the task again, there should be no new versions since the document hasn't
         # changed
 
-        with self.assertNumQueries(2):
-            # Only two queries to check and no inserts
+        with self.assertNumQueries(1):
+            # Only one query to check the queue and no inserts
             tasks.document_versioning()
         self.assertEqual(models.DocumentVersion.available_objects.count(), 2)
 
@@ -107,8 +112,8 @@ class DocumentVersioningTestCase(BaseTransactionTestCase):
         tasks.document_versioning()
         self.assertEqual(models.DocumentVersion.available_objects.count(), 2)
 
-        # However if we make objects even older, they will get skipped because we're limiting the
-        # query to only the last 24 hours for performance reasons.
+        # Documents that didn't change since their last version aren't versioned again, no matter
+        # how long ago they were updated.
         models.DocumentVersion.available_objects.update(
             created_at=timezone.now() - timedelta(hours=25),
             updated_at=timezone.now() - timedelta(hours=25),
@@ -121,3 +126,322 @@ class DocumentVersioningTestCase(BaseTransactionTestCase):
         # Run the task again
         tasks.document_versioning()
         self.assertEqual(models.DocumentVersion.available_objects.count(), 2)
+
+    def test_versioning_queue(self) -> None:
+        """Changes are versioned even if the task didn't run for longer than a day."""
+        documents = factories.DocumentFactory.create_batch(3, json={"test": "data"})
+        tasks.document_versioning(batch_size=2)
+        self.assertEqual(models.DocumentVersion.available_objects.count(), 3)
+        self.assertFalse(models.PendingDocumentVersion.objects.exists())
+
+        for document in documents[:2]:
+            document.json = {"new": "data"}
+            document.save()
+        # Only changes of the JSON queue a document.
+        documents[2].data = b"new data"
+        documents[2].save()
+        self.assertEqual(models.PendingDocumentVersion.objects.count(), 2)
+        models.Document.objects.update(updated_at=timezone.now() - timedelta(days=2))
+
+        with self.assertNumQueries(9):
+            # Both documents are versioned with one query for their keyframes, one for their data
+            # and a single insert in a single transaction.
+            tasks.document_versioning()
+        self.assertEqual(models.DocumentVersion.available_objects.count(), 5)
+        self.assertFalse(models.PendingDocumentVersion.objects.exists())
+
+        # Documents that were changed back to their last version aren't versioned again.
+        documents[0].json = {"newer": "data"}
+        documents[0].save()
+        documents[0].json = {"new": "data"}
+        documents[0].save()
+        models.Document.objects.update(updated_at=timezone.now() - timedelta(days=2))
+        tasks.document_versioning()
+        self.assertEqual(models.DocumentVersion.available_objects.count(), 5)
+        self.assertFalse(models.PendingDocumentVersion.objects.exists())
+
+        # Deleting a document removes it from the queue.
+        documents[1].json = {"newer": "data"}
+        documents[1].save()
+        documents[1].delete()
+        self.assertFalse(models.PendingDocumentVersion.objects.exists())
+
+    def test_versioning_concurrent_change(self) -> None:
+        """Documents that change while their version is built stay queued."""
+        document = factories.DocumentFactory.create(json={"test": "data"}, data=b"test data")
+        new_document_version = tasks._new_document_version
+
+        def change_document(
+            document: models.Document, keyframe: models.DocumentVersion | None
+        ) -> models.DocumentVersion:
+            # The version is built outside of a transaction, without locking the document.
+            self.assertFalse(connection.in_atomic_block)
+            models.Document.objects.filter(pk=document.pk).update(json={"new": "data"})
+            return new_document_version(document, keyframe)
+
+        with mock.patch.object(tasks, "_new_document_version", side_effect=change_document):
+            tasks.document_versioning()
+        version = models.DocumentVersion.available_objects.get()
+        self.assertEqual(version.get_data(), b"test data")
+        pending = models.PendingDocumentVersion.objects.get()
+        document.refresh_from_db()
+        self.assertEqual(pending.json_hash, document.json_hash)
+        self.assertNotEqual(version.json_hash, document.json_hash)
+
+    def test_version_storage(self) -> None:
+        """Versions are stored as compressed keyframes and deltas to them."""
+        data = b" ".join(str(number).encode() for number in range(10_000))
+        document = factories.DocumentFactory.create(json={"version": 0}, data=data)
+
+        contents = [data]
+        with self.settings(NODE_VERSIONING_INTERVAL=0, NODE_VERSIONING_KEYFRAME_INTERVAL=2):
+            tasks.document_versioning()
+            for version in range(1, 4):
+                document.json = {"version": version}
+                document.data = contents[-1] + f" edit {version}".encode()
+                document.save()
+                contents.append(document.data)
+                tasks.document_versioning()
+
+        versions = list(models.DocumentVersion.available_objects.order_by("created_at"))
+        self.assertEqual(
+            [version.encoding for version in versions],
+            [
+                models.DocumentVersion.Encoding.ZLIB,
+                models.DocumentVersion.Encoding.DELTA,
+                models.DocumentVersion.Encoding.DELTA,
+                # A new keyframe after two deltas.
+                models.DocumentVersion.Encoding.ZLIB,
+            ],
+        )
+        self.assertEqual(versions[1].keyframe, versions[0])
+        self.assertEqual(versions[2].keyframe, versions[0])
+        self.assertIsNone(versions[3].keyframe)
+        self.assertLess(len(versions[0].data), len(data) / 2)
+        self.assertLess(len(versions[1].data), 100)
+        self.assertEqual([version.get_data() for version in versions], contents)
+        self.assertEqual([version.size for version in versions], [len(c) for c in contents])
+
+        # Keyframes can only be deleted along with their deltas.
+        with self.assertRaises(RestrictedError):
+            versions[0].delete(soft=False)
+        document.delete()
+        self.assertFalse(models.DocumentVersion.objects.exists())
+
+    def test_prune_document_versions(self) -> None:
+        # The versions are created within the same hour, which is more than an hour ago.
+        start = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=2)
+        space = factories.SpaceFactory.create()
+        space_document = factories.DocumentFactory.create()
+        space.document = space_document
+        space.save()
+        node_document = factories.DocumentFactory.create()
+        factories.NodeFactory.create(space=space, editor_document=node_document)
+        other_document = factories.DocumentFactory.create()
+        models.DocumentVersion.objects.all().delete()
+
+        def create_versions(document: models.Document) -> list[models.DocumentVersion]:
+            keyframe = factories.DocumentVersionFactory.create(document=document, data=b"x" * 100)
+            versions = [keyframe] + [
+                factories.DocumentVersionFactory.create(
+                    document=document,
+                    data=b"x" * 10,
+                    encoding=models.DocumentVersion.Encoding.DELTA,
+                    keyframe=keyframe,
+                )
+                for _ in range(4)
+            ]
+            # One version every ten minutes, the keyframe is the oldest one.
+            for index, version in enumerate(versions):
+                models.DocumentVersion.objects.filter(pk=version.pk).update(
+                    created_at=start + timedelta(minutes=10 * index)
+                )
+            return versions
+
+        other_versions = create_versions(other_document)
+        create_versions(space_document)
+        create_versions(node_document)
+
+        with self.settings(NODE_VERSIONING_RETENTION=[[None, 0]]):
+            self.assertEqual(tasks.prune_document_versions(), 0)
+        self.assertEqual(models.DocumentVersion.objects.count(), 15)
+
+        # The space only keeps the latest version per hour, and the keyframe it refers to.
+        space.version_retention = [[None, 60 * 60]]
+        space.save()
+        with (
+            self.settings(NODE_VERSIONING_RETENTION=[[None, 0]]),
+            self.assertNumQueries(9),
+        ):
+            # The documents, the policies of the spaces and their nodes, the versions, the
+            # deletion in a transaction with the blob lock and the check for further documents.
+            reclaimed = tasks.prune_document_versions()
+        self.assertEqual(reclaimed, 2 * 3 * 10)
+        self.assertEqual(models.DocumentVersion.objects.count(), 5 + 2 * 2)
+        self.assertEqual(models.DocumentVersion.objects.filter(document=other_document).count(), 5)
+        for document in (space_document, node_document):
+            latest = models.DocumentVersion.objects.filter(document=document).latest("created_at")
+            self.assertEqual(
+                set(models.DocumentVersion.objects.filter(document=document)),
+                {latest, latest.keyframe},
+            )
+
+        # Once older than the last tier, only the latest version is kept.
+        with self.settings(NODE_VERSIONING_RETENTION=[[60, 0]]):
+            self.assertEqual(tasks.prune_document_versions(batch_size=1), 3 * 10)
+        self.assertEqual(
+            set(models.DocumentVersion.objects.filter(document=other_document)),
+            {other_versions[-1], other_versions[0]},
+        )
+        self.assertEqual(tasks.prune_document_versions(), 0)
+
+    @override_settings(
+        STORAGES={
+            **settings.STORAGES,
+            "versions": {"BACKEND": "django.core.files.storage.InMemoryStorage"},
+        },
+        NODE_VERSIONING_BLOB_STORAGE="versions",
+        NODE_VERSIONING_INLINE_THRESHOLD=100,
+        NODE_VERSIONING_INTERVAL=0,
+        NODE_VERSIONING_KEYFRAME_INTERVAL=0,
+    )
+    def test_version_blob_storage(self) -> None:
+        """Large versions are offloaded to the blob storage, identical payloads only once."""
+        data = bytes(range(256)) * 4
+        documents = factories.DocumentFactory.create_batch(2, json={"test": "data"}, data=data)
+        small_document = factories.DocumentFactory.create(data=b"small")
+        tasks.document_versioning()
+
+        versions = {
+            version.document_id: version for version in models.DocumentVersion.objects.all()
+        }
+        small_version = versions.pop(small_document.pk)
+        self.assertEqual(small_version.blob_key, "")
+        self.assertEqual(small_version.get_data(), b"small")
+        self.assertEqual(len({version.blob_key for version in versions.values()}), 1)
+        for version in versions.values():
+            self.assertEqual(bytes(version.data), b"")
+            self.assertEqual(version.get_data(), data)
+        blob_key = versions[documents[0].pk].blob_key
+        blob_size = blobs.get_storage().size(blob_key)
+        self.assertGreaterEqual(blob_size, 100)
+
+        # Blobs are deleted once no version refers to them anymore.
+        for document in documents:
+            document.json = {"new": "data"}
+            document.data = b"new data"
+            document.save()
+        tasks.document_versioning()
+        with self.settings(NODE_VERSIONING_RETENTION=[[1, 0]]):
+            models.DocumentVersion.objects.filter(pk=versions[documents[0].pk].pk).update(
+                created_at=timezone.now() - timedelta(days=1)
+            )
+            self.assertEqual(tasks.prune_document_versions(), 0)
+            self.assertTrue(blobs.get_storage().exists(blob_key))
+            models.DocumentVersion.objects.update(created_at=timezone.now() - timedelta(days=1))
+            self.assertEqual(tasks.prune_document_versions(), blob_size)
+        self.assertFalse(blobs.get_storage().exists(blob_key))
+
+    @override_settings(
+        STORAGES={
+            **settings.STORAGES,
+            "versions": {"BACKEND": "django.core.files.storage.InMemoryStorage"},
+        },
+        NODE_VERSIONING_BLOB_STORAGE="versions",
+        NODE_VERSIONING_INLINE_THRESHOLD=100,
+        NODE_VERSIONING_INTERVAL=0,
+        NODE_VERSIONING_KEYFRAME_INTERVAL=0,
+        NODE_VERSIONING_RETENTION=[[1, 0]],
+    )
+    def test_version_blob_pruned_concurrently(self) -> None:
+        """A blob that is pruned while a new version with the same payload is built is restored."""
+        data = bytes(range(256)) * 4
+        document = factories.DocumentFactory.create(json={"test": "data"}, data=data)
+        tasks.document_versioning()
+        document.json = {"new": "data"}
+        document.data = b"new data"
+        document.save()
+        tasks.document_versioning()
+        models.DocumentVersion.objects.update(created_at=timezone.now() - timedelta(days=1))
+
+        new_document = factories.DocumentFactory.create(data=data)
+        save = blobs.save
+
+        def prune_after_save(payload: bytes) -> str:
+            # The blob is stored before the version, the old version's blob is pruned in between.
+            key = save(payload)
+            if blobs.get_storage().exists(key) and models.DocumentVersion.objects.count() == 2:
+                tasks.prune_document_versions()
+                self.assertFalse(blobs.get_storage().exists(key))
+            return key
+
+        with mock.patch.object(blobs, "save", side_effect=prune_after_save):
+            tasks.document_versioning()
+
+        version = models.DocumentVersion.objects.get(document=new_document)
+        self.assertTrue(blobs.get_storage().exists(version.blob_key))
+        self.assertEqual(version.get_data(), data)
+
+
+class DocumentEventPartitionsTestCase(BaseTransactionTestCase):
+    def create_event(self, created_at: datetime) -> models.DocumentEvent:
+        event = models.DocumentEvent.objects.create(
+            public_id=uuid.uuid4(),
+            document_type=models.DocumentType.EDITOR,
+            action=models.DocumentEvent.EventType.UPDATE,
+        )
+        models.DocumentEvent.objects.filter(pk=event.pk).update(created_at=created_at)
+        return event
+
+    def test_maintain_partitions(self) -> None:
+        now = timezone.now()
+        today = now.date()
+        past_day = today - timedelta(days=3)
+        partitions.create_partitions(past_day, 1)
+        event = self.create_event(now - timedelta(days=3))
+
+        with self.settings(NODE_CRDT_EVENTS_PARTITIONS_AHEAD=10):
+            tasks.maintain_document_event_partitions()
+        days = set(partitions.list_partitions().values())
+        self.assertIn(None, days)
+        self.assertTrue({today + timedelta(days=offset) for offset in range(10)} <= days)
+        # The partition of a past day is kept while it holds events.
+        self.assertIn(past_day, days)
+
+        event.delete()
+        tasks.maintain_document_event_partitions()
+        self.assertNotIn(past_day, set(partitions.list_partitions().values()))
+
+    def test_drop_partition_lock_timeout(self) -> None:
+        """Partitions that can't be locked in time are kept until the next run."""
+        past_day = timezone.now().date() - timedelta(days=3)
+        partitions.create_partitions(past_day, 1)
+
+        # Another transaction reading the events, e.g. one processing them.
+        other_connection = connections.create_connection(DEFAULT_DB_ALIAS)
+        try:
+            other_connection.set_autocommit(False)
+            with other_connection.cursor() as cursor:
+                cursor.execute(f"SELECT 1 FROM {partitions.TABLE}")
+            with (
+                self.settings(NODE_CRDT_EVENTS_PARTITION_LOCK_TIMEOUT=0.1),
+                self.assertLogs("nodes.partitions", level="WARNING"),
+            ):
+                tasks.maintain_document_event_partitions()
+            self.assertIn(past_day, set(partitions.list_partitions().values()))
+        finally:
+            other_connection.rollback()
+            other_connection.close()
+
+        tasks.maintain_document_event_partitions()
+        self.assertNotIn(past_day, set(partitions.list_partitions().values()))
+
+    def test_create_partition_with_events_in_default_partition(self) -> None:
+        day = timezone.now().date() + timedelta(days=30)
+        event = self.create_event(timezone.now() + timedelta(days=30))
+        with self.assertLogs("nodes.partitions", level="ERROR"):
+            self.assertEqual(partitions.create_partitions(day, 1), [])
+
+        # Once the event is processed, the partition can be created.
+        event.delete()
+        self.assertEqual(partitions.create_partitions(day, 1), [partitions.partition_name(day)])
@@ -1,7 +1,13 @@
+import copy
+import json
+import sys
+from unittest import mock
+
 from django.test import SimpleTestCase
 
 from nodes import utils
 from nodes.tests import fixtures
+from utils import tokens
 
 
 class NodeExtractionTestCase(SimpleTestCase):
@@ -9,3 +15,101 @@ class NodeExtractionTestCase(SimpleTestCase):
         """Test that text is extracted from a node."""
         text = utils.extract_text_from_node(fixtures.EDITOR_WITH_NODES["default"])
         self.assertListEqual(text, ["Test", "Test", "Hey"])
+
+    def test_iter_text_deeply_nested(self) -> None:
+        """Test that deeply nested content doesn't exceed the recursion limit."""
+        content: dict = {"type": "text", "text": "Deepest"}
+        for index in range(sys.getrecursionlimit() * 2):
+            content = {
+                "type": "listItem",
+                "content": [{"type": "text", "text": str(index)}, content],
+            }
+        texts = utils.extract_text_from_node(content)
+        self.assertEqual(len(texts), sys.getrecursionlimit() * 2 + 1)
+        self.assertEqual(texts[0], str(sys.getrecursionlimit() * 2 - 1))
+        self.assertEqual(texts[-1], "Deepest")
+
+    def test_extract_text_deeply_nested(self) -> None:
+        """Test that the text of deeply nested content is extracted and its blocks hashed."""
+        content: dict = {"type": "text", "text": "Deepest"}
+        for index in range(sys.getrecursionlimit() * 2):
+            content = {
+                "type": "listItem",
+                "content": [{"type": "text", "text": str(index)}, content],
+            }
+        text, _, blocks = utils.extract_text({"type": "doc", "content": [content]})
+        self.assertTrue(text.endswith(" 0 Deepest"))
+        self.assertEqual(len(blocks), 1)
+
+        # Blocks that are too deep for the JSON encoder are serialized the same way without it.
+        block = [*fixtures.EDITOR_WITH_NODES["default"]["content"], {"ä": [1.5, None, True, "\n"]}]
+        self.assertEqual(
+            "".join(utils._iter_json(block)),
+            json.dumps(block, separators=(",", ":"), ensure_ascii=False),
+        )
+
+    def test_truncate_text(self) -> None:
+        """Test that the text is extracted up to a character or token budget."""
+        text = " ".join(utils.extract_text_from_node(fixtures.EDITOR_WITH_NODES))
+        self.assertEqual(utils.truncate_text(fixtures.EDITOR_WITH_NODES), (text, False))
+        self.assertEqual(
+            utils.truncate_text(fixtures.EDITOR_WITH_NODES, max_characters=6), (text[:6], True)
+        )
+        self.assertEqual(
+            utils.truncate_text(fixtures.EDITOR_WITH_NODES, max_tokens=2), ("Test Test", True)
+        )
+        self.assertEqual(
+            utils.truncate_text(fixtures.EDITOR_WITH_NODES, max_characters=len(text)),
+            (text, False),
+        )
+
+        # The tokens are counted with the encoding of the given model.
+        with mock.patch.object(tokens, "token_count", wraps=tokens.token_count) as token_count:
+            utils.truncate_text(fixtures.EDITOR_WITH_NODES, max_tokens=2, model="gpt-4o")
+        self.assertTrue(token_count.call_args_list)
+        for call in token_count.call_args_list:
+            self.assertEqual(call.args[1], "gpt-4o")
+
+    def test_split_text_blocks(self) -> None:
+        """Test that the blocks of a document yield the same text as the whole document."""
+        blocks = utils.split_text_blocks(fixtures.EDITOR_WITH_NODES)
+        self.assertEqual(len(blocks), 6)
+        self.assertListEqual(
+            [text for block in blocks for text in utils.extract_text_from_node(block)],
+            utils.extract_text_from_node(fixtures.EDITOR_WITH_NODES),
+        )
+
+    def test_extract_text(self) -> None:
+        """Test that text and token counts are extracted block by block."""
+        text, token_count, blocks = utils.extract_text(fixtures.EDITOR_WITH_NODES)
+        self.assertEqual(text, " ".join(utils.extract_text_from_node(fixtures.EDITOR_WITH_NODES)))
+        self.assertEqual(token_count, tokens.token_count(text))
+        self.assertEqual(len(blocks), 6)
+        self.assertEqual(
+            sum(length + 1 for _, length, _ in blocks if length is not None) - 1, len(text)
+        )
+
+    def test_extract_text_incrementally(self) -> None:
+        """Test that only changed blocks are extracted and tokenized again."""
+        content = copy.deepcopy(fixtures.EDITOR_WITH_NODES)
+        text, _, blocks = utils.extract_text(content)
+
+        content["default"]["content"][0]["content"][0]["text"] = "Changed text"
+        with mock.patch("utils.tokens.token_count", wraps=tokens.token_count) as token_count:
+            new_text, new_token_count, new_blocks = utils.extract_text(
+                content, previous_text=text, previous_blocks=blocks
+            )
+
+        token_count.assert_called_once_with("Changed text")
+        self.assertEqual(new_text, "Changed text Test Hey")
+        self.assertEqual(new_token_count, tokens.token_count(new_text))
+        self.assertEqual(new_blocks[1:], blocks[1:])
+        self.assertNotEqual(new_blocks[0], blocks[0])
+
+    def test_extract_text_with_mismatching_blocks(self) -> None:
+        """Test that cached blocks are ignored if they don't match the previous text."""
+        text, _, blocks = utils.extract_text(fixtures.EDITOR_WITH_NODES)
+        new_text, _, _ = utils.extract_text(
+            fixtures.EDITOR_WITH_NODES, previous_text="Something else", previous_blocks=blocks
+        )
+        self.assertEqual(new_text, text)
@@ -0,0 +1,91 @@
+import datetime
+import random
+
+from django.core.exceptions import ValidationError
+from django.test import SimpleTestCase
+
+from nodes import versioning
+
+
+class VersioningTestCase(SimpleTestCase):
+    def setUp(self) -> None:
+        self.random = random.Random(0)
+        # Somewhat compressible data, like the encoded text of a CRDT document.
+        self.base = b" ".join(
+            self.random.choice([b"lorem", b"ipsum", b"dolor", b"sit", b"amet"]) for _ in range(5000)
+        )
+
+    def test_compress(self) -> None:
+        encoding, payload = versioning.compress(self.base)
+        self.assertEqual(encoding, versioning.ZLIB)
+        self.assertLess(len(payload), len(self.base))
+        self.assertEqual(versioning.decompress(encoding, payload), self.base)
+
+        # Small and incompressible blobs stay raw.
+        self.assertEqual(versioning.compress(b"data", threshold=1024), (versioning.RAW, b"data"))
+        data = self.random.randbytes(1000)
+        self.assertEqual(versioning.compress(data), (versioning.RAW, data))
+        self.assertEqual(versioning.decompress(versioning.RAW, data), data)
+
+        with self.assertRaises(ValueError):
+            versioning.decompress(versioning.DELTA, data)
+
+    def test_diff_and_patch(self) -> None:
+        middle = len(self.base) // 2
+        changes = [
+            self.base,
+            self.base + b" appended",
+            b"prepended " + self.base,
+            self.base[:middle] + b" inserted " + self.base[middle:],
+            self.base[:middle] + self.base[middle + 100 :],
+            b"",
+            self.random.randbytes(100),
+        ]
+        for data in changes:
+            with self.subTest(size=len(data)):
+                delta = versioning.diff(data, self.base)
+                self.assertEqual(versioning.patch(delta, self.base), data)
+                self.assertEqual(
+                    versioning.patch(versioning.diff(self.base, data), data), self.base
+                )
+
+        # Small changes result in small deltas.
+        delta = versioning.diff(changes[3], self.base)
+        self.assertLess(len(delta), 50)
+
+    def test_retained_versions(self) -> None:
+        now = datetime.datetime(2024, 6, 1, 0, 30, tzinfo=datetime.UTC)
+        hour, day = 60 * 60, 60 * 60 * 24
+        policy = [[hour, 0], [day, hour], [None, day]]
+        ages = [
+            # All versions of the last hour are kept.
+            (1, 60),
+            (2, 120),
+            # Only the latest version per hour within the last day.
+            (3, 2 * hour),
+            (4, 2 * hour + 60),
+            (5, 5 * hour),
+            # Only the latest version per day after that.
+            (6, 2 * day),
+            (7, 2 * day + 60),
+            (8, 3 * day),
+        ]
+        versions = [
+            (version_id, now - datetime.timedelta(seconds=age), None) for version_id, age in ages
+        ]
+        self.assertEqual(versioning.retained_versions(versions, policy, now), {1, 2, 3, 5, 6, 8})
+
+        # Versions older than the last tier are dropped, but the latest version is always kept.
+        policy = [[hour, 0], [day, hour]]
+        self.assertEqual(versioning.retained_versions(versions, policy, now), {1, 2, 3, 5})
+        self.assertEqual(versioning.retained_versions(versions[-2:], policy, now), {7})
+
+        # The keyframes of kept deltas are kept.
+        versions = [(1, now, 8), (2, now - datetime.timedelta(days=1), 8), *versions[-2:]]
+        self.assertEqual(versioning.retained_versions(versions, [[hour, 0]], now), {1, 8})
+
+    def test_validate_retention_policy(self) -> None:
+        versioning.validate_retention_policy([[3600, 0], [None, 86400]])
+        for policy in [[], {}, [[3600]], [[None, 0], [3600, 0]], [[-1, 0]], [[3600, "0"]]]:
+            with self.subTest(policy=policy), self.assertRaises(ValidationError):
+                versioning.validate_retention_policy(policy)
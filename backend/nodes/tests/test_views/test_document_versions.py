@@ -1,6 +1,10 @@
+from django.conf import settings
+from django.test import override_settings
 from django.urls import reverse
 
+import nodes.blobs
 import nodes.models
+import nodes.versioning
 from nodes.tests import factories
 from utils.testcases import BaseTransactionTestCase
 
@@ -159,3 +163,111 @@ class DocumentVersionViewTestCase(BaseTransactionTestCase):
             [item["id"] for item in response.data["results"]],
             [str(document_version_2.public_id), str(document_version_1.public_id)],
         )
+
+    def test_crdt(self) -> None:
+        space = factories.SpaceFactory.create(owner=self.owner_user)
+        data = b"0123456789" * 1000
+        document = factories.DocumentFactory.create(data=data)
+        factories.NodeFactory.create(space=space, editor_document=document)
+        keyframe = factories.DocumentVersionFactory.create(
+            document=document,
+            encoding=nodes.models.DocumentVersion.Encoding.ZLIB,
+            data=nodes.versioning.compress(data)[1],
+        )
+        delta = factories.DocumentVersionFactory.create(
+            document=document,
+            encoding=nodes.models.DocumentVersion.Encoding.DELTA,
+            keyframe=keyframe,
+            data=nodes.versioning.diff(data + b"edit", data),
+        )
+
+        for version, expected in ((keyframe, data), (delta, data + b"edit")):
+            response = self.owner_client.get(
+                reverse("nodes:document-versions-crdt", args=[version.public_id])
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response), expected)
+
+    def test_crdt_caching(self) -> None:
+        space = factories.SpaceFactory.create(owner=self.owner_user)
+        data = b"0123456789" * 1000
+        document = factories.DocumentFactory.create(data=data)
+        factories.NodeFactory.create(space=space, editor_document=document)
+        version = factories.DocumentVersionFactory.create(document=document, data=data)
+        url = reverse("nodes:document-versions-crdt", args=[version.public_id])
+        etag = f'"{version.json_hash}"'
+
+        response = self.owner_client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["ETag"], etag)
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(response["Content-Length"], str(len(data)))
+
+        response = self.owner_client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(response.content, b"")
+
+        response = self.owner_client.get(url, headers={"Range": "bytes=10-19"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes 10-19/{len(data)}")
+        self.assertEqual(b"".join(response), data[10:20])
+
+        response = self.owner_client.get(url, headers={"Range": "bytes=-5"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response), data[-5:])
+
+        response = self.owner_client.get(url, headers={"Range": f"bytes={len(data)}-"})
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(data)}")
+
+        # Ranges of another version of the content are ignored.
+        response = self.owner_client.get(
+            url, headers={"Range": "bytes=10-19", "If-Range": '"outdated"'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response), data)
+
+    @override_settings(
+        STORAGES={
+            **settings.STORAGES,
+            "versions": {"BACKEND": "django.core.files.storage.InMemoryStorage"},
+        },
+        NODE_VERSIONING_BLOB_STORAGE="versions",
+    )
+    def test_crdt_from_blob_storage(self) -> None:
+        space = factories.SpaceFactory.create(owner=self.owner_user)
+        data = b"0123456789" * 1000
+        document = factories.DocumentFactory.create(data=data)
+        factories.NodeFactory.create(space=space, editor_document=document)
+        raw_version = factories.DocumentVersionFactory.create(
+            document=document, data=b"", blob_key=nodes.blobs.save(data)
+        )
+        compressed_version = factories.DocumentVersionFactory.create(
+            document=document,
+            data=b"",
+            encoding=nodes.models.DocumentVersion.Encoding.ZLIB,
+            blob_key=nodes.blobs.save(nodes.versioning.compress(data)[1]),
+        )
+
+        for version in (raw_version, compressed_version):
+            response = self.owner_client.get(
+                reverse("nodes:document-versions-crdt", args=[version.public_id])
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b"".join(response), data)
+
+        response = self.owner_client.get(
+            reverse("nodes:document-versions-crdt", args=[raw_version.public_id]),
+            headers={"Range": "bytes=5-"},
+        )
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b"".join(response), data[5:])
+
+        # Uncompressed blobs can be downloaded from the storage directly.
+        with self.settings(NODE_VERSIONING_BLOB_REDIRECT=True):
+            response = self.owner_client.get(
+                reverse("nodes:document-versions-crdt", args=[raw_version.public_id])
+            )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], nodes.blobs.url(raw_version.blob_key))
@@ -16,6 +16,8 @@ class MethodNodesViewTestCase(BaseTransactionTestCase):
             response = self.owner_client.get(reverse("nodes:methods-list"))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.data["count"], 10)
+        self.assertNotIn("revision", response.data["results"][0])
+        self.assertNotIn("text_blocks", response.data["results"][0])
 
     def test_retrieve(self) -> None:
         node = factories.MethodNodeFactory.create(creator=self.owner_user, owner=self.owner_user)
@@ -187,3 +187,17 @@ class NodesViewTestCase(BaseTransactionTestCase):
         self.assertEqual(response.status_code, 200)
 
         self.assertIn(f"This node is a prerequisite for these nodes: {target_id}", response.data)
+
+        response = self.owner_client.get(
+            reverse("nodes:nodes-context", args=[node.public_id]), {"token_budget": 100_000}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(f"This node is a prerequisite for these nodes: {target_id}", response.data)
+
+        for token_budget in ("many", "0", "-10"):
+            response = self.owner_client.get(
+                reverse("nodes:nodes-context", args=[node.public_id]),
+                {"token_budget": token_budget},
+            )
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("token_budget", response.data)
@@ -35,6 +35,9 @@ class SearchViewTestCase(BaseTransactionTestCase):
         self.assertEqual(response.data["results"][0]["id"], str(node.public_id))
         self.assertEqual(len(response.data["results"][0]["parents"]), 1)
         self.assertEqual(response.data["results"][0]["parents"][0], parent_node.public_id)
+        # Internal fields aren't part of the results.
+        self.assertNotIn("revision", response.data["results"][0])
+        self.assertNotIn("text_blocks", response.data["results"][0])
 
         response = self.owner_client.get(
             reverse("nodes:search"), {"space": str(space.public_id), "q": "not existing"}
@@ -1,16 +1,220 @@
+import hashlib
+import json
 import typing
 
+from utils import tokens
+
+
+def iter_text(node: dict[str, typing.Any] | list | None) -> typing.Iterator[str]:
+    """
+    Yield the text fragments of a node lazily, in document order. The content is walked with an
+    explicit stack of iterators instead of recursion, so deeply nested content can't exceed the
+    recursion limit and nothing is copied between the levels.
+    """
+    # Every frame is a dict with the iterator over its items, or None with an iterator over a list.
+    stack: list[tuple[dict | None, typing.Iterator]] = [(None, iter((node,)))]
+    push = stack.append
+    pop = stack.pop
+    while stack:
+        parent, iterator = stack[-1]
+        if parent is None:
+            for item in iterator:
+                if isinstance(item, dict):
+                    push((item, iter(item.items())))
+                    break
+                if isinstance(item, list):
+                    push((None, iter(item)))
+                    break
+            else:
+                pop()
+        else:
+            for key, value in iterator:
+                if key == "type" and value == "text":
+                    yield parent["text"]
+                elif isinstance(value, dict):
+                    push((value, iter(value.items())))
+                    break
+                elif isinstance(value, list):
+                    push((None, iter(value)))
+                    break
+            else:
+                pop()
+
 
 def extract_text_from_node(node: dict[str, typing.Any] | list | None) -> list[str]:
     """Extract text from a node."""
+    return list(iter_text(node))
+
+
+def truncate_text(
+    node: dict[str, typing.Any] | list | None,
+    max_characters: int | None = None,
+    max_tokens: int | None = None,
+    model: str = "gpt-4",
+) -> tuple[str, bool]:
+    """
+    Extract the text of a node, joined like `extract_text`, up to a budget of characters and/or
+    tokens. Stops walking the content as soon as the budget is exhausted and returns the text and
+    whether it was truncated. The token budget is kept per fragment, so the text ends at the last
+    fragment that fits completely.
+    """
+    texts: list[str] = []
+    characters = token_count = 0
+    for fragment in iter_text(node):
+        separator = " " if texts else ""
+        if max_tokens is not None:
+            token_count += tokens.token_count(separator + fragment, model) or 0
+            if token_count > max_tokens:
+                return "".join(texts), True
+        if max_characters is not None and characters + len(separator + fragment) > max_characters:
+            texts.append((separator + fragment)[: max_characters - characters])
+            return "".join(texts), True
+        texts.append(separator + fragment)
+        characters += len(separator + fragment)
+    return "".join(texts), False
+
+
+def split_text_blocks(node: dict[str, typing.Any] | list | None) -> list[typing.Any]:
+    """
+    Split the content of a node into its top-level blocks, e.g. the paragraphs of a document.
+    Extracting the text of the blocks one after another yields the same texts as extracting them
+    from the whole content.
+    """
+    blocks: list[typing.Any] = []
+    # Containers are expanded in place, the stack holds the remaining items in reverse order.
+    stack = [node]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, list):
+            stack.extend(reversed(item))
+        elif isinstance(item, dict) and item.get("type") == "doc":
+            for key, value in item.items():
+                if key == "content" and isinstance(value, list):
+                    blocks.extend(value)
+                elif isinstance(value, (dict, list)):
+                    blocks.append(value)
+        elif isinstance(item, dict) and "type" not in item:
+            # A container of documents, e.g. the fragments of the editor's Yjs document.
+            stack.extend(
+                reversed([value for value in item.values() if isinstance(value, (dict, list))])
+            )
+        elif item is not None:
+            blocks.append(item)
+    return blocks
+
+
+def _iter_json(value: typing.Any) -> typing.Iterator[str]:
+    """
+    Serialize a value like `json.dumps` with compact separators and without escaping non-ASCII
+    characters, but with an explicit stack, so deeply nested values can't exceed the recursion
+    limit.
+    """
+    # Every entry is a value to serialize, or the already serialized punctuation and keys.
+    stack: list[tuple[bool, typing.Any]] = [(False, value)]
+    while stack:
+        is_serialized, item = stack.pop()
+        if is_serialized:
+            yield item
+        elif isinstance(item, dict):
+            parts: list[tuple[bool, typing.Any]] = [(True, "{")]
+            for index, (key, child) in enumerate(item.items()):
+                # Like the encoder, keys that aren't strings are converted to their JSON.
+                name = key if isinstance(key, str) else json.dumps(key)
+                parts.append((True, ("," if index else "") + json.dumps(name, ensure_ascii=False)))
+                parts.append((True, ":"))
+                parts.append((False, child))
+            parts.append((True, "}"))
+            stack.extend(reversed(parts))
+        elif isinstance(item, list | tuple):
+            parts = [(True, "[")]
+            for index, child in enumerate(item):
+                if index:
+                    parts.append((True, ","))
+                parts.append((False, child))
+            parts.append((True, "]"))
+            stack.extend(reversed(parts))
+        else:
+            yield json.dumps(item, ensure_ascii=False)
+
+
+def _block_hash(block: typing.Any) -> str:
+    block_hash = hashlib.blake2b(digest_size=16)
+    try:
+        block_hash.update(json.dumps(block, separators=(",", ":"), ensure_ascii=False).encode())
+    except RecursionError:
+        # The encoder recurses, deeply nested blocks are serialized the same way without it.
+        for part in _iter_json(block):
+            block_hash.update(part.encode())
+    return block_hash.hexdigest()
+
+
+def extract_text(
+    content: dict[str, typing.Any] | list | None,
+    previous_text: str | None = None,
+    previous_blocks: list[list] | None = None,
+) -> tuple[str, int, list[list]]:
+    """
+    Extract the text of the content and count its tokens, block by block.
+
+    Returns the text, its token count and the blocks as `[hash, length, token count]` entries,
+    where the length is `None` for blocks without text. When the blocks and text of the previous
+    content are given, the text and token counts of unchanged blocks are reused, so that only the
+    changed blocks are extracted and tokenized again.
+
+    The blocks are joined with a space and every block except for the first one is tokenized with
+    its leading space, which matches tokenizing the whole text except for rare edge cases at the
+    boundaries of blocks.
+    """
+    cache = _text_block_cache(previous_text, previous_blocks)
+
     texts: list[str] = []
-    if isinstance(node, dict):
-        for key, value in node.items():
-            if key == "type" and value == "text":
-                texts.append(node["text"])
-            elif isinstance(value, (dict, list)):
-                texts.extend(extract_text_from_node(value))
-    elif isinstance(node, list):
-        for item in node:
-            texts.extend(extract_text_from_node(item))
-    return texts
+    token_count = 0
+    blocks: list[list] = []
+    for block in split_text_blocks(content):
+        block_hash = _block_hash(block)
+        is_first = not texts
+        if (block_hash, is_first) in cache:
+            text, block_token_count = cache[(block_hash, is_first)]
+        else:
+            block_texts = extract_text_from_node(block)
+            text = " ".join(block_texts) if block_texts else None
+            block_token_count = 0
+            if text is not None:
+                block_token_count = tokens.token_count(text if is_first else f" {text}") or 0
+            cache[(block_hash, is_first)] = (text, block_token_count)
+
+        if text is None:
+            blocks.append([block_hash, None, 0])
+        else:
+            texts.append(text)
+            token_count += block_token_count
+            blocks.append([block_hash, len(text), block_token_count])
+    return " ".join(texts), token_count, blocks
+
+
+def _text_block_cache(
+    text: str | None, blocks: list[list] | None
+) -> dict[tuple[str, bool], tuple[str | None, int]]:
+    """
+    Return the text and token count of the given blocks, keyed by the hash of the block and whether
+    it is the first block with text. The cache is empty if the blocks don't match the text.
+    """
+    if text is None or not blocks:
+        return {}
+    cache: dict[tuple[str, bool], tuple[str | None, int]] = {}
+    position = 0
+    is_first = True
+    for block_hash, length, block_token_count in blocks:
+        if length is None:
+            cache[(block_hash, is_first)] = (None, 0)
+            continue
+        if not is_first:
+            if text[position : position + 1] != " ":
+                return {}
+            position += 1
+        cache[(block_hash, is_first)] = (text[position : position + length], block_token_count)
+        position += length
+        is_first = False
+    if position != len(text):
+        return {}
+    return cache
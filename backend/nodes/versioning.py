@@ -0,0 +1,148 @@
+"""
+Compact storage of document versions.
+
+Versions are stored as keyframes, which contain the whole (possibly compressed) CRDT binary of a
+document, and deltas, which only contain the difference to a keyframe of the same document. A delta
+keeps the common prefix and suffix of the binaries as offsets and compresses the part in between,
+using the corresponding part of the keyframe as a preset dictionary. Deltas always refer to a
+keyframe directly, so restoring a version needs at most one other version.
+
+Old versions are thinned out according to a retention policy, see `validate_retention_policy`.
+"""
+
+import datetime
+import struct
+import typing
+import zlib
+
+from django.core.exceptions import ValidationError
+
+RAW = "raw"
+ZLIB = "zlib"
+DELTA = "delta"
+
+COMPRESSION_LEVEL = 6
+# zlib only looks back 32 KiB, a larger dictionary doesn't help.
+MAX_DICTIONARY_SIZE = 32 * 1024
+# The length of the common prefix and suffix.
+_DELTA_HEADER = struct.Struct("<II")
+
+
+def compress(data: bytes, threshold: int = 0) -> tuple[str, bytes]:
+    """Encode a keyframe, blobs smaller than the threshold or that don't compress stay raw."""
+    if len(data) >= threshold:
+        compressed = zlib.compress(data, COMPRESSION_LEVEL)
+        if len(compressed) < len(data):
+            return ZLIB, compressed
+    return RAW, data
+
+
+def decompress(encoding: str, payload: bytes) -> bytes:
+    """Decode a keyframe."""
+    if encoding == RAW:
+        return payload
+    if encoding == ZLIB:
+        return zlib.decompress(payload)
+    raise ValueError(f"{encoding!r} is not a keyframe encoding.")
+
+
+def _common_prefix_length(a: bytes, b: bytes) -> int:
+    # Binary search, so the comparisons are done by memcmp instead of byte by byte in Python.
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[low:middle] == b[low:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _common_suffix_length(a: bytes, b: bytes, limit: int) -> int:
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle : len(a) - low] == b[len(b) - middle : len(b) - low]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def _dictionary(base: bytes, prefix: int, suffix: int) -> bytes:
+    return base[prefix : len(base) - suffix][-MAX_DICTIONARY_SIZE:]
+
+
+def diff(data: bytes, base: bytes) -> bytes:
+    """Encode the data as a delta to the base."""
+    prefix = _common_prefix_length(data, base)
+    suffix = _common_suffix_length(data, base, min(len(data), len(base)) - prefix)
+    dictionary = _dictionary(base, prefix, suffix)
+    compressor = (
+        zlib.compressobj(COMPRESSION_LEVEL, zdict=dictionary)
+        if dictionary
+        else zlib.compressobj(COMPRESSION_LEVEL)
+    )
+    middle = data[prefix : len(data) - suffix]
+    return _DELTA_HEADER.pack(prefix, suffix) + compressor.compress(middle) + compressor.flush()
+
+
+def patch(payload: bytes, base: bytes) -> bytes:
+    """Restore the data from a delta to the base."""
+    prefix, suffix = _DELTA_HEADER.unpack_from(payload)
+    dictionary = _dictionary(base, prefix, suffix)
+    decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+    middle = decompressor.decompress(payload[_DELTA_HEADER.size :]) + decompressor.flush()
+    return base[:prefix] + middle + base[len(base) - suffix :]
+
+
+def validate_retention_policy(policy: typing.Any) -> None:
+    """
+    Validate a retention policy, a list of `[max_age, interval]` tiers in seconds. Versions younger
+    than the `max_age` of a tier are thinned out to the latest version per `interval`, an interval
+    of 0 keeps all of them and a `max_age` of null applies to all older versions.
+    Versions older than the last tier are dropped.
+    """
+    if not isinstance(policy, list) or not policy:
+        raise ValidationError("The retention policy must be a non-empty list of tiers.")
+    for index, tier in enumerate(policy):
+        if (
+            not isinstance(tier, list | tuple)
+            or len(tier) != 2
+            or not (tier[0] is None or isinstance(tier[0], int) and tier[0] > 0)
+            or not (isinstance(tier[1], int) and tier[1] >= 0)
+        ):
+            raise ValidationError(f"Invalid retention tier {tier!r}, expected [max_age, interval].")
+        if tier[0] is None and index != len(policy) - 1:
+            raise ValidationError("Only the last retention tier can apply to all older versions.")
+
+
+def retained_versions(
+    versions: typing.Iterable[tuple[int, datetime.datetime, int | None]],
+    policy: typing.Sequence[typing.Sequence[int | None]],
+    now: datetime.datetime,
+) -> set[int]:
+    """
+    Return the IDs of the versions of a document to keep according to the retention policy.
+    The versions are given as `(id, created_at, keyframe_id)`. The latest version and the keyframes
+    of kept deltas are always kept.
+    """
+    # Newest first, the ID breaks ties.
+    versions = sorted(versions, key=lambda version: (version[1], version[0]), reverse=True)
+    keep: set[int] = set()
+    buckets: set[tuple[int, float]] = set()
+    for index, (version_id, created_at, _) in enumerate(versions):
+        age = (now - created_at).total_seconds()
+        interval = next(
+            (interval for max_age, interval in policy if max_age is None or age < max_age), None
+        )
+        if interval is None and index > 0:
+            continue
+        # The buckets are aligned to the epoch, so that the same versions are kept on every run.
+        bucket = (interval, created_at.timestamp() // interval) if interval else (0, version_id)
+        if index == 0 or bucket not in buckets:
+            keep.add(version_id)
+            buckets.add(bucket)
+    return keep | {
+        keyframe_id for version_id, _, keyframe_id in versions if keyframe_id and version_id in keep
+    }
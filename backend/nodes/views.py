@@ -1,3 +1,4 @@
+import io
 import json
 import typing
 import uuid
@@ -7,9 +8,10 @@ import dry_rest_permissions.generics as dry_permissions
 import rest_framework.filters
 import sentry_sdk
 from django import http
+from django.conf import settings
 from django.db import models as django_models
 from drf_spectacular.utils import OpenApiParameter, extend_schema, extend_schema_view
-from rest_framework import decorators, generics, parsers, response
+from rest_framework import decorators, exceptions, generics, parsers, response
 
 import permissions.managers
 import permissions.models
@@ -20,9 +22,9 @@ import utils.llm
 import utils.managers
 import utils.pagination
 import utils.parsers
-from nodes import filters, models, serializers
+from nodes import blobs, filters, models, serializers
 from utils import filters as base_filters
-from utils import views
+from utils import responses, views
 
 if typing.TYPE_CHECKING:
     from rest_framework import request
@@ -115,12 +117,33 @@ class NodeModelViewSet(views.BaseReadOnlyModelViewSet[models.Node]):
     @extend_schema(
         description="Retrieve context based on this node.",
         summary="Retrieve context",
+        parameters=[
+            OpenApiParameter(name="depth", type=int, description="Depth of the context."),
+            OpenApiParameter(
+                name="token_budget",
+                type=int,
+                description="Maximum number of tokens of the context, which is then expanded "
+                "best-first to fit it instead of by depth.",
+            ),
+        ],
     )
     @decorators.action(detail=True, methods=["get"])
     def context(
         self, request: "request.Request", public_id: str | None = None
     ) -> response.Response:
         node = self.get_object()
+        if "token_budget" in request.query_params:
+            try:
+                token_budget = int(request.query_params["token_budget"])
+            except ValueError as exc:
+                raise exceptions.ValidationError(
+                    {"token_budget": "Token budget must be an integer."}
+                ) from exc
+            if token_budget <= 0:
+                raise exceptions.ValidationError({"token_budget": "Token budget must be positive."})
+            context, _ = node.node_context_for_budget(token_budget, include_edges=True)
+            return response.Response(context)
+
         try:
             depth = int(request.query_params.get("depth", 1))
         except ValueError as exc:
@@ -280,9 +303,24 @@ class DocumentVersionModelViewSet(views.BaseReadOnlyModelViewSet[models.Document
         summary="Retrieve CRDT of a node version",
     )
     @decorators.action(detail=True, methods=["get"])
-    def crdt(self, request: "request.Request", public_id: str | None = None) -> http.HttpResponse:
+    def crdt(
+        self, request: "request.Request", public_id: str | None = None
+    ) -> http.HttpResponseBase:
         document_version = self.get_object()
-        return http.HttpResponse(document_version.data, content_type="application/octet-stream")
+        # Versions never change, the hash of their content identifies them.
+        etag = f'"{document_version.json_hash}"'
+        if (
+            document_version.blob_key
+            and document_version.encoding == models.DocumentVersion.Encoding.RAW
+        ):
+            # Uncompressed keyframes in the blob storage don't need to be restored.
+            if settings.NODE_VERSIONING_BLOB_REDIRECT:
+                return http.HttpResponseRedirect(blobs.url(document_version.blob_key))
+            blob = blobs.open_blob(document_version.blob_key)
+            size = document_version.size if document_version.size is not None else blob.size
+            return responses.immutable_file_response(request, blob, size, etag)
+        data = document_version.get_data()
+        return responses.immutable_file_response(request, io.BytesIO(data), len(data), etag)
 
 
 @extend_schema(tags=["Nodes"])
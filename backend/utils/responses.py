@@ -0,0 +1,91 @@
+import re
+import typing
+
+from django import http
+from django.utils.cache import get_conditional_response
+
+# Immutable content can be cached forever, but only by the client, it might require permissions.
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+CHUNK_SIZE = 64 * 1024
+
+_BYTE_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_byte_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parse a `Range` header with a single byte range into the first and last byte position.
+    Returns None if the range can't be satisfied and raises ValueError if it isn't supported.
+    """
+    match = _BYTE_RANGE_RE.match(header.strip())
+    if match is None:
+        # Multiple ranges or other units, which servers are free to ignore.
+        raise ValueError(f"Unsupported range {header!r}")
+    first, last = match.groups()
+    if not first:
+        if not last:
+            raise ValueError(f"Unsupported range {header!r}")
+        # A suffix range, the last bytes of the content.
+        if int(last) == 0 or size == 0:
+            return None
+        return max(size - int(last), 0), size - 1
+    if int(first) >= size or (last and int(last) < int(first)):
+        return None
+    return int(first), min(int(last), size - 1) if last else size - 1
+
+
+def _read_chunks(file: typing.BinaryIO, length: int) -> typing.Iterator[bytes]:
+    with file:
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def immutable_file_response(
+    request: http.HttpRequest,
+    file: typing.BinaryIO,
+    size: int,
+    etag: str,
+    content_type: str = "application/octet-stream",
+) -> http.HttpResponseBase:
+    """
+    Stream immutable content in chunks, with a strong `ETag` and headers that allow caching it
+    forever. Supports conditional requests with `If-None-Match` and requests for a single byte
+    range with `Range` and `If-Range`.
+    """
+    headers = {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL, "Accept-Ranges": "bytes"}
+
+    if (not_modified := get_conditional_response(request, etag=etag)) is not None:
+        file.close()
+        for header, value in headers.items():
+            not_modified[header] = value
+        return not_modified
+
+    first, last = 0, size - 1
+    status = 200
+    range_header = request.headers.get("Range")
+    # The range only applies to the content it was requested for.
+    if range_header and request.headers.get("If-Range", etag) == etag:
+        try:
+            byte_range = parse_byte_range(range_header, size)
+        except ValueError:
+            pass
+        else:
+            if byte_range is None:
+                file.close()
+                return http.HttpResponse(
+                    status=416, headers={**headers, "Content-Range": f"bytes */{size}"}
+                )
+            first, last = byte_range
+            status = 206
+            headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+
+    file.seek(first)
+    length = last - first + 1
+    response = http.StreamingHttpResponse(
+        _read_chunks(file, length), status=status, content_type=content_type, headers=headers
+    )
+    response["Content-Length"] = str(length)
+    return response
@@ -0,0 +1,49 @@
+import dataclasses
+from unittest import mock
+
+import tiktoken
+from django.test import SimpleTestCase, override_settings
+
+from utils import tokens
+
+
+class TokenCountTestCase(SimpleTestCase):
+    def test_token_counts(self) -> None:
+        """Test that counting tokens in a batch matches counting them one by one."""
+        texts = ["test", None, "test test", ""]
+        self.assertListEqual(
+            tokens.token_counts(texts), [tokens.token_count(text) for text in texts]
+        )
+
+    def test_token_counts_threaded(self) -> None:
+        """Test that large batches counted in threads keep the order of the texts."""
+        texts = [f"text {index} " * index for index in range(tokens.MIN_THREADED_BATCH_SIZE * 2)]
+        texts += [None, *texts[:10]]
+        self.assertListEqual(
+            tokens.token_counts(texts), [tokens.token_count(text) for text in texts]
+        )
+
+    def test_get_encoding(self) -> None:
+        """Test that encodings are shared and unknown models fall back to cl100k_base."""
+        self.assertIs(tokens.get_encoding("gpt-4"), tokens.get_encoding("gpt-4"))
+        with self.assertLogs("utils.tokens", "WARNING"):
+            self.assertEqual(tokens.get_encoding("unknown-model").name, "cl100k_base")
+
+    @override_settings(TOKEN_COUNT_CACHE_MIN_LENGTH=10)
+    def test_token_count_cache(self) -> None:
+        """Test that texts are only tokenized once and found in the shared cache."""
+        tokens.clear_local_cache()
+        texts = ["short", "a longer text " * 10, "a longer text " * 10]
+        stats = dataclasses.replace(tokens.cache_stats)
+        expected = tokens.token_counts(texts)
+        self.assertEqual(tokens.cache_stats.misses - stats.misses, 2)
+
+        stats = dataclasses.replace(tokens.cache_stats)
+        with mock.patch.object(tiktoken.Encoding, "encode") as encode:
+            self.assertListEqual(tokens.token_counts(texts), expected)
+            tokens.clear_local_cache()
+            self.assertEqual(tokens.token_count(texts[1]), expected[1])
+        encode.assert_not_called()
+        self.assertEqual(tokens.cache_stats.local_hits - stats.local_hits, 2)
+        self.assertEqual(tokens.cache_stats.shared_hits - stats.shared_hits, 1)
+        self.assertEqual(tokens.cache_stats.misses, stats.misses)
@@ -1,18 +1,153 @@
+import dataclasses
+import functools
 import logging
+import os
+import threading
 import typing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
 
 import tiktoken
+from django.conf import settings
+from django.core.cache import caches
 from openai.types.chat import ChatCompletionMessageParam
 
 logger = logging.getLogger(__name__)
 
+# Encoding releases the GIL, so larger batches are split across a pool of threads. Smaller batches
+# are encoded in the calling thread, where handing them off would cost more than it saves.
+MAX_THREADS = 8
+MIN_THREADED_BATCH_SIZE = 64
+# The cache statistics are logged every this many lookups.
+STATS_LOG_INTERVAL = 10_000
+
+
+@dataclasses.dataclass
+class TokenCacheStats:
+    """Counters of the token count cache."""
+
+    local_hits: int = 0
+    shared_hits: int = 0
+    misses: int = 0
+
+    @property
+    def lookups(self) -> int:
+        return self.local_hits + self.shared_hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        return (self.local_hits + self.shared_hits) / self.lookups if self.lookups else 0.0
+
+
+cache_stats = TokenCacheStats()
+# Token counts of the most recently used texts by cache key, shared by the threads of the process.
+_local_cache: OrderedDict[str, int] = OrderedDict()
+_local_cache_lock = threading.Lock()
+
+
+@functools.cache
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Return the encoding of a model, shared by the whole process."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # This is different from the OpenAI cookbook, which uses the o200k_base encoding, but for
+        # us, cl100k_base is still the default.
+        logger.warning(f"Model {model} not found, using the cl100k_base encoding.")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@functools.cache
+def _executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(MAX_THREADS, thread_name_prefix="tokens")
+
+
+# Threads don't survive a fork, e.g. of the Celery worker processes.
+os.register_at_fork(after_in_child=_executor.cache_clear)
+
+
+def _cache_key(encoding: tiktoken.Encoding, text: str) -> str:
+    return f"tokens:{encoding.name}:{sha256(text.encode(errors='surrogatepass')).hexdigest()}"
+
+
+def _count(encoding: tiktoken.Encoding, texts: list[str]) -> list[int]:
+    def count(batch: list[str]) -> list[int]:
+        return [len(encoding.encode(text)) for text in batch]
+
+    if len(texts) < MIN_THREADED_BATCH_SIZE:
+        return count(texts)
+    size = -(-len(texts) // MAX_THREADS)
+    batches = [texts[i : i + size] for i in range(0, len(texts), size)]
+    return [value for values in _executor().map(count, batches) for value in values]
+
+
+def _record(local_hits: int, shared_hits: int, misses: int) -> None:
+    with _local_cache_lock:
+        lookups = cache_stats.lookups
+        cache_stats.local_hits += local_hits
+        cache_stats.shared_hits += shared_hits
+        cache_stats.misses += misses
+        if lookups // STATS_LOG_INTERVAL != cache_stats.lookups // STATS_LOG_INTERVAL:
+            logger.info(f"Token count cache: {cache_stats}, hit rate {cache_stats.hit_rate:.1%}")
+
+
+def clear_local_cache() -> None:
+    with _local_cache_lock:
+        _local_cache.clear()
+
 
 def token_count(text: str | None, model: str = "gpt-4") -> int | None:
     """Count the number of tokens in a string."""
     if text is None:
         return None
-    enc = tiktoken.encoding_for_model(model)
-    return len(enc.encode(text))
+    return token_counts([text], model)[0]
+
+
+def token_counts(texts: typing.Iterable[str | None], model: str = "gpt-4") -> list[int | None]:
+    """
+    Count the number of tokens in multiple strings at once.
+
+    Counts are cached by the encoding and the hash of the text, in process and, for texts of at
+    least `TOKEN_COUNT_CACHE_MIN_LENGTH` characters, in the cache `TOKEN_COUNT_CACHE`. Only the
+    distinct texts that miss both caches are tokenized.
+    """
+    texts = list(texts)
+    encoding = get_encoding(model)
+    keys = {text: _cache_key(encoding, text) for text in texts if text is not None}
+    counts: dict[str, int] = {}
+
+    with _local_cache_lock:
+        for text, key in keys.items():
+            if (count := _local_cache.get(key)) is not None:
+                _local_cache.move_to_end(key)
+                counts[text] = count
+    local_hits = len(counts)
+
+    shared_keys = {
+        keys[text]: text
+        for text in keys
+        if text not in counts and len(text) >= settings.TOKEN_COUNT_CACHE_MIN_LENGTH
+    }
+    shared_cache = caches[settings.TOKEN_COUNT_CACHE]
+    shared_hits = shared_cache.get_many(list(shared_keys)) if shared_keys else {}
+    counts.update((shared_keys[key], count) for key, count in shared_hits.items())
+
+    missing = [text for text in keys if text not in counts]
+    counted = dict(zip(missing, _count(encoding, missing), strict=True))
+    counts.update(counted)
+    counted_keys = {keys[text]: count for text, count in counted.items()}
+    if to_share := {key: count for key, count in counted_keys.items() if key in shared_keys}:
+        shared_cache.set_many(to_share, settings.TOKEN_COUNT_CACHE_TIMEOUT)
+
+    with _local_cache_lock:
+        _local_cache.update(shared_hits)
+        _local_cache.update(counted_keys)
+        while len(_local_cache) > settings.TOKEN_COUNT_LOCAL_CACHE_SIZE:
+            _local_cache.popitem(last=False)
+    _record(local_hits, len(shared_hits), len(missing))
+
+    return [None if text is None else counts[text] for text in texts]
 
 
 # Copied from the OpenAI cookbook at:
@@ -22,14 +157,6 @@ def num_tokens_from_messages(
     messages: typing.Iterable[ChatCompletionMessageParam], model: str = "gpt-3.5-turbo-0613"
 ) -> int:
     """Return the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        # This is different from the original code, which uses the o200k_base encoding, but for us,
-        # cl100k_base is still the default.
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-
     if model == "gpt-3.5-turbo-0301":
         tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
         tokens_per_name = -1  # if there's a name, the role is omitted
@@ -38,11 +165,14 @@ def num_tokens_from_messages(
         tokens_per_name = 1
 
     num_tokens = 0
+    values: list[str] = []
     for message in messages:
         num_tokens += tokens_per_message
         for key, value in message.items():
-            num_tokens += len(encoding.encode(str(value)))
+            values.append(str(value))
             if key == "name":
                 num_tokens += tokens_per_name
+    # Count the tokens of all values at once, which uses the token count cache.
+    num_tokens += sum(count or 0 for count in token_counts(values, model))
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens